@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+'''Offline benchmarks for the hot paths of the SNooPy fitting chain.
+
+Each kernel is set up with fixed inputs (SN2006ax from snpy/tests, a fixed
+random seed and a fixed E(B-V)_gal so no network look-ups are done) and
+then timed in two ways:
+
+   * warm:  the kernel is run once to fill any caches, then the best of
+            [repeat] runs of [number] calls each is reported.
+   * cold:  (--cold) each kernel is run in a fresh python process, reporting
+            the time to import snpy, set up the inputs and make the first
+            call, along with the peak resident memory (max RSS) of that
+            process.
+
+Peak memory is only reported for cold runs: the warm kernels share one
+process, whose peak is set by whichever kernel used the most memory so far.
+Results can be saved as JSON and compared with a previous run::
+
+   python bench_snpy.py --cold --save results.json
+   python bench_snpy.py --compare baseline.json
+
+Use --kernels to run a subset (see --list).
+'''
+import sys,os
+import time
+import json
+import resource
+import platform
+import subprocess
+import argparse
+
+base = os.path.dirname(os.path.abspath(__file__))
+sn_file = os.path.join(base, '..', 'snpy', 'tests', 'SN2006ax.txt')
+
+def maxrss():
+   '''Peak resident memory of this process in MB.'''
+   rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+   if sys.platform == 'darwin':
+      return rss/1024.0**2      # bytes on OS X
+   return rss/1024.0            # kB on Linux
+
+def load_sn():
+   import snpy
+   s = snpy.get_sn(sn_file)
+   s.EBVgal = 0.02
+   s.e_EBVgal = 0.002
+   s.replot = 0
+   s.quiet = 1
+   return s
+
+# Each setup function returns the callable to be timed.
+def setup_model_call():
+   s = load_sn()
+   s.choose_model('EBV_NIR_model2')
+   s.fit(['B','V','r','i'], dokcorr=0)
+   bands = ['B','V','r','i']
+   ts = dict([(b, s.data[b].MJD) for b in bands])
+   def run():
+      for b in bands:
+         s.model(b, ts[b])
+   return run
+
+def setup_kcorr_mangle():
+   import numpy as num
+   from snpy import kcorr
+   num.random.seed(1)
+   days = num.arange(-10, 40, 3.0)
+   filts = ['B','V','r','i']
+   mags = 15 + 0.1*num.arange(4)[num.newaxis,:] + 0.01*days[:,num.newaxis]
+   mags = mags + num.random.normal(0, 0.01, size=mags.shape)
+   mask = num.ones(mags.shape, dtype=bool)
+   def run():
+      kcorr.kcorr_mangle(days, filts, mags, mask, filts, 0.02)
+   return run
+
+def setup_filter_response():
+   from snpy import kcorr, fset
+   wave,flux = kcorr.get_SED(0, 'H3')
+   filts = [fset[b] for b in ['u','B','V','g','r','i','Y','J','H']]
+   def run():
+      for f in filts:
+         f.response(wave, flux, z=0.02)
+   return run
+
+def setup_mangler_solve():
+   import numpy as num
+   from snpy import kcorr, mangle_spectrum
+   wave,flux = kcorr.get_SED(0, 'H3')
+   bands = ['B','V','r','i']
+   colors = num.array([-0.05, -0.02, 0.15])
+   def run():
+      m = mangle_spectrum.mangler(wave*1.02, flux, 'bspline')
+      m.solve(bands, colors)
+   return run
+
+def setup_dm15_template():
+   import numpy as num
+   from snpy.CSPtemp import dm15_template
+   t = dm15_template()
+   t.mktemplate(1.1)
+   times = num.arange(-10, 70, 0.5)
+   def run():
+      for b in ['B','V','r','i','Y','J','H']:
+         t.eval(b, times)
+   return run
+
+def setup_sn_fit():
+   s = load_sn()
+   s.choose_model('EBV_NIR_model2')
+   def run():
+      s.fit(['B','V','r','i'])
+   return run
+
+kernels = [
+      ('model_call', setup_model_call, 50),
+      ('kcorr_mangle', setup_kcorr_mangle, 5),
+      ('filter_response', setup_filter_response, 100),
+      ('mangler_solve', setup_mangler_solve, 5),
+      ('dm15_template_eval', setup_dm15_template, 20),
+      ('sn_fit', setup_sn_fit, 1)]
+kernel_names = [k[0] for k in kernels]
+
+def run_warm(name, repeat=3):
+   '''Run kernel [name] warm, returning a dictionary of results. Times are
+   in seconds per call.'''
+   setup,number = [(k[1],k[2]) for k in kernels if k[0] == name][0]
+   t0 = time.time()
+   func = setup()
+   t1 = time.time()
+   func()
+   t2 = time.time()
+   best = None
+   for i in range(repeat):
+      t = time.time()
+      for j in range(number):
+         func()
+      t = (time.time() - t)/number
+      if best is None or t < best:  best = t
+   return {'setup':t1 - t0, 'first':t2 - t1, 'warm':best, 'number':number,
+           'repeat':repeat}
+
+def run_cold(name):
+   '''Run kernel [name] in a fresh python process. Returns the import time,
+   setup time, time for the first call and the peak memory.'''
+   code = 'import time; t0=time.time(); import snpy; t1=time.time();'\
+          'import sys; sys.path.insert(0, %r); import bench_snpy as b;'\
+          'import json; s=[k[1] for k in b.kernels if k[0]==%r][0];'\
+          't2=time.time(); f=s(); t3=time.time(); f(); t4=time.time();'\
+          'print json.dumps({"import":t1-t0, "setup":t3-t2, "first":t4-t3,'\
+          '"maxrss_MB":b.maxrss()})' % (base, name)
+   p = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE)
+   out = p.communicate()[0]
+   if p.returncode != 0:
+      raise RuntimeError, "cold run of %s failed" % name
+   return json.loads(out.strip().split('\n')[-1])
+
+def machine_info():
+   return {'python':platform.python_version(), 'platform':platform.platform(),
+           'processor':platform.processor(), 'date':time.strftime('%Y-%m-%d')}
+
+def compare(results, baseline):
+   '''Print a table comparing [results] with [baseline].'''
+   print "%-20s %-6s %12s %12s %8s" % ('kernel','mode','baseline','now','ratio')
+   for name in kernel_names:
+      for mode,key in [('warm','warm'),('cold','first')]:
+         try:
+            t0 = baseline['kernels'][name][mode][key]
+            t1 = results['kernels'][name][mode][key]
+         except KeyError:
+            continue
+         print "%-20s %-6s %12.5f %12.5f %8.2f" % (name, mode, t0, t1, t1/t0)
+
+def main(argv=None):
+   parser = argparse.ArgumentParser(description=__doc__,
+         formatter_class=argparse.RawDescriptionHelpFormatter)
+   parser.add_argument('--kernels', default=None,
+         help='comma-separated list of kernels to run (default: all)')
+   parser.add_argument('--list', action='store_true', help='list kernels')
+   parser.add_argument('--repeat', type=int, default=3,
+         help='number of warm repeats (best is reported)')
+   parser.add_argument('--cold', action='store_true',
+         help='also run each kernel in a fresh process')
+   parser.add_argument('--save', default=None, help='save results to JSON')
+   parser.add_argument('--compare', default=None,
+         help='compare with previously saved results')
+   args = parser.parse_args(argv)
+
+   if args.list:
+      for name in kernel_names:  print name
+      return
+   names = kernel_names
+   if args.kernels is not None:
+      names = args.kernels.split(',')
+      for name in names:
+         if name not in kernel_names:
+            raise ValueError, "unknown kernel %s, use --list" % name
+
+   results = {'machine':machine_info(), 'kernels':{}}
+   for name in names:
+      res = {'warm':run_warm(name, args.repeat)}
+      print "%-20s warm %10.5f s/call  first %8.4f s" % \
+            (name, res['warm']['warm'], res['warm']['first'])
+      if args.cold:
+         res['cold'] = run_cold(name)
+         print "%-20s cold import %7.3f s  setup %7.3f s  first %8.4f s  "\
+               "maxrss %7.1f MB" % (name, res['cold']['import'],
+               res['cold']['setup'], res['cold']['first'],
+               res['cold']['maxrss_MB'])
+      results['kernels'][name] = res
+
+   if args.save is not None:
+      f = open(args.save, 'w')
+      json.dump(results, f, indent=1, sort_keys=True)
+      f.close()
+   if args.compare is not None:
+      f = open(args.compare)
+      baseline = json.load(f)
+      f.close()
+      compare(results, baseline)
+   return results
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,74 @@
+# Keep SNooPy warm and fit SN photometry files as they arrive.
+#
+#	USE
+#
+#	 python snoopy_daemon.py --inbox incoming --outbox fits [snoopy_fit options]
+#
+# Every SNooPy photometry file written to (or updated in) the inbox is fit
+# with the same recipe as snoopy_fit.py, by a pool of worker processes that
+# have already imported snpy. All the products (.snpy files, plots, profile)
+# are moved into the outbox once the fit is done, along with a
+# <name>.status.json record of the fit. Any option not listed below is passed
+# on to snoopy_fit.py (e.g., --fit_type, --bandlist, --no_kcor, --profile).
+#--------------------------------------------------------60
+
+import sys
+import functools
+import argparse
+from snpy.utils import watchdir
+from snoopy_fit import snoopy_fit
+
+def fit_file(filename, workdir, argv=[]):
+	'''Fit [filename] with snoopy_fit, writing the products to [workdir].'''
+	fitter = snoopy_fit()
+	parser = fitter.add_options()
+	options = parser.parse_args(list(argv) + ['--filepath', filename,
+											  '--outdir', workdir])
+	fitter.options = options
+	fitter.debug = options.debug
+	fitter.check_inputs()
+	countSN, countSNFail = fitter.main()
+	if countSNFail or not countSN:
+		raise RuntimeError("fit of %s failed" % filename)
+	return {'warnings':fitter.warnings}
+
+def add_options(parser=None, usage=None):
+	if parser == None:
+		parser = argparse.ArgumentParser(usage=usage, conflict_handler="resolve")
+	parser.add_argument('--inbox', required=True, type=str,
+						help='directory to watch for photometry files')
+	parser.add_argument('--outbox', required=True, type=str,
+						help='directory to which fit results are written')
+	parser.add_argument('--pattern', default='*.dat', type=str,
+						help='glob pattern of files to fit (default=%(default)s)')
+	parser.add_argument('--debounce', default=2.0, type=float,
+						help='seconds a file must be unchanged before it is fit (default=%(default)s)')
+	parser.add_argument('--workers', default=2, type=int,
+						help='number of worker processes (default=%(default)s)')
+	parser.add_argument('--max_queue', default=None, type=int,
+						help='maximum number of files waiting to be fit (default=2*workers)')
+	parser.add_argument('--poll', default=1.0, type=float,
+						help='seconds between scans of the inbox (default=%(default)s)')
+	parser.add_argument('--once', default=False, action="store_true",
+						help='fit what is in the inbox, then exit')
+	return parser
+
+if __name__ == "__main__":
+	usagestring = """python snoopy_daemon.py --inbox <dir> --outbox <dir> <snoopy_fit options>
+example: python snoopy_daemon.py --inbox incoming --outbox fits --workers 4 --fit_type optical
+"""
+	parser = add_options(usage=usagestring)
+	options, fit_argv = parser.parse_known_args()
+
+	watcher = watchdir.WatchDir(options.inbox, options.outbox,
+								functools.partial(fit_file, argv=fit_argv),
+								pattern=options.pattern, debounce=options.debounce,
+								workers=options.workers, max_queue=options.max_queue,
+								poll_interval=options.poll)
+	print("# Watching %s for %s (%d workers)" % (options.inbox, options.pattern,
+												 options.workers))
+	try:
+		watcher.run(until_idle=options.once)
+	except KeyboardInterrupt:
+		pass
+	print("\n# -- %i SNe fitted and %i failed --" % (watcher.nfit, watcher.nfail))
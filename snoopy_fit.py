@@ -28,7 +28,12 @@
 #--------------------------------------------------------60
 
 import sys # To read arguments in command line
+import matplotlib
+matplotlib.use('Agg') # Plots are only saved to files: no display needed.
 from snpy import *
+from snpy.utils import profiler
+from snpy.utils import pmap
+from snpy import fitstore
 import numpy as np
 import glob # To read the files in my directory
 import os # To use command line like instructions
@@ -36,7 +41,95 @@ from matplotlib import pyplot as plt
 import argparse
 
 #########################################################60
+
+# Observer-frame NIR bands in Andy's compilation or RAISINs
+# (but using Snoopy names).
+All_NIR_bands = ['Y','Ydw','JANDI','J2m', 'J', 'Jrc1', 'Jrc2','Jdw',
+				 'HANDI', 'H2m', 'H', 'Hdw', 'KANDI', 'Ks2m', 'K',
+				 'f125w', 'f160w']
+
+def plot_fit(snpyfile, DirSaveOutput, NameDataFileToSave, bandlist=None,
+			 fit_type='opticalnir', s=None):
+	"""Render the filters, k-corrections and fit plots of a fit saved in
+	snpyfile (or of the sn object s, if given) into DirSaveOutput."""
+	if s is None:
+		s = get_sn(snpyfile)
+	if bandlist:
+		BandsToFit = [band for band in list(s.data.keys())
+					  if band in bandlist.split(',')]
+	NIRbands = [band for band in list(s.data.keys()) if band in All_NIR_bands]
+
+	plt.close() # Close any possible plot unfinished/leftover.
+
+	# Plot filters
+	s.plot_filters(fill=True, outfile="%s/%s_Filters.png"%(DirSaveOutput,NameDataFileToSave))
+	plt.close()
+
+	# Plot kcorrs
+	s.plot_kcorrs(outfile='%s/%s_PlotKcorrs.png'%(DirSaveOutput,NameDataFileToSave))
+	plt.close()
+
+	# --- Plotting	--->
+
+	plt.figure()
+
+	x_loc = 5; # days
+
+	#- Determine the y location for the text info. It is going to be below
+	#  from the maximum of the last filter to be plotted
+	if bandlist:
+		y_loc = s.get_max(bands=BandsToFit[0])[1]+0.6
+		x_loc = s.get_max(bands=BandsToFit[0])[0]
+	else:
+		if fit_type == "optical":
+			y_loc = s.get_max(bands=s.filter_order[-1])[1]+0.6
+			x_loc = s.get_max(bands=s.filter_order[-1])[0]
+		else:
+			y_loc = s.get_max(bands=s.filter_order[-(len(NIRbands)+1)])[1]+0.6
+			x_loc = s.get_max(bands=s.filter_order[-(len(NIRbands)+1)])[0]
+
+	s.plot(epoch=True,xrange=(x_loc-20,x_loc+50),yrange=(y_loc+3,y_loc-2))
+
+	print(x_loc,y_loc)
+	try:
+		plt.text(-20,y_loc+3,r"""$\Delta$m15 = %.2f $\pm$ %.2f
+$z_{\rm hel}$ = %.3f
+$\mu$ = %.3f $\pm$ %.3f
+$T_{\rm Bmax}$ = %.2f $\pm$ %.3f
+E(B-V)$_{\rm MW}$ = %.3f
+E(B-V)$_{\rm host}$ = %.3f $\pm$ %.3f"""%(
+	s.dm15,s.e_dm15,s.z,s.DM,s.e_DM,s.Tmax,
+	s.e_Tmax,s.EBVgal,s.EBVhost,s.e_EBVhost))
+	except:
+		plt.text(-20,y_loc+3,r"""$s$ = %.2f $\pm$ %.2f
+$z_{\rm hel}$ = %.3f
+$\mu$ = %.3f $\pm$ %.3f
+$T_{\rm Bmax}$ = %.2f $\pm$ %.3f
+E(B-V)$_{\rm MW}$ = %.3f
+E(B-V)$_{\rm host}$ = %.3f $\pm$ %.3f"""%(
+	s.st,s.e_st,s.z,s.DM,s.e_DM,s.Tmax,
+	s.e_Tmax,s.EBVgal,s.EBVhost,s.e_EBVhost))
 		
+	plt.savefig("%s/%s_PlotFitText.png"%(DirSaveOutput,NameDataFileToSave),
+				format='png')
+	plt.close()
+	# <--- Plotting	 ---
+
+def _render(job):
+	"""Pool worker: render the plots of one saved fit. Returns
+	(snpyfile, error message or None)."""
+	try:
+		plot_fit(*job)
+		return (job[0], None)
+	except Exception as err:
+		plt.close('all')
+		return (job[0], str(err))
+
+def render_plots(jobs, workers=1):
+	"""Render the plots for a list of jobs (arguments of plot_fit), using
+	a pool of [workers] processes. Returns a list of (snpyfile, error)."""
+	return pmap.pmap(_render, jobs, workers, chunksize=1)
+
 class snoopy_fit:
 	def __init__(self):
 		self.warnings = []
@@ -77,11 +170,52 @@ class snoopy_fit:
 							help='output directory for fits (default=%default)')
 		parser.add_argument('--bandlist', default="gDEC,rDEC,zDEC,iDEC,ps1_g,ps1_r,ps1_i,ps1_z,f125w,f160w", type=str,
 							help='list of comma-separated bands to fit, can be empty to fit all bands (default=%default)')
+		parser.add_argument('--results_db', default=None, type=str,
+							help='SQLite results store to which the fits are added (default=%default)')
+		parser.add_argument('--no_store_systematics', default=True, action="store_false",
+							dest='store_systematics',
+							help='don\'t record the systematic errors in --results_db')
+		parser.add_argument('--profile', default=False, action="store_true",
+							help='time each fitting stage and write a JSON record per SN to the output directory (default=%default)')
+		parser.add_argument('--multistart', default=0, type=int,
+							help='seed the (B,V) prefit with this many extra starts from a scan over Tmax and shape (default=%default)')
+		parser.add_argument('--plots', default='now', choices=['now','later','none'],
+							help='render the plots after each fit (now), after all the fits in parallel (later) or not at all (default=%default)')
+		parser.add_argument('--plot_workers', default=1, type=int,
+							help='number of processes rendering plots with --plots later or --render_plots (default=%default)')
+		parser.add_argument('--render_plots', default=False, action="store_true",
+							help='only render the plots of the fits already saved in --outdir (default=%default)')
 
 		return parser
 
+	def render(self):
+		"""Render the plots of all the fits saved in the output directory."""
+		jobs = []
+		for snpyfile in sorted(glob.glob('%s/*_1stFit.snpy'%self.options.outdir)):
+			NameDataFileToSave = os.path.basename(snpyfile)[:-len('_1stFit.snpy')]
+			jobs.append((snpyfile, self.options.outdir, NameDataFileToSave,
+						 self.options.bandlist, self.options.fit_type))
+		return self.render_jobs(jobs)
+
+	def render_jobs(self, jobs):
+		"""Render the plots for jobs, returning the number that succeeded
+		and failed."""
+		print("# Rendering the plots of %s fits with %s workers."%(
+			len(jobs), self.options.plot_workers))
+		countOK = countFail = 0
+		for snpyfile,err in render_plots(jobs, self.options.plot_workers):
+			if err is None:
+				countOK += 1
+			else:
+				countFail += 1
+				self.addwarning("%s. Plotting failed: %s"%(snpyfile, err))
+		return countOK, countFail
+
 	def main(self):
 
+		if self.options.render_plots:
+			return self.render()
+
 		#- Reading the LC data file names with the snoopy format.
 		the_list = glob.glob(self.options.filepath)
 
@@ -98,200 +232,175 @@ class snoopy_fit:
 		countSN = 0 # Counter number of SNe fitted correctly
 		countSNFail = 0 # # Counter number of SNe failed during the fitting.
 
+		store = None
+		if self.options.results_db:
+			store = fitstore.FitStore(self.options.results_db)
+		plot_jobs = [] # plots to render after all the fits (--plots later)
+
 		#------------------------------
 
-		for file in the_list:
-			try:
-				print(" ")
-				print("\n==================== %s ===================\n"%file[0:14])
-				print("%s"%file)
+		try:
+			for file in the_list:
+				prof = None
+				if self.options.profile:
+					prof = profiler.Profiler(file).activate()
+				try:
+					print(" ")
+					print("\n==================== %s ===================\n"%file[0:14])
+					print("%s"%file)
 				
-				s = get_sn(file)
-				s.summary()
-				s.choose_model('EBV_NIR_model2')
+					s = get_sn(file)
+					s.summary()
+					s.choose_model('EBV_NIR_model2')
 				
-				#- Creation of an array with the name of the filters of this SN.
-				FilterNames_array = []
-				for band in s.restbands:
-					FilterNames_array += [band]
+					#- Creation of an array with the name of the filters of this SN.
+					FilterNames_array = []
+					for band in s.restbands:
+						FilterNames_array += [band]
 					
-				#- Creation of an array with the specific band names to fit for this SN:
-				if self.options.bandlist:
-					BandsToFit = []; BandsExcludedOfFit = []
-					for band in list(s.data.keys()):
-						if band in self.options.bandlist.split(','): BandsToFit += [band]
-						else: BandsExcludedOfFit += [band]
-
-				else:
-					#- Creation of an array with the name the OPTICAL only and
-					# NIR only filters.
-					# Observer-frame NIR bands in Andy's compilation or RAISINs
-					# (but using Snoopy names).
-					All_NIR_bands = ['Y','Ydw','JANDI','J2m', 'J', 'Jrc1', 'Jrc2','Jdw',
-									 'HANDI', 'H2m', 'H', 'Hdw', 'KANDI', 'Ks2m', 'K',
-									 'f125w', 'f160w']
-					OpticalBands = [] # List to put the optical-only bands
-					NIRbands = [] # List to put the NIR-only bands
-					for band in list(s.data.keys()):
-						if band not in All_NIR_bands: OpticalBands += [band]
-						else: NIRbands += [band]
-
-				#--- Find out if filters (Bs, Vs) or (B,V) are present in the photometry.
-				# If so, do a quick fit (without k-corr) to find T_Bmax,
-				# if (Bs, Vs) or (B,V) are -not- present, then fit all the LC
-				# data with "s.fit()" and write the name of the SN file in the
-				# failure text file.
-				#-------
-				if ('Bs' and 'Vs') in FilterNames_array:
-					# print ("Bands ('Bs','Vs') in: %s \n" % (s.name ))
-					# To quickly find the TB_max. It is needed 2 bands necessarily
-					s.fit(['Bs','Vs'], dokcorr=0)
-				#-------
-				elif ('B' and 'V')	in FilterNames_array:
-					# print ("Bands ('B','V') in: %s \n" % (s.name ))
-					# To quickly find the TB_max. It is needed 2 bands necessarily
-					s.fit(['B','V'], dokcorr=0)
-					#-------
-				elif ('B' and 'V0')	 in FilterNames_array:
-					# print ("Bands ('B','V') in: %s \n" % (s.name ))
-					# To quickly find the TB_max. It is needed 2 bands necessarily
-					# s.fit(['B','V0'], dokcorr=0)
-					s.fit(['B','V0'])
-					#-------
-				elif ('B' and 'V1')	 in FilterNames_array:
-					# print ("Bands ('B','V') in: %s \n" % (s.name ))
-					# To quickly find the TB_max. It is needed 2 bands necessarily
-					s.fit(['B','V1'], dokcorr=0)
+					#- Creation of an array with the specific band names to fit for this SN:
+					if self.options.bandlist:
+						BandsToFit = []; BandsExcludedOfFit = []
+						for band in list(s.data.keys()):
+							if band in self.options.bandlist.split(','): BandsToFit += [band]
+							else: BandsExcludedOfFit += [band]
+
+					else:
+						#- Creation of an array with the name the OPTICAL only and
+						# NIR only filters.
+						OpticalBands = [] # List to put the optical-only bands
+						NIRbands = [] # List to put the NIR-only bands
+						for band in list(s.data.keys()):
+							if band not in All_NIR_bands: OpticalBands += [band]
+							else: NIRbands += [band]
+
+					#--- Find out if filters (Bs, Vs) or (B,V) are present in the photometry.
+					# If so, do a quick fit (without k-corr) to find T_Bmax,
+					# if (Bs, Vs) or (B,V) are -not- present, then fit all the LC
+					# data with "s.fit()" and write the name of the SN file in the
+					# failure text file.
 					#-------
-				elif ('BANDI' and 'VANDI')	in FilterNames_array:
-					# print ("Bands ('BANDI','VANDI') in: %s \n" % (s.name ))
-					# To quickly find the TB_max. It is needed 2 bands necessarily
-					s.fit(['BANDI','VANDI'], dokcorr=0)
+					if ('Bs' and 'Vs') in FilterNames_array:
+						# print ("Bands ('Bs','Vs') in: %s \n" % (s.name ))
+						# To quickly find the TB_max. It is needed 2 bands necessarily
+						s.fit(['Bs','Vs'], dokcorr=0, multistart=self.options.multistart)
 					#-------
-				else: # When there is NOT the bands (B, V) nor (Bs, Vs) in the LC data
-					# print ("No bands in %s \n" % (s.name ))
-					print("No B,V observed-frame bands found, but don't worry.")
-
-				print("%s. Prefitting (B,V) with no kcorrections: done."%s.name)
-
-				#-------------------------------------------------------------------
-				# MAIN FITTING, either, Optical only, Optica+NIR, or specific bands only:
-
-				if self.options.bandlist: # Final fit all the data
-					if self.debug: print("Bands to plot:", BandsToFit)
-					s.fit(BandsToFit, dokcorr=(not self.options.no_kcor),
-						  k_stretch=(not self.options.no_kcor_stretch),
-						  reset_kcorrs=True)
-					if self.debug: print('Fitted bands:', BandsToFit)
-
-				else:
-
-					if self.options.fit_type == "optical": # Final fit all the data
-						if self.debug: print("Bands to plot:", OpticalBands)
-						s.fit(OpticalBands, dokcorr=(not self.options.no_kcor),
+					elif ('B' and 'V')	in FilterNames_array:
+						# print ("Bands ('B','V') in: %s \n" % (s.name ))
+						# To quickly find the TB_max. It is needed 2 bands necessarily
+						s.fit(['B','V'], dokcorr=0, multistart=self.options.multistart)
+						#-------
+					elif ('B' and 'V0')	 in FilterNames_array:
+						# print ("Bands ('B','V') in: %s \n" % (s.name ))
+						# To quickly find the TB_max. It is needed 2 bands necessarily
+						# s.fit(['B','V0'], dokcorr=0)
+						s.fit(['B','V0'], multistart=self.options.multistart)
+						#-------
+					elif ('B' and 'V1')	 in FilterNames_array:
+						# print ("Bands ('B','V') in: %s \n" % (s.name ))
+						# To quickly find the TB_max. It is needed 2 bands necessarily
+						s.fit(['B','V1'], dokcorr=0, multistart=self.options.multistart)
+						#-------
+					elif ('BANDI' and 'VANDI')	in FilterNames_array:
+						# print ("Bands ('BANDI','VANDI') in: %s \n" % (s.name ))
+						# To quickly find the TB_max. It is needed 2 bands necessarily
+						s.fit(['BANDI','VANDI'], dokcorr=0, multistart=self.options.multistart)
+						#-------
+					else: # When there is NOT the bands (B, V) nor (Bs, Vs) in the LC data
+						# print ("No bands in %s \n" % (s.name ))
+						print("No B,V observed-frame bands found, but don't worry.")
+
+					print("%s. Prefitting (B,V) with no kcorrections: done."%s.name)
+
+					#-------------------------------------------------------------------
+					# MAIN FITTING, either, Optical only, Optica+NIR, or specific bands only:
+
+					if self.options.bandlist: # Final fit all the data
+						if self.debug: print("Bands to plot:", BandsToFit)
+						s.fit(BandsToFit, dokcorr=(not self.options.no_kcor),
 							  k_stretch=(not self.options.no_kcor_stretch),
 							  reset_kcorrs=True)
-						if self.debug: print("Fitting optical bands only: done")
-
-					elif self.options.fit_type == "opticalnir": # Final fit all the data
-						if self.debug: print("Bands to plot:", list(s.data.keys()))
-						s.fit(dokcorr=(not self.options.no_kcor),
-							  k_stretch=(not self.options.no_kcor_stretch),
-							  reset_kcorrs=True)
-						if self.debug: print("Fitting optical+nir bands: done")
+						if self.debug: print('Fitted bands:', BandsToFit)
 
 					else:
-						raise RuntimeError("NIR alone not yet implemented")
-
-				if self.debug:
-					print("%s. Fitting all the bands: done with no issues."%s.name)
-				#-------------------------------------------------------------------
-				#  Saving the snpy data
 
-				# Removing the words "_snoopy.dat" at the end of the name for each SN.
-				NameDataFileToSave = file.split('/')[-1].split('.')[0]
-
-				s.save('%s/%s_1stFit.snpy'%(DirSaveOutput,NameDataFileToSave))
-				if self.debug:
-					print("%s. The '_1stFit.snpy' file created and saved."%s.name)
-
-				#-------------------------------------------------------------------
-
-				#		PLOTTING
-
-				if self.debug: print("%s. Preparing to plot the fit."%s.name)
-
-				plt.close() # Close any possible plot unfinished/leftover.
-
-				# Plot filters
-				s.plot_filters(fill=True, outfile="%s/%s_Filters.png"%(DirSaveOutput,NameDataFileToSave))
-				plt.close()
-				if self.debug: print("%s. Plot filters: done."%s.name)
-
-				# Plot kcorrs
-				s.plot_kcorrs(outfile='%s/%s_PlotKcorrs.png'%(DirSaveOutput,NameDataFileToSave))
-				plt.close()
-				if self.debug: print("%s. Plot kcorrs: done."%s.name)
-
-				countSN = countSN + 1
-
-				# --- Plotting	--->
-
-				plt.figure()
-
-				x_loc = 5; # days
-
-				#- Determine the y location for the text info. It is going to be below
-				#  from the maximum of the last filter to be plotted
-				if self.options.bandlist:
-					y_loc = s.get_max(bands=BandsToFit[0])[1]+0.6
-					x_loc = s.get_max(bands=BandsToFit[0])[0]
-				else:
-					if self.fit_type == "optical":
-						y_loc = s.get_max(bands=s.filter_order[-1])[1]+0.6
-						x_loc = s.get_max(bands=s.filter_order[-1])[0]
-					else:
-						y_loc = s.get_max(bands=s.filter_order[-(len(NIRbands)+1)])[1]+0.6
-						x_loc = s.get_max(bands=s.filter_order[-(len(NIRbands)+1)])[0]
-
-				s.plot(epoch=True,xrange=(x_loc-20,x_loc+50),yrange=(y_loc+3,y_loc-2))
-
-				print(x_loc,y_loc)
-				try:
-					plt.text(-20,y_loc+3,r"""$\Delta$m15 = %.2f $\pm$ %.2f
-$z_{\rm hel}$ = %.3f
-$\mu$ = %.3f $\pm$ %.3f
-$T_{\rm Bmax}$ = %.2f $\pm$ %.3f
-E(B-V)$_{\rm MW}$ = %.3f
-E(B-V)$_{\rm host}$ = %.3f $\pm$ %.3f"""%(
-	s.dm15,s.e_dm15,s.z,s.DM,s.e_DM,s.Tmax,
-	s.e_Tmax,s.EBVgal,s.EBVhost,s.e_EBVhost))
-				except:
-					plt.text(-20,y_loc+3,r"""$s$ = %.2f $\pm$ %.2f
-$z_{\rm hel}$ = %.3f
-$\mu$ = %.3f $\pm$ %.3f
-$T_{\rm Bmax}$ = %.2f $\pm$ %.3f
-E(B-V)$_{\rm MW}$ = %.3f
-E(B-V)$_{\rm host}$ = %.3f $\pm$ %.3f"""%(
-	s.st,s.e_st,s.z,s.DM,s.e_DM,s.Tmax,
-	s.e_Tmax,s.EBVgal,s.EBVhost,s.e_EBVhost))
-					
-				plt.savefig("%s/%s_PlotFitText.png"%(DirSaveOutput,NameDataFileToSave),
-							format='png')
-				plt.close()
-				
-				if self.debug: print("%s. Plot fit with text: done."%s.name)
-				# <--- Plotting	 ---
-
-				#-----------------------------------------------------------------------
-
-				print('%s: All done with no issues.'%s.name)
-			except Exception as err:
-				countSNFail = countSNFail + 1
-				#Removing the words "snoopy.dat" at the end of the name for each SN:
-				NameDataFileToSave = file.split('.')[0]
-				print "%s. Failed in some part during running this code."%file
-				print "%s"%err
+						if self.options.fit_type == "optical": # Final fit all the data
+							if self.debug: print("Bands to plot:", OpticalBands)
+							s.fit(OpticalBands, dokcorr=(not self.options.no_kcor),
+								  k_stretch=(not self.options.no_kcor_stretch),
+								  reset_kcorrs=True)
+							if self.debug: print("Fitting optical bands only: done")
+
+						elif self.options.fit_type == "opticalnir": # Final fit all the data
+							if self.debug: print("Bands to plot:", list(s.data.keys()))
+							s.fit(dokcorr=(not self.options.no_kcor),
+								  k_stretch=(not self.options.no_kcor_stretch),
+								  reset_kcorrs=True)
+							if self.debug: print("Fitting optical+nir bands: done")
+
+						else:
+							raise RuntimeError("NIR alone not yet implemented")
+
+					if self.debug:
+						print("%s. Fitting all the bands: done with no issues."%s.name)
+					if store is not None:
+						store.add(s, systematics=self.options.store_systematics,
+								  options={'fit_type':self.options.fit_type,
+											  'bandlist':self.options.bandlist,
+											  'no_kcor':self.options.no_kcor,
+											  'no_kcor_stretch':self.options.no_kcor_stretch})
+					#-------------------------------------------------------------------
+					#  Saving the snpy data
+
+					# Removing the words "_snoopy.dat" at the end of the name for each SN.
+					NameDataFileToSave = file.split('/')[-1].split('.')[0]
+
+					with profiler.stage('save'):
+						s.save('%s/%s_1stFit.snpy'%(DirSaveOutput,NameDataFileToSave))
+					if self.debug:
+						print("%s. The '_1stFit.snpy' file created and saved."%s.name)
+
+					#-------------------------------------------------------------------
+
+					#		PLOTTING
+
+					job = ('%s/%s_1stFit.snpy'%(DirSaveOutput,NameDataFileToSave),
+						   DirSaveOutput, NameDataFileToSave, self.options.bandlist,
+						   self.options.fit_type)
+					if self.options.plots == 'now':
+						if self.debug: print("%s. Preparing to plot the fit."%s.name)
+						with profiler.stage('plotting'):
+							plot_fit(*job, s=s)
+						if self.debug: print("%s. Plots: done."%s.name)
+					elif self.options.plots == 'later':
+						plot_jobs.append(job)
+
+					countSN = countSN + 1
+
+					#-----------------------------------------------------------------------
+
+					print('%s: All done with no issues.'%s.name)
+				except Exception as err:
+					countSNFail = countSNFail + 1
+					#Removing the words "snoopy.dat" at the end of the name for each SN:
+					NameDataFileToSave = file.split('.')[0]
+					print "%s. Failed in some part during running this code."%file
+					print "%s"%err
+					if prof is not None:
+						prof.info['status'] = 'failed'
+						prof.info['error'] = str(err)
+				if prof is not None:
+					prof.deactivate()
+					prof.info.setdefault('status', 'ok')
+					prof.write('%s/%s_profile.json'%(DirSaveOutput,
+						file.split('/')[-1].split('.')[0]))
+
+			# Deferred plots are rendered in parallel once all the fits are done
+			if plot_jobs:
+				self.render_jobs(plot_jobs)
+		finally:
+			if store is not None:
+				store.close()
 		return countSN, countSNFail
 				
 if __name__ == "__main__":
@@ -313,5 +422,8 @@ example: python snoopy_fit.py --filepath '../snoopy_lc_optnir/*dat' --outdir out
 		print('There were warnings!!')
 		print((snpy.warnings))
 	
-	print("\n\n# -- %i SNe fitted and %i failed --"%(countSN, countSNFail))
+	if options.render_plots:
+		print("\n\n# -- %i SNe plotted and %i failed --"%(countSN, countSNFail))
+	else:
+		print("\n\n# -- %i SNe fitted and %i failed --"%(countSN, countSNFail))
 		
@@ -44,16 +44,7 @@ from scipy.interpolate import CloughTocher2DInterpolator as interp2D
 from scipy.interpolate import bisplrep,bisplev
 import scipy.optimize
 import pickle
-try:
-   from astropy.io import fits as pyfits
-except ImportError:
-   try:
-      import pyfits
-   except ImportError:
-      sys.stderr.write('Error:  You need pyfits to run snpy.  You can get it\n')
-      sys.stderr.write('        from:  http://www.stsci.edu/resources/'+\
-                       'software_hardware/pyfits/\n')
-      raise ImportError
+from snpy.utils import profiler
 
 debug=0
 
@@ -101,6 +92,17 @@ def load_data(band, param='dm15', gen=1):
          return
 
 
+      # only needed if the pickle is out of date, and slow to import
+      try:
+         from astropy.io import fits as pyfits
+      except ImportError:
+         try:
+            import pyfits
+         except ImportError:
+            sys.stderr.write('Error:  You need pyfits to run snpy.  You can get it\n')
+            sys.stderr.write('        from:  http://www.stsci.edu/resources/'+\
+                             'software_hardware/pyfits/\n')
+            raise ImportError
       f = pyfits.open(file)
       h = f[0].header
       fdata = f[0].data
@@ -163,6 +165,7 @@ def finterp(band, t, p, param, gen, extrap=False):
    else:
       scalar = 0
    t = num.atleast_1d(t)
+   profiler.count('template.bisplev')
    # First the evaluation mtarix:
    Z = num.atleast_2d(bisplev(t, p, f))[:,0]
    eZ = num.atleast_2d(bisplev(t, p, ef))[:,0]
@@ -43,6 +43,7 @@ import numpy as num
 import dm15temp2c as dm15tempc
 import pickle
 from scipy.interpolate import bisplev
+from snpy.utils import profiler
 
 base = os.path.dirname(globals()['__file__'])
 if base == '':  base = '.'
@@ -159,6 +160,7 @@ class template:
          dm15tempc.dm15temp(filter_numbers[band], self.dm15, evt, evd, eevd, 
                self.normalize, sigx0, xscale, maxsigmax, sigy0)
       else:
+         profiler.count('template.bisplev')
          if not isinstance(evt, num.ndarray):
             evd = num.array([bisplev(evt, self.dm15, btck[band])])
             eevd = num.array([bisplev(evt, self.dm15, btck["e_"+band])])
@@ -11,7 +11,6 @@ from snpy import ubertemp,NIR_ubertemp
 from snpy import kcorr
 from snpy.utils import redlaw
 from numpy.linalg import cholesky
-from scipy import stats
 from scipy.optimize import leastsq
 from scipy.optimize import brent
 import scipy.interpolate
@@ -142,16 +141,17 @@ class EBV_NIR_model(model):
 
 	  return temp,etemp,mask*mask2
 
-   def get_max(self, bands, restframe=0, deredden=0):
+   def _get_max(self, bands, restframe=0, deredden=0):
 	  Tmaxs = []
 	  Mmaxs = []
 	  eMmaxs = []
 	  rbands = []
-	  self.template.mktemplate(self.dm15)
-	  for band in bands:
+	  # find where the template truly peaks:
+	  x0s = self.template_peaks([self.parent.restbands[band] for band in bands],
+			self.dm15)
+	  for i,band in enumerate(bands):
 		 rband = self.parent.restbands[band]
-		 # find where the template truly peaks:
-		 x0 = brent(lambda x: self.template.eval(rband, x, gen=self.gen)[0], brack=(0.,5.))
+		 x0 = x0s[i]
 		 Tmaxs.append(x0 + self.Tmax)
 		 mmax = self.DM + self.MMax(rband, self.calibration)
 		 if not restframe and band in self.parent.ks_tck:
@@ -354,16 +354,17 @@ class EBV_NIR_model2(model):
 
 	  return temp,etemp,mask*mask2
 
-   def get_max(self, bands, restframe=0, deredden=0):
+   def _get_max(self, bands, restframe=0, deredden=0):
 	  Tmaxs = []
 	  Mmaxs = []
 	  eMmaxs = []
 	  rbands = []
-	  self.template.mktemplate(self.parameters[self.stype])
-	  for band in bands:
+	  # find where the template truly peaks:
+	  x0s = self.template_peaks([self.parent.restbands[band] for band in bands],
+			self.parameters[self.stype])
+	  for i,band in enumerate(bands):
 		 rband = self.parent.restbands[band]
-		 # find where the template truly peaks:
-		 x0 = brent(lambda x: self.template.eval(rband, x, gen=self.gen)[0], brack=(0.,5.))
+		 x0 = x0s[i]
 		 Tmaxs.append(x0 + self.Tmax)
 		 mmax = self.DM + self.MMax(rband, self.calibration)
 		 if not restframe and band in self.parent.ks_tck:
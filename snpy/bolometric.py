@@ -15,12 +15,13 @@ There are serveral steps:
 '''
 
 from snpy.filters import fset, ch, standards
-from kcorr import get_SED
+from kcorr import get_SED,get_SEDs,SED_lims
 import kcorr
 from filters import standards
 Vega = standards['VegaB']
 from utils import deredden
-from mangle_spectrum import mangle_spectrum2
+from mangle_spectrum import mangle_spectrum2, mangle_spectra_linear
+from mangle_spectrum import default_method
 from scipy.integrate import trapz
 from scipy.interpolate import splrep,splev
 from numpy import *
@@ -208,111 +209,167 @@ def bolometric_SED(sn, bands=None, lam1=None, lam2=None, refband=None,
    ts = ts[gids]
 
    # restrict on wanted interval if necessary
+   gids = ~isnan(ts)
    if tmin is not None and tmin > ts.min():
-      gids = greater(ts, tmin)
+      gids = gids*greater(ts, tmin)
    if tmax is not None and tmax < ts.max():
-      gids = less(ts, tmax)
+      gids = gids*less(ts, tmax)
    ts = ts[gids]
+   mags = mags[gids,:]
+   masks = masks[gids,:]
 
-   # Now mangle the spectra, deredden and integrate-em
-   filters_used = []
-   boloflux = []
-   epochs = []
-   mfuncs = []
-   fluxes = []
-   waves = []
-   parss = []
-   refbands = []
-
+   # Figure out the filters and the reference filter for each epoch
    mids = []
+   bss = []
+   refids = []
    for i in range(len(ts)):
-      t = ts[i]
-      wave,flux = fSED(t/s)
-      # Check limits of integration (in rest frame of SN)
-      if min(lam1) < wave.min() or (max(lam2) > wave.max() and not extrap_red):
-         raise RuntimeError, "Error: your limits of integration (%.3f,%.3f) "\
-                             "are outside the limits of the SED (%.3f,%.3f)" %\
-                             (min(lam1),max(lam2),wave.min(), wave.max())
-
-      # integration limits
-      i1 = [searchsorted(wave, lam) for lam in lam1]
-      i2 = [searchsorted(wave, lam) for lam in lam2]
       bs = [bands[j] for j in range(masks.shape[1]) if masks[i,j]]
-
       if refband is None:
          idx = bands.index(bs[0])
-         filt = fset[bs[0]]
          if verbose:  log("   Using %s as reference filter" % bs[0])
       else:
          if refband not in bs:
             if verbose: log("Warning: refband %s has no observation or "
-                  "interpolation for epoch %f" % ts[i])
+                  "interpolation for epoch %f" % (refband, ts[i]))
             mids.append(False)
             continue 
          idx = bands.index(refband)
-         filt = fset[refband]
       mids.append(True)
-      refbands.append(filt.name)
-
-      if len(bs) == 1:
-         # No mangling possible
-         mflux = flux
-         mfunc = (flux*0+1)
-         #mfuncs.append(mfunc/mfunc.max())
+      bss.append(bs)
+      refids.append(idx)
+   mids = array(mids, dtype=bool)
+   ts = ts[mids]
+   mags = mags[mids,:]
+   masks = masks[mids,:]
+   refids = array(refids, dtype=int)
+   refbands = [bands[idx] for idx in refids]
+
+   # Get the SEDs and group together the epochs that share a wavelength
+   # grid (for the built-in templates, that's all of them). Each group is
+   # then mangled, de-reddened and integrated as a 2D array.
+   if type(SED) is type("") and SED in SED_lims:
+      # built-in templates are served as one block by the SED provider
+      w,fs,m = get_SEDs(ts, version=SED, extrapolate=True, stretch=s)
+      seds = [(w,fs[i]) for i in range(len(ts))]
+   else:
+      seds = [fSED(t/s) for t in ts]
+   groups = []
+   for i,(wave,flux) in enumerate(seds):
+      # Check limits of integration (in rest frame of SN)
+      if min(lam1) < wave.min() or (max(lam2) > wave.max() and not extrap_red):
+         raise RuntimeError, "Error: your limits of integration (%.3f,%.3f) "\
+                             "are outside the limits of the SED (%.3f,%.3f)" %\
+                             (min(lam1),max(lam2),wave.min(), wave.max())
+      for gwave,ids in groups:
+         if wave is gwave or (wave.shape == gwave.shape and \
+               alltrue(equal(wave, gwave))):
+            ids.append(i)
+            break
+      else:
+         groups.append((wave,[i]))
+
+   # Only the linear (basis spline) mangling can be done as a block
+   method = mopts.get('method', default_method)
+   linear = method == 'bspline' and mopts.get('lstsq', True)
+   bargs = dict([(key,mopts[key]) for key in mopts \
+         if key in ['k','gradient','slopes','verbose','log']])
+
+   fbols = {}
+   ws = {}
+   fs = {}
+   mfs = {}
+   pars_d = {}
+   for wave,ids in groups:
+      ids = array(ids)
+      fluxes = array([seds[i][1] for i in ids])
+      mfluxes = fluxes*1.0
+      if linear:
+         # epochs with the same set of filters share the same basis
+         bsets = {}
+         for k,i in enumerate(ids):
+            if len(bss[i]) > 1:
+               bsets.setdefault(tuple(bss[i]), []).append(k)
+         for bs,ks in bsets.items():
+            bs = list(bs)
+            jids = [bands.index(b) for b in bs]
+            mflux,state,pars = mangle_spectra_linear(wave*(1+sn.z),
+                  fluxes[ks], bs, mags[ids[ks]][:,jids], normfilter=refband,
+                  **bargs)
+            mfluxes[ks] = mflux
+            for k,p in zip(ks,pars):
+               pars_d[ids[k]] = p
       else:
-         init = [pars0.get(b, 1.0) for b in bs]
-         mflux,ave_wave,pars = mangle_spectrum2(wave*(1+sn.z), flux, bs, 
-               mags[i,masks[i]], normfilter=refband, init=init, **mopts)
-         mfunc = (mflux[0]/flux)
-         #mfuncs.append(mfunc/mfunc.max())
-         mflux = mflux[0]
-         for k,b in enumerate(bs):
-            pars0[b] = pars[k]
-         parss.append(pars)
+         for k,i in enumerate(ids):
+            bs = bss[i]
+            if len(bs) == 1:  continue
+            init = [pars0.get(b, 1.0) for b in bs]
+            mflux,state,pars = mangle_spectrum2(wave*(1+sn.z), fluxes[k], bs, 
+                  mags[i,masks[i]], normfilter=refband, init=init, **mopts)
+            mfluxes[k] = mflux[0]
+            for j,b in enumerate(bs):
+               pars0[b] = pars[j]
+            pars_d[i] = pars
+      # No mangling possible for epochs with a single filter, which leaves
+      # the mangling function at 1
+      mfuncs = mfluxes/fluxes
 
       # Scale to match photometry. We need to be careful here. The magnitude
       # measures the response of the filter to the *redshifted* spectrum
-      mag = mags[i, idx]
-      mflux = mflux*power(10, 
-            -0.4*(mag - filt.zp))/filt.response(wave, mflux/(1+sn.z), z=sn.z)
+      for idx in unique(refids[ids]):
+         filt = fset[bands[idx]]
+         sel = equal(refids[ids], idx)
+         resp = filt.responses(wave, mfluxes[sel]/(1+sn.z), z=sn.z)
+         mfluxes[sel] = mfluxes[sel]*(power(10, 
+               -0.4*(mags[ids[sel],idx] - filt.zp))/resp)[:,newaxis]
       # Note:  the quantity power()/filt.response() is actually
       # dimensionless. Therefore mflux is in erg/s/cm^2/AA
       # and *not* in photons
 
-      # Next, de-redden MW extinction and host extinction
-      mflux,a,b = deredden.unred(wave*(1+sn.z),mflux,sn.EBVgal,R_V=3.1,redlaw=redlaw)
-      mflux,a,b = deredden.unred(wave,mflux,EBVhost, R_V=Rv, redlaw=redlaw)
-
-      # Finally!  integrate!
+      # Next, de-redden MW extinction and host extinction. Same for all
+      # epochs, so compute the correction vector once.
+      unit = wave*0.0 + 1.0
+      ext = deredden.unred(wave*(1+sn.z),unit,sn.EBVgal,R_V=3.1,
+            redlaw=redlaw)[0]*deredden.unred(wave,unit,EBVhost, R_V=Rv,
+            redlaw=redlaw)[0]
+      mfluxes = mfluxes*ext[newaxis,:]
+
+      # Finally!  integrate! A cumulative trapezoidal integral turns each
+      # (lam1,lam2) window into a difference of two columns.
+      dw = (wave[1:] - wave[:-1]).astype(float64)
+      cum = zeros(mfluxes.shape)
+      cum[:,1:] = cumsum(0.5*(mfluxes[:,1:] + mfluxes[:,:-1])*dw, axis=1)
+      i1 = [searchsorted(wave, lam) for lam in lam1]
+      i2 = [searchsorted(wave, lam) for lam in lam2]
       fbol = []
-      ws = []
-      fs = []
-      mfs = []
       for j in range(len(i1)):
-         ws.append(wave[i1[j]:i2[j]])
-         fs.append(mflux[i1[j]:i2[j]])
-         mfs.append(mfunc[i1[j]:i2[j]])
-         fbol.append(trapz(mflux[i1[j]:i2[j]], x=wave[i1[j]:i2[j]]))
+         if i2[j] - i1[j] > 1:
+            fbol.append(cum[:,i2[j]-1] - cum[:,i1[j]])
+         else:
+            fbol.append(zeros(mfluxes.shape[0]))
          if lam2[j] > wave.max():
             # add Rayleigh-Jeans extrapolation (~ 1/lam^4)
-            fbol[-1] += mflux[-1]*wave[-1]/3*(1 - power(wave[-1]/lam2[j],3))
-
-      filters_used.append(bs)
-      if scalar:
-         boloflux.append(fbol[0])
-         waves.append(ws[0])
-         fluxes.append(fs[0])
-         mfuncs.append(mfs[0])
-      else:
-         boloflux.append(fbol)
-         waves.append(ws)
-         fluxes.append(fs)
-         mfuncs.append(mfs)
-      epochs.append(ts[i])
+            fbol[-1] = fbol[-1] + \
+                  mfluxes[:,-1]*wave[-1]/3*(1 - power(wave[-1]/lam2[j],3))
+      for k,i in enumerate(ids):
+         fbols[i] = [fb[k] for fb in fbol]
+         ws[i] = [wave[i1[j]:i2[j]] for j in range(len(i1))]
+         fs[i] = [mfluxes[k,i1[j]:i2[j]] for j in range(len(i1))]
+         mfs[i] = [mfuncs[k,i1[j]:i2[j]] for j in range(len(i1))]
+
+   filters_used = bss
+   parss = [pars_d[i] for i in range(len(ts)) if i in pars_d]
+   epochs = ts
+   if scalar:
+      boloflux = [fbols[i][0] for i in range(len(ts))]
+      waves = [ws[i][0] for i in range(len(ts))]
+      fluxes = [fs[i][0] for i in range(len(ts))]
+      mfuncs = [mfs[i][0] for i in range(len(ts))]
+   else:
+      boloflux = [fbols[i] for i in range(len(ts))]
+      waves = [ws[i] for i in range(len(ts))]
+      fluxes = [fs[i] for i in range(len(ts))]
+      mfuncs = [mfs[i] for i in range(len(ts))]
 
-   mids = array(mids)
-   mags = mags[mids,:]
-   masks = masks[mids, :]
    boloflux = array(boloflux)
    epochs = array(epochs)
    waves = array(waves)
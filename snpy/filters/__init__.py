@@ -27,6 +27,7 @@ import scipy.interpolate
 from glob import glob
 import string
 from snpy.utils.deredden import unred
+from snpy.utils import profiler
 
 interp_method = 'spline'
 integ_method = 'simpsons'
@@ -41,6 +42,57 @@ h = 6.626068e-27  # erg s
 c = 2.997925e18   # Angstrom/s
 ch = c * h        # erg Angstrom
 
+def integ_weights(x):
+   '''Compute the quadrature weights used by filter.response() for the
+   sampling x, i.e., the vector w such that sum(w*y) is the integral of y
+   over x using the current integ_method.  Because the integration is linear
+   in y, this lets us integrate many spectra sampled on the same wavelengths
+   with a single dot product.
+
+   Args:
+      x (float array): strictly increasing abscissae
+
+   Returns:
+      float array: the weights, same length as x
+   '''
+   x = num.asarray(x, dtype=num.float64)
+   N = x.shape[0]
+   w = num.zeros(N)
+   if N < 2:
+      return w
+   dx = x[1:] - x[:-1]
+   if integ_method == 'trapz':
+      w[:-1] += 0.5*dx
+      w[1:] += 0.5*dx
+   elif integ_method == 'simpsons':
+      def basic(start, stop, fac):
+         # the same stencil as scipy.integrate's _basic_simps
+         i0 = num.arange(start, stop, 2)
+         i0 = i0[i0+2 < N]
+         h0 = dx[i0]
+         h1 = dx[i0+1]
+         hsum = h0 + h1
+         w[i0] += fac*hsum/6.0*(2 - h1/h0)
+         w[i0+1] += fac*hsum/6.0*hsum*hsum/(h0*h1)
+         w[i0+2] += fac*hsum/6.0*(2 - h0/h1)
+      if N % 2 == 0:
+         # even='avg':  average of simpsons + trapezoid at either end
+         basic(0, N-3, 0.5)
+         w[-1] += 0.25*dx[-1]
+         w[-2] += 0.25*dx[-1]
+         basic(1, N-2, 0.5)
+         w[0] += 0.25*dx[0]
+         w[1] += 0.25*dx[0]
+      elif N > 2:
+         basic(0, N-2, 1.0)
+   else:
+      w[:] = (x[-1] - x[0])/(N-1)
+   return w
+
+def _wave_key(wave):
+   '''A hashable key identifying a wavelength grid.'''
+   return (wave.shape[0], wave.dtype.str, hash(wave.tostring()))
+
 class spectrum:
    '''This class defines a spectrum.  It contains the response as Numeric arrays.  It has
    the following member data:
@@ -136,16 +188,35 @@ class filter(spectrum):
       R(Rv, z=0, strict_ccm=0): Compute the filters' Reddening coefficient for 
                                 assumed value of Rv and redshift z.'''
 
-   def __init__(self, name, file=None, zp=None, comment=None):
+   def __init__(self, name, file=None, zp=None, comment=None, standard=None):
       '''Creates a filter instance.  Required parameters:  name and file.  Can also
-      specify the zero point (instead of using the comptute_zpt() function do do it).'''
-      spectrum.__init__(self, name, file)
-      self.zp = zp
+      specify the zero point (instead of using the comptute_zpt() function do do it).
+      Alternatively, give a standard as (spectrum, mag) or 'AB' and the zero
+      point is computed when first needed.  The response is read from file
+      when first needed.'''
+      spectrum.__init__(self, name, file, load=0)
+      if standard is None:
+         self.zp = zp
+      else:
+         self._zp_standard = standard
       self.comment = comment
-      self.read()
       self.tck = None     # Used for interpolating the filter response
       self.mint = None    #    "
 
+   def __getattr__(self, name):
+      if name == 'zp' and '_zp_standard' in self.__dict__:
+         standard = self.__dict__.pop('_zp_standard')
+         if standard == 'AB':
+            # We have an AB system, so in principle there is no standard. The
+            # zero-point is derived from the filter function alone. See
+            # documentation.
+            self.zp = 16.84692 + 2.5*num.log10(
+                  scipy.integrate.trapz(self.resp/self.wave, x=self.wave))
+         else:
+            self.zp = self.compute_zpt(standard[0], standard[1])
+         return self.zp
+      return spectrum.__getattr__(self, name)
+
    def read(self):
       '''Reads in the response for file and updates several member functions.'''
       spectrum.read(self)
@@ -197,6 +268,46 @@ class filter(spectrum):
                   fresp_int)
       return(fresp_int)
 
+   def _resample(self, swave):
+      '''Find the portion of the wavelength vector [swave] that overlaps
+      the filter (padded by 5 elements) and resample the filter response
+      onto it.  Returns (i_min, i_max, trim_wave, fresp_int).'''
+      # Now figure out the limits of the integration:
+      x_min = num.minimum.reduce(self.wave)
+      x_max = num.maximum.reduce(self.wave)
+      try:
+         i_min = num.nonzero(num.greater(swave - x_min, 0))[0][0]
+      except:
+         i_min = 0
+      try:
+         i_max = num.nonzero(num.greater(swave - x_max, 0))[0][0]
+      except:
+         i_max = len(swave)-1
+   
+      if i_min >= 5:
+         i_min -= 5
+      else:
+         i_min = 0
+      if i_max <= len(swave)-6:
+         i_max += 5
+      else:
+         i_max = len(swave) - 1
+      trim_wave = swave[i_min:i_max+1:subsample]
+      # Now, we need to resample the response wavelengths to the spectrum:
+      if interp_method == "spline":
+         if self.tck is None:
+            self.tck = scipy.interpolate.splrep(self.wave, self.resp, k=1, s=0)
+         fresp_int = scipy.interpolate.splev(trim_wave, self.tck)
+      else:
+         if self.mint is None:
+            self.mint = scipy.interpolate.interp1d(self.wave, self.resp, 
+                  kind=interp_method)
+         fresp_int = self.mint(trim_wave)
+      # Zero out any places beyond the definition of the filter:
+      fresp_int = num.where(num.less(trim_wave, x_min), 0, fresp_int)
+      fresp_int = num.where(num.greater(trim_wave, x_max), 0, fresp_int)
+      return(i_min, i_max, trim_wave, fresp_int)
+
    def response(self, specwave, flux=None, z=0, zeropad=0, photons=1):
       '''Get the response of this filter over the specified spectrum.  This
       spectrum can be defined as a spectrum instance, in which case you simply
@@ -209,6 +320,7 @@ class filter(spectrum):
       spectrum's definition.  If photons=1, the integrand is multiplied by the
       wavelength vector and divided by c*h, i.e., the photon flux is
       computed..'''
+      profiler.count('filter.response')
 
       # Handle the intput parameters
       if flux is None:
@@ -237,42 +349,8 @@ class filter(spectrum):
       if (self.wavemin < swave[0] or self.wavemax > swave[-1]) and not zeropad:
             return(-1.0)
 
-      # Now figure out the limits of the integration:
-      x_min = num.minimum.reduce(self.wave)
-      x_max = num.maximum.reduce(self.wave)
-      try:
-         i_min = num.nonzero(num.greater(swave - x_min, 0))[0][0]
-      except:
-         i_min = 0
-      try:
-         i_max = num.nonzero(num.greater(swave - x_max, 0))[0][0]
-      except:
-         i_max = len(swave)-1
-   
-      if i_min >= 5:
-         i_min -= 5
-      else:
-         i_min = 0
-      if i_max <= len(swave)-6:
-         i_max += 5
-      else:
-         i_max = len(swave) - 1
-
+      i_min,i_max,trim_wave,fresp_int = self._resample(swave)
       trim_spec = spec[i_min:i_max+1:subsample]
-      trim_wave = swave[i_min:i_max+1:subsample]
-      # Now, we need to resample the response wavelengths to the spectrum:
-      if interp_method == "spline":
-         if self.tck is None:
-            self.tck = scipy.interpolate.splrep(self.wave, self.resp, k=1, s=0)
-         fresp_int = scipy.interpolate.splev(trim_wave, self.tck)
-      else:
-         if self.mint is None:
-            self.mint = scipy.interpolate.interp1d(self.wave, self.resp, 
-                  kind=interp_method)
-         fresp_int = self.mint(trim_wave)
-      # Zero out any places beyond the definition of the filter:
-      fresp_int = num.where(num.less(trim_wave, x_min), 0, fresp_int)
-      fresp_int = num.where(num.greater(trim_wave, x_max), 0, fresp_int)
 
       integrand = fresp_int*trim_spec
       if photons:
@@ -287,6 +365,62 @@ class filter(spectrum):
 
       return(result)
 
+   def response_weights(self, specwave, z=0, zeropad=0, photons=1):
+      '''Get the vector of weights w such that
+      self.response(specwave, flux, z, zeropad, photons) is equal to
+      dot(w, flux) for any flux sampled at [specwave].  The weights are
+      cached for each wavelength grid, so spectra that share the same
+      wavelengths (like the SED templates in kcorr) only pay for the
+      interpolation and integration setup once.  Returns None if the
+      spectrum does not cover the filter (and zeropad is false).'''
+      wave = num.asarray(specwave)
+      key = (_wave_key(wave), z, zeropad, photons, interp_method,
+             integ_method, subsample)
+      cache = getattr(self, '_wcache', None)
+      if cache is None:
+         cache = self._wcache = {}
+      if key in cache:
+         return cache[key]
+
+      if z > 0:
+         swave = wave*(1.+z)
+      elif z < 0:
+         swave = wave/(1.+z)
+      else:
+         swave = wave
+      if (self.wavemin < swave[0] or self.wavemax > swave[-1]) and not zeropad:
+         w = None
+      else:
+         i_min,i_max,trim_wave,fresp_int = self._resample(swave)
+         coef = fresp_int*integ_weights(trim_wave)
+         if photons:
+            coef = coef*trim_wave/ch
+         w = num.zeros(wave.shape[0])
+         w[i_min:i_max+1:subsample] = coef
+
+      # keep the memory bounded
+      if len(cache) > 50:  cache.clear()
+      cache[key] = w
+      return w
+
+   def responses(self, specwave, fluxes, z=0, zeropad=0, photons=1):
+      '''Same as response(), but for a 2D array of fluxes [fluxes], indexed
+      by [spectrum,wavelength], all sampled at the same wavelengths
+      [specwave]. Returns an array of responses (-1 if the spectrum does not
+      cover the filter and zeropad is false).'''
+      fluxes = num.asarray(fluxes)
+      profiler.count('filter.response', fluxes.size//fluxes.shape[-1])
+      w = self.response_weights(specwave, z=z, zeropad=zeropad, photons=photons)
+      if w is None:
+         return num.zeros(fluxes.shape[:-1]) - 1.0
+      return num.dot(fluxes, w)
+
+   def __getstate__(self):
+      # Don't pickle the cache of integration weights
+      state = self.__dict__.copy()
+      state.pop('_wcache', None)
+      return state
+
    def ABoff(self):
       '''Compute the AB offset for this filter. Due to the way SNooPy stores
       the zero-points, this only depends on filter function shape.'''
@@ -700,8 +834,8 @@ for obs in obsdirs:
                   raise ValueError, \
                         "Could not convert standard magnitude for filter %s" %\
                         l[0]
-               newf = filter(l[0], os.path.join(dir,l[1]), 0.0, string.join(l[3:]))
-               newf.zp = newf.compute_zpt(standards[std], m)
+               newf = filter(l[0], os.path.join(dir,l[1]), None,
+                     string.join(l[3:]), standard=(standards[std], m))
                fset.observatories[obs_name].telescopes[tel_name].add_filter(newf)
             else:
                raise ValueError, \
@@ -709,12 +843,9 @@ for obs in obsdirs:
 
 
          elif l[2] == 'AB':
-            # We have an AB system, so in principle there is no standard. The
-            # zero-point is derived from the filter function alone. See
-            # documentation.
-            newf = filter(l[0], os.path.join(dir,l[1]), 0.0, string.join(l[3:]))
-            newf.zp = 16.84692 + 2.5*num.log10(
-                  scipy.integrate.trapz(newf.resp/newf.wave, x=newf.wave))
+            # AB system: the zero-point depends on the filter function alone
+            newf = filter(l[0], os.path.join(dir,l[1]), None,
+                  string.join(l[3:]), standard='AB')
             fset.observatories[obs_name].telescopes[tel_name].add_filter(newf)
          else:
             fset.observatories[obs_name].telescopes[tel_name].add_filter(
@@ -0,0 +1,273 @@
+'''A module for storing the results of light-curve fits in an SQLite
+database, so that samples of thousands of objects can be queried without
+un-pickling every .snpy file.
+
+Each call to :meth:`FitStore.add` records one fit of one SN: the parameters,
+their statistical and systematic errors, the covariance matrix, the
+chi-square, the options used in the fit and the versions of the code, SED
+and filters::
+
+   >>> from snpy import fitstore
+   >>> db = fitstore.FitStore('fits.db')
+   >>> s.fit(store=db)            # or db.add(s) after any fit
+   >>> res = db.query(['Tmax','st','EBVhost','DM'], model='EBV_NIR_model2')
+   >>> res['st'], res['e_st'], res['name']
+
+Queries return a dictionary of numpy arrays, one element per fit.
+'''
+import os
+import time
+import json
+import sqlite3
+import hashlib
+import numpy as num
+from version import __version__
+from filters import fset
+
+schema = [
+   '''CREATE TABLE IF NOT EXISTS fits (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      name TEXT NOT NULL,
+      model TEXT,
+      z REAL,
+      zcmb REAL,
+      EBVgal REAL,
+      chisquare REAL,
+      dof INTEGER,
+      rchisquare REAL,
+      bands TEXT,
+      options TEXT,
+      snpy_version TEXT,
+      k_version TEXT,
+      template TEXT,
+      filters_hash TEXT,
+      created REAL)''',
+   '''CREATE TABLE IF NOT EXISTS params (
+      fit_id INTEGER NOT NULL REFERENCES fits(id) ON DELETE CASCADE,
+      param TEXT NOT NULL,
+      value REAL,
+      error REAL,
+      sys REAL,
+      PRIMARY KEY (param, fit_id))''',
+   '''CREATE TABLE IF NOT EXISTS covar (
+      fit_id INTEGER NOT NULL REFERENCES fits(id) ON DELETE CASCADE,
+      p1 TEXT NOT NULL,
+      p2 TEXT NOT NULL,
+      value REAL,
+      PRIMARY KEY (fit_id, p1, p2))''',
+   '''CREATE INDEX IF NOT EXISTS fits_name ON fits (name, id)''',
+   '''CREATE INDEX IF NOT EXISTS fits_model ON fits (model, id)''',
+   '''CREATE INDEX IF NOT EXISTS params_fit ON params (fit_id)''']
+
+# The columns of the fits table that can be asked for in a query
+fit_columns = ['id','name','model','z','zcmb','EBVgal','chisquare','dof',
+               'rchisquare','bands','snpy_version','k_version','template',
+               'filters_hash','created']
+
+def filters_hash(bands):
+   '''A hash of the filter response functions of [bands], so that fits done
+   with different filter definitions can be told apart.'''
+   h = hashlib.md5()
+   for b in sorted(bands):
+      f = fset[b]
+      h.update(b)
+      h.update(num.asarray(f.wave, dtype=num.float64).tostring())
+      h.update(num.asarray(f.resp, dtype=num.float64).tostring())
+   return h.hexdigest()
+
+def _float(value):
+   if value is None:  return None
+   try:
+      return float(value)
+   except (TypeError, ValueError):
+      return None
+
+class FitStore:
+   '''An SQLite database of fit results.
+
+   Args:
+      filename (str): the database file (created if it does not exist).
+                      Use ':memory:' for a temporary in-memory store.
+      timeout (float): seconds to wait for a lock when several processes
+                       write to the same file.
+   '''
+
+   def __init__(self, filename, timeout=30.0):
+      self.filename = filename
+      self.con = sqlite3.connect(filename, timeout=timeout)
+      self.con.execute('PRAGMA foreign_keys = ON')
+      for stmt in schema:
+         self.con.execute(stmt)
+      self.con.commit()
+
+   def close(self):
+      '''Close the database.'''
+      self.con.close()
+
+   def add(self, sn, systematics=False, options=None, **sargs):
+      '''Record the current fit of [sn] in the store.
+
+      Args:
+         sn (sn instance): a SN object that has been fit.
+         systematics (bool): If True, compute and store the systematic
+                             errors (see sn.systematics()).
+         options (dict): the options used in the fit (stored as JSON).
+         sargs (dict): extra arguments sent to sn.systematics().
+
+      Returns:
+         int: the ID of the new fit.
+      '''
+      model = getattr(sn, 'model', None)
+      if model is None or getattr(model, 'C', None) is None:
+         raise ValueError, "SN %s has not been fit" % sn.name
+      bands = list(getattr(model, '_fbands', []))
+      systs = {}
+      if systematics:
+         try:
+            systs = sn.systematics(**sargs)
+         except NotImplementedError:
+            systs = {}
+      try:
+         zcmb = sn.get_zcmb()
+      except:
+         zcmb = None
+      template = model.__class__.__name__
+      tmpl = getattr(model, 'template', None)
+      if tmpl is not None:
+         template += ':%s.%s' % (tmpl.__class__.__module__,
+                                 tmpl.__class__.__name__)
+      if getattr(model, 'gen', None) is not None:
+         template += ':gen%s' % model.gen
+      if options is None:  options = {}
+      opts = dict(options)
+      opts.setdefault('fixed', dict([(p,model.parameters[p]) \
+            for p in model.fixed]))
+      opts.setdefault('args', dict([(k,v) for k,v in model.args.items() \
+            if type(v) in [int,float,str,bool]]))
+
+      c = self.con.cursor()
+      c.execute('''INSERT INTO fits (name,model,z,zcmb,EBVgal,chisquare,dof,
+            rchisquare,bands,options,snpy_version,k_version,template,
+            filters_hash,created) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)''',
+            (sn.name, model.__class__.__name__, _float(sn.z), _float(zcmb),
+             _float(sn.EBVgal), _float(getattr(model, 'chisquare', None)),
+             getattr(model, 'dof', None),
+             _float(getattr(model, 'rchisquare', None)), ','.join(bands),
+             json.dumps(opts, sort_keys=True, default=str), __version__,
+             getattr(sn, 'k_version', None), template, filters_hash(bands),
+             time.time()))
+      fit_id = c.lastrowid
+      c.executemany('''INSERT INTO params (fit_id,param,value,error,sys)
+            VALUES (?,?,?,?,?)''',
+            [(fit_id, p, _float(model.parameters[p]),
+              _float(model.errors.get(p, None)), _float(systs.get(p, None))) \
+             for p in model.parameters])
+      c.executemany('''INSERT INTO covar (fit_id,p1,p2,value)
+            VALUES (?,?,?,?)''',
+            [(fit_id, p1, p2, _float(model.C[p1][p2])) \
+             for p1 in model.C for p2 in model.C[p1]])
+      self.con.commit()
+      return fit_id
+
+   def _where(self, name, model, latest, where):
+      conds = []
+      args = []
+      if name is not None:
+         if type(name) in [list,tuple]:
+            conds.append('f.name IN (%s)' % ','.join(['?']*len(name)))
+            args += list(name)
+         else:
+            conds.append('f.name = ?')
+            args.append(name)
+      if model is not None:
+         conds.append('f.model = ?')
+         args.append(model)
+      if latest:
+         sub = 'SELECT MAX(id) FROM fits'
+         if model is not None:
+            sub += ' WHERE model = ?'
+            args.append(model)
+         conds.append('f.id IN (%s GROUP BY name)' % sub)
+      if where is not None:
+         conds.append('(%s)' % where)
+      if not conds:  return '',args
+      return ' WHERE ' + ' AND '.join(conds),args
+
+   def query(self, params=None, name=None, model=None, latest=True,
+         where=None, columns=['name']):
+      '''Query the store for fitted parameters.
+
+      Args:
+         params (list of str): parameters to retrieve. If None, all the
+                               parameters in the store.
+         name (str or list): restrict to these SNe.
+         model (str): restrict to fits with this model.
+         latest (bool): If True, only the latest fit for each SN (and model,
+                        if given) is returned.
+         where (str): extra SQL condition on the fits table (aliased as f),
+                      e.g., "f.rchisquare < 2".
+         columns (list of str): columns of the fits table to return.
+
+      Returns:
+         dict: numpy arrays, one element per fit, keyed by column name and,
+               for each parameter p, p, 'e_'+p and 'sys_'+p. Parameters that
+               are missing for a fit are NaN.
+      '''
+      if params is None:
+         params = [r[0] for r in \
+               self.con.execute('SELECT DISTINCT param FROM params')]
+      for col in columns:
+         if col not in fit_columns:
+            raise ValueError, "Unknown column %s" % col
+      sel = ['f.id'] + ['f.%s' % col for col in columns if col != 'id']
+      joins = []
+      jargs = []
+      for i,p in enumerate(params):
+         sel += ['p%d.value' % i, 'p%d.error' % i, 'p%d.sys' % i]
+         joins.append('LEFT JOIN params p%d ON p%d.fit_id = f.id AND '\
+               'p%d.param = ?' % (i,i,i))
+         jargs.append(p)
+      whr,wargs = self._where(name, model, latest, where)
+      sql = 'SELECT %s FROM fits f %s%s ORDER BY f.id' % \
+            (','.join(sel), ' '.join(joins), whr)
+      rows = self.con.execute(sql, jargs + wargs).fetchall()
+
+      res = {}
+      ncol = len(sel) - 3*len(params)
+      cols = ['id'] + [col for col in columns if col != 'id']
+      for j,col in enumerate(cols):
+         res[col] = num.array([r[j] for r in rows])
+      for i,p in enumerate(params):
+         for k,key in enumerate([p, 'e_'+p, 'sys_'+p]):
+            res[key] = num.array([r[ncol+3*i+k] for r in rows],
+                  dtype=num.float64)
+      return res
+
+   def get_covar(self, fit_id):
+      '''Return the covariance matrix of fit [fit_id] as (params, C), where
+      C[i,j] is the covariance of params[i] and params[j].'''
+      rows = self.con.execute('SELECT p1,p2,value FROM covar WHERE '\
+            'fit_id = ?', (fit_id,)).fetchall()
+      params = sorted(set([r[0] for r in rows]))
+      C = num.zeros((len(params),len(params)))
+      for p1,p2,value in rows:
+         C[params.index(p1),params.index(p2)] = value
+      return params,C
+
+   def get_options(self, fit_id):
+      '''Return the fit options of fit [fit_id] as a dictionary.'''
+      row = self.con.execute('SELECT options FROM fits WHERE id = ?',
+            (fit_id,)).fetchone()
+      if row is None:
+         raise ValueError, "No fit with id %d" % fit_id
+      return json.loads(row[0])
+
+   def names(self):
+      '''List of SN names in the store.'''
+      return [r[0] for r in \
+            self.con.execute('SELECT DISTINCT name FROM fits ORDER BY name')]
+
+   def delete(self, name):
+      '''Delete all the fits of SN [name].'''
+      self.con.execute('DELETE FROM fits WHERE name = ?', (name,))
+      self.con.commit()
@@ -0,0 +1,341 @@
+'''A module for fitting many SNe at once with shared (hyper-)parameters,
+rather than fitting the sample-level quantities to the outputs of individual
+fits (which throws away the covariances of each fit).
+
+The models must be calibrated with a table (see model.read_table(), e.g.,
+EBV_model2 or EBV_NIR_model2). The peak absolute magnitude of SN i in
+rest-frame filter f is then
+
+   MMax = a_f + b_f*delta + c_f*delta**2 + offset_if
+
+where delta is the decline-rate (or stretch) parameter and offset_if is
+a latent offset with a Gaussian prior of width sigma_f (the intrinsic
+dispersion). The a_f, b_f, c_f and R_V of the host are shared by all the SNe
+and can be fit along with the free parameters of each SN and the offsets.
+The distance moduli of SNe with independent distances can be held fixed,
+which is needed to fit the zero-points a_f::
+
+   >>> from snpy import jointfit
+   >>> for s in sne:  s.fit(['B','V','r','i'])
+   >>> jf = jointfit.JointFit(sne, DM={'SN2006ax':34.2}, hyper=['a','b','Rv'],
+   ...                        priors={'a_B':(-19.3,0.02)})
+   >>> jf.fit(processes=8, fit_sigma=True)
+   >>> jf.hyper['a_B'], jf.ehyper['a_B'], jf.sigma['B']
+   >>> jf.results['SN2006ax']['parameters']
+
+The residuals are those of each SN's model (model._wrap_model()) and the
+priors on the offsets, so each SN only depends on its own parameters and
+the shared ones: the Jacobian is sparse and is computed block by block
+(optionally in several processes), which keeps the cost linear in the number
+of SNe. The covariance matrix of the shared parameters is found the same way
+(a Schur complement over the blocks of the SNe).
+
+The SN objects are left as they were: the results are in the JointFit
+instance.
+'''
+import numpy as num
+from scipy.optimize import least_squares
+from scipy import sparse
+import kcorr
+from snpy.utils import pmap
+
+# The workers get the JointFit instance being fit through pmap.get_state()
+def _joint_residuals(job):
+   ids,x,sigma = job
+   return [pmap.get_state()._residuals(i, x, sigma) for i in ids]
+
+def _joint_jacobian(job):
+   ids,x,sigma = job
+   return [pmap.get_state()._jacobian(i, x, sigma) for i in ids]
+
+class JointFit:
+   '''A joint fit of the SN objects [sne]. Each SN must have been fit with
+   a model calibrated with a table; its free parameters are those of the
+   last fit.
+
+   Args:
+      sne (list of sn instances): the SNe
+      DM (dict): distance moduli, keyed by SN name, of the SNe whose
+                 distances are known. These are held fixed.
+      hyper (list of str): the shared parameters to fit: any of 'a','b','c'
+                           (the calibration in each rest-frame filter) and
+                           'Rv' (of the host). The others are held at the
+                           values of the calibration.
+      sigma (dict): the intrinsic dispersion in each rest-frame filter
+                    (default: the sigSN of the calibration).
+      priors (dict): Gaussian priors (mean,std) on the shared parameters,
+                     keyed by name (e.g., 'a_B', 'Rv'). Note that the
+                     zero-points are degenerate with the host extinction
+                     of all the SNe, so one of them needs a prior.
+      Rvs (float array): values of R_V at which R_obs is computed for each
+                         filter (and interpolated during the fit).
+   '''
+
+   def __init__(self, sne, DM=None, hyper=['a','b','Rv'], sigma=None,
+         priors=None, Rvs=num.linspace(1.0, 5.0, 17)):
+      self.sne = list(sne)
+      if DM is None:  DM = {}
+      self.DM = DM
+      for h in hyper:
+         if h not in ['a','b','c','Rv']:
+            raise ValueError, "Unknown shared parameter %s" % h
+      self.Rvs = num.asarray(Rvs, dtype=float)
+      if 'a' in hyper and not [s for s in self.sne if s.name in DM]:
+         raise ValueError, "To fit the zero-points (a), the distances of "\
+               "some SNe must be given"
+
+      self.hnames = []          # names of the shared parameters
+      x0 = []
+      sigma0 = {}
+      self.blocks = []
+      self._saved = []
+      for s in self.sne:
+         m = s.model
+         for att in ['a','b','c','Rv_host','sigSN']:
+            if att not in m.__dict__:
+               raise ValueError, "The model of %s is not calibrated with "\
+                     "a table" % s.name
+         if not m._fbands or 'C' not in m.__dict__:
+            raise ValueError, "SN %s has not been fit" % s.name
+         cal = getattr(m, 'calibration', 0)
+         bands = list(m._fbands)
+         rbands = sorted(set([s.restbands[b] for b in bands]))
+         hcols = []
+         for rb in rbands:
+            for h in ['a','b','c']:
+               name = '%s_%s' % (h,rb)
+               if h in hyper:
+                  if name not in self.hnames:
+                     self.hnames.append(name)
+                     x0.append(getattr(m, h)[cal][rb])
+                  hcols.append(name)
+            if rb not in sigma0:
+               sigma0[rb] = m.sigSN[cal][rb]
+         Rtab = {}
+         if 'Rv' in hyper:
+            if 'Rv' not in self.hnames:
+               self.hnames.append('Rv')
+               x0.append(m.Rv_host[cal])
+            hcols.append('Rv')
+            for b in bands:
+               Rtab[b] = num.array([kcorr.R_obs(b, s.z, 0, 0.01, 0, Rv,
+                  s.Rv_gal, s.k_version, redlaw=s.redlaw) for Rv in self.Rvs])
+         free = [p for p in m._free if not (p == 'DM' and s.name in DM)]
+         error = {}
+         for b in bands:
+            error[b] = s.data[b].get_covar(flux=1)
+         self.blocks.append({'cal':cal, 'bands':bands, 'rbands':rbands,
+            'hcols':hcols, 'free':free, 'error':error, 'Rtab':Rtab,
+            'start':[m.parameters[p] for p in free]})
+         self._saved.append({'parameters':m.parameters.copy(),
+            '_free':m._free, 'a':m.a[cal].copy(), 'b':m.b[cal].copy(),
+            'c':m.c[cal].copy(), 'Rv_host':m.Rv_host[cal],
+            'Robs':m.Robs.copy()})
+      # Now lay out the parameter vector: shared parameters first, then
+      # each SN's parameters and offsets
+      self.nh = len(self.hnames)
+      self.hindex = dict([(h,i) for i,h in enumerate(self.hnames)])
+      for blk in self.blocks:
+         blk['hcols'] = [self.hindex[h] for h in blk['hcols']]
+         n0 = len(x0)
+         blk['pids'] = range(n0, n0 + len(blk['free']))
+         blk['dids'] = range(n0 + len(blk['free']),
+               n0 + len(blk['free']) + len(blk['rbands']))
+         x0 += blk['start'] + [0.0]*len(blk['rbands'])
+      self.x = num.array(x0, dtype=float)
+      self.sigma = sigma0
+      if sigma is not None:
+         self.sigma.update(sigma)
+      if priors is None:  priors = {}
+      for h in priors:
+         if h not in self.hindex:
+            raise ValueError, "%s is not a shared parameter of the fit" % h
+      self.priors = priors
+      self._pids = [self.hindex[h] for h in sorted(priors)]
+      self._pmu = num.array([priors[h][0] for h in sorted(priors)])
+      self._psig = num.array([priors[h][1] for h in sorted(priors)])
+      self._pool = None
+
+   def _apply(self, i, x):
+      '''Set up the model of SN [i] for the parameter vector [x].'''
+      s = self.sne[i]
+      m = s.model
+      blk = self.blocks[i]
+      saved = self._saved[i]
+      cal = blk['cal']
+      h = self.hindex
+      for k,rb in enumerate(blk['rbands']):
+         for att in ['a','b','c']:
+            name = '%s_%s' % (att,rb)
+            if name in h:
+               getattr(m, att)[cal][rb] = x[h[name]]
+            else:
+               getattr(m, att)[cal][rb] = saved[att][rb]
+         m.a[cal][rb] += x[blk['dids'][k]]
+      if 'Rv' in h:
+         Rv = x[h['Rv']]
+         m.Rv_host[cal] = Rv
+         for b in blk['bands']:
+            m.Robs[b] = num.interp(Rv, self.Rvs, blk['Rtab'][b])
+      if s.name in self.DM:
+         m.parameters['DM'] = self.DM[s.name]
+      m._free = blk['free']
+
+   def _residuals(self, i, x, sigma):
+      '''The residuals of SN [i]: its model's and the offsets' priors.'''
+      blk = self.blocks[i]
+      self._apply(i, x)
+      r = self.sne[i].model._wrap_model(x[blk['pids']], blk['bands'],
+            blk['error'])
+      sig = num.array([sigma[rb] for rb in blk['rbands']])
+      return num.concatenate([r, x[blk['dids']]/sig])
+
+   def _jacobian(self, i, x, sigma):
+      '''The (dense) block of the Jacobian for SN [i], by forward
+      differences. Returns the block and its columns.'''
+      blk = self.blocks[i]
+      cols = blk['hcols'] + blk['pids'] + blk['dids']
+      r0 = self._residuals(i, x, sigma)
+      J = num.zeros((len(r0), len(cols)))
+      for k,j in enumerate(cols):
+         xp = x.copy()
+         dx = 1e-6*max(abs(x[j]), 1.0)
+         xp[j] += dx
+         J[:,k] = (self._residuals(i, xp, sigma) - r0)/dx
+      return J,cols
+
+   def _map(self, func, x):
+      '''Evaluate [func] (_joint_residuals or _joint_jacobian) for all the
+      SNe, in the worker processes if there are any.'''
+      N = len(self.sne)
+      if self._nproc > 1:
+         chunks = num.array_split(num.arange(N), min(N, 4*self._nproc))
+         jobs = [(list(c), x, self.sigma) for c in chunks if len(c)]
+         res = self._pool.map(func, jobs, chunksize=1)
+         return [r for chunk in res for r in chunk]
+      return self._pool.map(func, [(range(N), x, self.sigma)])[0]
+
+   def _fun(self, x):
+      return num.concatenate(self._map(_joint_residuals, x) +
+            [(x[self._pids] - self._pmu)/self._psig])
+
+   def _jac(self, x):
+      rows = []; cols = []; vals = []
+      n0 = 0
+      for J,c in self._map(_joint_jacobian, x):
+         nr,nc = J.shape
+         rows.append(num.repeat(num.arange(n0, n0 + nr), nc))
+         cols.append(num.tile(c, nr))
+         vals.append(J.ravel())
+         n0 += nr
+      # the priors on the shared parameters
+      rows.append(num.arange(n0, n0 + len(self._pids)))
+      cols.append(num.array(self._pids, dtype=int))
+      vals.append(1.0/self._psig)
+      n0 += len(self._pids)
+      return sparse.csr_matrix((num.concatenate(vals),
+         (num.concatenate(rows), num.concatenate(cols))),
+         shape=(n0, len(x)))
+
+   def fit(self, processes=1, fit_sigma=False, niter=10, tol=1e-3, **args):
+      '''Do the joint fit. The results are stored in self.hyper, self.ehyper
+      and self.C (the shared parameters), self.sigma (the intrinsic
+      dispersions) and self.results (keyed by SN name).
+
+      Args:
+         processes (int): number of worker processes
+         fit_sigma (bool): If True, also solve for the intrinsic dispersion
+                           in each filter. The dispersions are updated from
+                           the offsets and their errors after each fit
+                           (an EM iteration), until they change by less
+                           than a fraction [tol] or after [niter] fits.
+         args (dict): extra arguments passed to scipy.optimize.least_squares
+
+      Returns:
+         scipy.optimize.OptimizeResult: the output of the (last) fit.
+      '''
+      self._nproc = processes
+      self._pool = pmap.WorkerPool(processes, self)
+      try:
+         for it in range(fit_sigma and niter or 1):
+            res = least_squares(self._fun, self.x, jac=self._jac,
+                  method='trf', tr_solver='lsmr', x_scale='jac', **args)
+            self.x = res.x
+            self._solution(res)
+            if not fit_sigma:  break
+            change = 0
+            for rb in self.sigma:
+               d2 = [self.results[s.name]['offsets'][rb]**2 + \
+                     self.results[s.name]['e_offsets'][rb]**2 \
+                     for s in self.sne if rb in self.results[s.name]['offsets']]
+               sig = num.sqrt(num.mean(d2))
+               change = max(change, abs(sig/self.sigma[rb] - 1))
+               self.sigma[rb] = sig
+            if change < tol:  break
+      finally:
+         self._pool.close()
+         self._pool = None
+         self.restore()
+      return res
+
+   def _solution(self, res):
+      '''Store the solution and covariances of the fit [res]. The covariance
+      matrix of the shared parameters is the inverse of the Schur complement
+      of the SNe's blocks of J^T J.'''
+      x = res.x
+      J = sparse.csr_matrix(res.jac)
+      JTJ = (J.T*J).tocsr()
+      nh = self.nh
+      A = JTJ[:nh,:nh].toarray()
+      S = A.copy()
+      Bs = JTJ[:nh,:].toarray()
+      blocks = []
+      for blk in self.blocks:
+         c = blk['pids'] + blk['dids']
+         c0,c1 = c[0],c[-1] + 1      # contiguous
+         Dinv = num.linalg.inv(JTJ[c0:c1,c0:c1].toarray())
+         B = Bs[:,c0:c1]
+         S -= num.dot(B, num.dot(Dinv, B.T))
+         blocks.append((Dinv,B))
+      Ch = num.linalg.inv(S) if nh > 0 else num.zeros((0,0))
+      self.chisquare = num.sum(res.fun**2)
+      self.dof = len(res.fun) - len(x)
+      self.rchisquare = self.chisquare/max(self.dof, 1)
+      self.hyper = dict([(h, x[i]) for i,h in enumerate(self.hnames)])
+      self.ehyper = dict([(h, num.sqrt(Ch[i,i])) \
+            for i,h in enumerate(self.hnames)])
+      self.C = {}
+      for i,h in enumerate(self.hnames):
+         self.C[h] = dict([(h2, Ch[i,j]) for j,h2 in enumerate(self.hnames)])
+      self.results = {}
+      for s,blk,(Dinv,B) in zip(self.sne, self.blocks, blocks):
+         DB = num.dot(Dinv, B.T)
+         C = Dinv + num.dot(DB, num.dot(Ch, DB.T))
+         n = len(blk['free'])
+         r = {'parameters':{}, 'errors':{}, 'C':{}, 'offsets':{},
+              'e_offsets':{}}
+         for k,p in enumerate(blk['free']):
+            r['parameters'][p] = x[blk['pids'][k]]
+            r['errors'][p] = num.sqrt(C[k,k])
+            r['C'][p] = dict([(p2, C[k,l]) \
+                  for l,p2 in enumerate(blk['free'])])
+         for k,rb in enumerate(blk['rbands']):
+            r['offsets'][rb] = x[blk['dids'][k]]
+            r['e_offsets'][rb] = num.sqrt(C[n+k,n+k])
+         if s.name in self.DM:
+            r['parameters']['DM'] = self.DM[s.name]
+            r['errors']['DM'] = 0.0
+         self.results[s.name] = r
+
+   def restore(self):
+      '''Put the models of the SNe back in their state before the fit.'''
+      for s,blk,saved in zip(self.sne, self.blocks, self._saved):
+         m = s.model
+         cal = blk['cal']
+         m.parameters.update(saved['parameters'])
+         m._free = saved['_free']
+         for att in ['a','b','c']:
+            getattr(m, att)[cal].update(saved[att])
+         m.Rv_host[cal] = saved['Rv_host']
+         m.Robs.clear()
+         m.Robs.update(saved['Robs'])
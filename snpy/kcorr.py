@@ -11,17 +11,8 @@ been moved to the :mod:`snpy.filter` module.
 import os,sys,string,re
 import numpy as num
 import scipy.interpolate
+from collections import OrderedDict
 from utils import deredden
-try:
-   from astropy.io import fits as pyfits
-except ImportError:
-   try:
-      import pyfits
-   except ImportError:
-      sys.stderr.write('Error:  You need pyfits to run snpy.  You can get it\n')
-      sys.stderr.write('        from:  http://www.stsci.edu/resources/'+\
-                       'software_hardware/pyfits/\n')
-      raise ImportError
 import filters
 from mangle_spectrum import mangle_spectrum2, default_method
 
@@ -39,33 +30,26 @@ ch = c * h
 def dm152s(dm15):
    return 2.13 - 2.44*dm15 + 2.07*dm15**2 - 0.7*dm15**3
 
-# Load all the SED templates:
-# Hsiao's uberspectrum:
-f = pyfits.open(os.path.join(spec_base, 'Hsiao_SED_V2.fits'))
-h_sed = f[0].data
-head = f[0].header
-h_wav = head['CRVAL1'] + (num.arange(head['NAXIS1'],dtype=num.float32) - \
-      head['CRPIX1'] + 1)*head['CDELT1']
-f.close()
-# Hsiao's new OPT+NIR uberspectrum
-f = pyfits.open(os.path.join(spec_base, 'Hsiao_SED_V3.fits'))
-h3_sed = f[0].data
-head = f[0].header
-h3_wav = head['CRVAL1']+(num.arange(head['NAXIS1'],dtype=num.float32) - \
-      head['CRPIX1'] + 1)*head['CDELT1']
-f.close()
-# Nugent's uberspectrum:
-f = pyfits.open(os.path.join(spec_base, "Nugent_SED.fits"))
-n_sed = f[0].data
-head = f[0].header
-n_wav = head['CRVAL1']+(num.arange(head['NAXIS1'],dtype=num.float32) - \
-      head['CRPIX1'] + 1)*head['CDELT1']
-# Nugent's 91bg-like SED:
-f = pyfits.open(os.path.join(spec_base, "Nugent_91bg_SED.fits"))
-n91_sed = f[0].data
-head = f[0].header
-n91_wav = head['CRVAL1']+(num.arange(head['NAXIS1'],dtype=num.float32) - \
-      head['CRPIX1'] + 1)*head['CDELT1']
+def read_SED_cube(filename):
+   '''Read an SED cube (indexed by [day,wavelength]) from FITS file
+   [filename]. Returns (wave, cube).'''
+   try:
+      from astropy.io import fits as pyfits
+   except ImportError:
+      try:
+         import pyfits
+      except ImportError:
+         sys.stderr.write('Error:  You need pyfits to run snpy.  You can get it\n')
+         sys.stderr.write('        from:  http://www.stsci.edu/resources/'+\
+                          'software_hardware/pyfits/\n')
+         raise ImportError
+   f = pyfits.open(filename)
+   sed = f[0].data
+   head = f[0].header
+   wav = head['CRVAL1'] + (num.arange(head['NAXIS1'],dtype=num.float32) - \
+         head['CRPIX1'] + 1)*head['CDELT1']
+   f.close()
+   return wav,sed
 
 def linterp(spec1, spec2, day1, day2, day):
    if day1 == day2:
@@ -85,7 +69,268 @@ SED_lims = {
       'N':(-19,70),
       '91bg':(-13,100)}
 
-def get_SED(day, version='H3', interpolate=True, extrapolate=False):
+# FITS file and index of day 0 for each SED version
+SED_files = {
+      'H':('Hsiao_SED_V2.fits', 20),
+      'H3':('Hsiao_SED_V3.fits', 20),
+      'N':('Nugent_SED.fits', 19),
+      '91bg':('Nugent_91bg_SED.fits', 13)}
+
+# Directory in which the SED cubes are cached as .npy files and the
+# precision ('float64' or 'float32') in which they are kept.
+SED_cache_dir = os.environ.get('SNPY_SED_CACHE', os.path.join(spec_base,'cache'))
+SED_precision = os.environ.get('SNPY_SED_PRECISION', 'float64')
+
+class SEDCubes(dict):
+   '''A dictionary of SED cubes (wave, cube, index of day 0), indexed by
+   version. The cubes listed in [files] are only read when first needed.
+
+   The first time a cube is read, it is converted to [precision] and saved
+   as a .npy file in [cache_dir]. After that, the .npy file is memory-mapped
+   (read-only), so the cube is loaded page by page as needed and processes
+   using the same cache share its memory. If [cache_dir] is None or cannot
+   be written, the cube is kept in memory instead.
+   '''
+
+   def __init__(self, files, cache_dir=None, precision='float64'):
+      dict.__init__(self)
+      self.files = files
+      self.cache_dir = cache_dir
+      self.set_precision(precision)
+
+   def set_precision(self, precision):
+      '''Set the precision of the cubes ('float64' or 'float32'). Cubes
+      already loaded are dropped.'''
+      if precision not in ['float64','float32']:
+         raise ValueError, "precision must be 'float64' or 'float32'"
+      self.precision = precision
+      self.clear()
+
+   def cache_files(self, version):
+      '''The .npy files (wave, cube) used to cache [version].'''
+      base = os.path.splitext(self.files[version][0])[0]
+      return (os.path.join(self.cache_dir, base+'_wave.npy'),
+              os.path.join(self.cache_dir, '%s_%s.npy' % (base,self.precision)))
+
+   def _write_cache(self, version, wav, sed):
+      '''Save the cube to the cache. Returns False if that failed.'''
+      try:
+         if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+         for fname,arr in zip(self.cache_files(version), [wav,sed]):
+            # write to a temporary file and rename, so other processes never
+            # see a partial file
+            tmp = '%s.%d.tmp' % (fname, os.getpid())
+            f = open(tmp, 'wb')
+            num.save(f, arr)
+            f.close()
+            os.rename(tmp, fname)
+      except (IOError, OSError):
+         return False
+      return True
+
+   def load(self, version):
+      '''Read cube [version], via the cache if possible. Returns
+      (wave, cube).'''
+      fits = os.path.join(spec_base, self.files[version][0])
+      if self.cache_dir is not None:
+         files = self.cache_files(version)
+         if all([os.path.isfile(f) and \
+               os.path.getmtime(f) >= os.path.getmtime(fits) for f in files]):
+            return tuple([num.asarray(num.load(f, mmap_mode='r')) \
+               for f in files])
+      wav,sed = read_SED_cube(fits)
+      wav = num.ascontiguousarray(wav, dtype=num.float64)
+      sed = num.ascontiguousarray(sed, dtype=self.precision)
+      if self.cache_dir is not None and self._write_cache(version, wav, sed):
+         return tuple([num.asarray(num.load(f, mmap_mode='r')) \
+               for f in files])
+      wav.setflags(write=False)
+      sed.setflags(write=False)
+      return wav,sed
+
+   def __missing__(self, version):
+      if version not in self.files:
+         raise KeyError, version
+      wav,sed = self.load(version)
+      self[version] = (wav, sed, self.files[version][1])
+      return self[version]
+
+   def __contains__(self, version):
+      return dict.__contains__(self, version) or version in self.files
+
+   def keys(self):
+      return list(set(dict.keys(self) + self.files.keys()))
+
+   def __iter__(self):
+      return iter(self.keys())
+
+SED_cubes = SEDCubes(SED_files, SED_cache_dir, SED_precision)
+
+class SEDProvider:
+   '''A class that owns the SED cubes and serves (optionally stretched)
+   SEDs from them. Interpolated spectra are cached by version and stretched
+   epoch (day/stretch) with least-recently-used eviction, so k-corrections,
+   bolometric fluxes and mangled SEDs that need the same epoch share
+   a single copy rather than re-slicing the cube.
+
+   Args:
+      cubes (dict): (wave, cube, index of day 0), indexed by version
+      lims (dict): (first day, last day), indexed by version
+      cache_size (int): maximum number of spectra to keep in the cache.
+   '''
+
+   def __init__(self, cubes, lims, cache_size=512):
+      self.cubes = cubes
+      self.lims = lims
+      self.cache_size = cache_size
+      self._cache = OrderedDict()
+
+   def clear_cache(self):
+      '''Empty the cache of interpolated spectra.'''
+      self._cache.clear()
+
+   def epochs(self, days, version='H3', stretch=1.0, interpolate=True,
+         extrapolate=False):
+      '''Map days onto the (fractional) epochs of the SED cube.
+
+      Returns:
+         2-tuple: (epochs, mask). mask is False where days are outside the
+                  range of the SED (in which case epoch is meaningless).
+      '''
+      if version not in self.cubes:
+         raise AttributeError, "version %s not recognized" % version
+      epochs = num.atleast_1d(num.asarray(days, dtype=num.float64))/stretch
+      if not interpolate:
+         epochs = num.round(epochs)
+      lo,hi = self.lims[version]
+      mask = num.greater_equal(epochs, lo)*num.less_equal(epochs, hi)
+      if extrapolate:
+         epochs = num.clip(epochs, lo, hi)
+         mask[:] = True
+      else:
+         epochs = num.where(mask, epochs, lo)
+      return epochs,mask
+
+   def _slice(self, version, epochs):
+      '''Interpolate the SED cube linearly at each epoch in epochs.'''
+      wave,cube,off = self.cubes[version]
+      day1 = num.floor(epochs).astype(int)
+      day2 = num.ceil(epochs).astype(int)
+      fluxes = cube[day1+off,:]
+      # interpolate in the precision of the cube
+      frac = (epochs - day1).astype(cube.dtype)
+      if num.sometrue(frac > 0):
+         fluxes = fluxes + (cube[day2+off,:] - fluxes)*frac[:,num.newaxis]
+      return fluxes
+
+   def get_SEDs(self, days, version='H3', stretch=1.0, interpolate=True,
+         extrapolate=False):
+      '''Retrieve the SEDs at many epochs at once. Spectra not in the
+      cache are interpolated from the cube as a single block.
+
+      Args:
+         days (float array): The days w.r.t. time of B-maximum
+         version (str): The version of SED sequence to use. See
+                        :func:`.get_SED`.
+         stretch (float): The days are divided by this stretch before
+                          looking up the SED.
+         interpolate(bool): If and day is not an integer, interpolate
+                            the spectrum linearly. Otherwise, choose
+                            nearest spectrum.
+         extrapolate(bool): If True and the date is outside the range
+                            of defined SED, simply take the first/last
+                            SED to extend before/after range.
+
+      Returns:
+         3-tuple: (wave,fluxes,mask):
+
+         * wave (array):  Wavelength in Angstroms
+         * fluxes (2d array):  arbitrarily normalized fluxes, indexed by
+                               [day,wavelength]
+         * mask (bool array):  True where the SED is defined. Fluxes are
+                               zero where it is not.
+      '''
+      epochs,mask = self.epochs(days, version, stretch, interpolate,
+            extrapolate)
+      wave,cube,off = self.cubes[version]
+      rows = [None]*len(epochs)
+      missing = []
+      for i in range(len(epochs)):
+         if not mask[i]:  continue
+         key = (version, epochs[i])
+         if key in self._cache:
+            rows[i] = self._cache.pop(key)
+            self._cache[key] = rows[i]
+         else:
+            missing.append(i)
+      if missing:
+         # Duplicate epochs are only sliced once
+         uepochs,inv = num.unique(epochs[missing], return_inverse=True)
+         block = self._slice(version, uepochs)
+         new = []
+         for k in range(len(uepochs)):
+            row = block[k].copy()
+            row.flags.writeable = False
+            new.append(row)
+         for k,i in enumerate(missing):
+            rows[i] = new[inv[k]]
+         if self.cache_size > 0:
+            for k in range(len(uepochs)):
+               self._cache[(version, uepochs[k])] = new[k]
+            while len(self._cache) > self.cache_size:
+               self._cache.popitem(last=False)
+
+      if num.alltrue(mask):
+         fluxes = num.array(rows)
+      else:
+         dtype = rows[num.nonzero(mask)[0][0]].dtype if num.sometrue(mask) \
+               else cube.dtype
+         fluxes = num.zeros((len(epochs), len(wave)), dtype=dtype)
+         for i in num.nonzero(mask)[0]:
+            fluxes[i] = rows[i]
+      return (wave, fluxes, mask)
+
+   def get_SED(self, day, version='H3', stretch=1.0, interpolate=True,
+         extrapolate=False):
+      '''Retrieve the SED at a single epoch. See :meth:`.get_SEDs`. The
+      flux array that is returned is shared with the cache and is therefore
+      read-only.
+
+      Returns:
+         2-tuple: (wave,flux), or (None,None) if day is outside the range
+                  of the SED.
+      '''
+      epochs,mask = self.epochs(day, version, stretch, interpolate,
+            extrapolate)
+      if not mask[0]:
+         return (None,None)
+      key = (version, epochs[0])
+      if key in self._cache:
+         flux = self._cache.pop(key)
+      else:
+         flux = self._slice(version, epochs)[0].copy()
+         flux.flags.writeable = False
+      if self.cache_size > 0:
+         self._cache[key] = flux
+         while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+      return (self.cubes[version][0], flux)
+
+# The SED provider shared by the k-corrections, bolometric and sn modules
+sed_provider = SEDProvider(SED_cubes, SED_lims)
+
+def set_SED_precision(precision):
+   '''Keep the SED cubes in [precision] ('float64' or 'float32'). float32
+   halves the memory and can speed up batch k-corrections, at the cost of
+   ~1e-7 relative precision in the SEDs.'''
+   global SED_precision
+   SED_cubes.set_precision(precision)
+   sed_provider.clear_cache()
+   SED_precision = precision
+
+def get_SED(day, version='H3', interpolate=True, extrapolate=False, 
+      stretch=1.0):
    '''Retrieve the SED for a SN for a particular epoch.
    
    Args:
@@ -102,45 +347,34 @@ def get_SED(day, version='H3', interpolate=True, extrapolate=False):
       extrapolate(bool): If True and the date is outside the range
                          of defined SED, simply take the first/last
                          SED to extend before/after range.
+      stretch (float): Stretch the SED in time (day is divided by stretch).
 
    Returns:
       2-tuple: (wave,flux):
 
       * wave (array):  Wavelength in Angstroms
-      * flux (array):  arbitrarily normalized flux
+      * flux (array):  arbitrarily normalized flux (read-only)
    '''
-
-   if type(day) is type(1.0) and not interpolate:
-      day = round(day)
+   return sed_provider.get_SED(day, version, stretch, interpolate, 
+         extrapolate)
+
+def get_SEDs(days, version='H3', interpolate=True, extrapolate=False,
+      stretch=1.0):
+   '''Retrieve the SEDs for a SN for many epochs at once. This is the same
+   as :func:`.get_SED`, but works on the SED cube for all the epochs in one
+   go. See :meth:`SEDProvider.get_SEDs`.
    
-   # Check limits
-   if day < SED_lims[version][0]:
-      if extrapolate:
-         day = SED_lims[version][0]
-      else:
-         return (None,None)
-   if day > SED_lims[version][1]:
-      if extrapolate:
-         day = SED_lims[version][1]
-      else:
-         return (None,None)
+   Returns:
+      3-tuple: (wave,fluxes,mask):
 
-   day1 = int(num.floor(day))
-   day2 = int(num.ceil(day))
-   if version == 'H':
-      return (h_wav, 
-            linterp(h_sed[day1+20,:],h_sed[day2+20,:],day1,day2,day))
-   elif version == 'H3':
-      return (h3_wav, 
-            linterp(h3_sed[day1+20,:],h3_sed[day2+20,:],day1,day2,day))
-   elif version == 'N':
-      return (n_wav, 
-            linterp(n_sed[day1+19,:],n_sed[day2+19,:],day1,day2,day))
-   elif version == '91bg':
-      return (n91_wav, 
-            linterp(n91_sed[day1+13, :],n91_sed[day2+13,:],day1,day2,day))
-   else:
-      raise AttributeError, "version %s not recognized" % version
+      * wave (array):  Wavelength in Angstroms
+      * fluxes (2d array):  arbitrarily normalized fluxes, indexed by
+                            [day,wavelength]
+      * mask (bool array):  True where the SED is defined. Fluxes are zero
+                            where it is not.
+   '''
+   return sed_provider.get_SEDs(days, version, stretch, interpolate, 
+         extrapolate)
 
 def redden(wave, flux, ebv_gal, ebv_host, z, R_gal=3.1, R_host=3.1,
       redlaw='ccm', strict_ccm=False):
@@ -183,7 +417,9 @@ def K(wave, spec, f1, f2, z, photons=1):
    
    Args:
       wave (float array): input wavelength in Angstroms
-      flux (float array): arbitrarily scaled flux
+      flux (float array): arbitrarily scaled flux. If 2D, indexed by
+                          [spectrum,wavelength] and K-corrections are computed
+                          for each spectrum.
       f1 (filter instance): Rest-frame filter.
       f2 (filter instance): Observed filter. This could be the same as f1 or
                             a redder filter for cross-band K-correction
@@ -194,14 +430,23 @@ def K(wave, spec, f1, f2, z, photons=1):
    Returns:
       2-tuple: (K,flag)
 
-      * K: K-correction
-      * flag: 1 -> success, 0->failed
+      * K: K-correction (array if spec is 2D)
+      * flag: 1 -> success, 0->failed (array if spec is 2D)
    '''
 
    # The zero-points
    zpt1 = f1.zp
    zpt2 = f2.zp
 
+   if len(num.shape(spec)) == 2:
+      f1flux_0 = f1.responses(wave, spec, photons=photons)
+      f2flux_z = f2.responses(wave, spec, z=z, photons=photons)
+      flag = num.greater_equal(f1flux_0, 0)*num.greater(f2flux_z, 0)
+      rat = num.where(flag, f1flux_0, 1)/num.where(flag, f2flux_z, 1)
+      kf1f2 = num.where(flag, 2.5*num.log10(1+z) + 2.5*num.log10(rat) - \
+               zpt1 + zpt2, 0.0)
+      return (kf1f2, flag.astype(int))
+
    # compute the response through each filter
    f1flux_0 = f1.response(wave, spec, photons=photons)
    f2flux_z = f2.response(wave, spec, z=z, photons=photons)
@@ -226,7 +471,9 @@ def S(wave, spec, f1, f2, z):
 
    Args:
       wave (float array): input wavelength in Angstroms
-      flux (float array): arbitrarily scaled flux
+      flux (float array): arbitrarily scaled flux. If 2D, indexed by
+                          [spectrum,wavelength] and S-corrections are computed
+                          for each spectrum.
       f1 (filter instance): Observed source filter.
       f2 (filter instance): Observed destination filter.
       z (float): redshift
@@ -240,6 +487,14 @@ def S(wave, spec, f1, f2, z):
       * flag: 1 -> success, 0->failed
    '''
 
+   if len(num.shape(spec)) == 2:
+      r1 = f1.responses(wave, spec, z=z)
+      r2 = f2.responses(wave, spec, z=z)
+      flag = num.greater(r1, 0)*num.greater(r2, 0)
+      S = num.where(flag, -2.5*num.log10(num.where(flag, r2, 1)) + f2.zp + \
+            2.5*num.log10(num.where(flag, r1, 1)) - f1.zp, 0.0)
+      return (S, flag.astype(int))
+
    # compute the magnitude through each filter
    mag1 = f1.synth_mag(wave, spec, z=z)
    mag2 = f2.synth_mag(wave, spec, z=z)
@@ -289,33 +544,24 @@ def kcorr(days, filter1, filter2, z, ebv_gal=0, ebv_host=0, R_gal=3.1,
    if filter2 not in filters.fset:
       raise AttributeError, "filter %s not defined in filters module" % filter2
 
-   kcorrs = []
-   mask = []      # Masks the good values (1) and bad (not defined) values (0)
-   # Loop through the list of days
-   for day in days:
-      day = int(day)
-      spec_wav,spec_f = get_SED(day, version)
-      if spec_wav is None:
-         # print "Warning:  no spectra for day %d, setting Kxy=0" % day
-         kcorrs.append(0.0)
-         mask.append(0)
-         continue
-
-      # Do the reddening, if required
-      if ebv_gal > 0 or ebv_host > 0:
-         sp_f = redden(spec_wav, spec_f, ebv_gal, ebv_host, z, R_gal, R_host)
-      else:
-         sp_f = spec_f
+   # Slice the SED cube for all days at once
+   days = num.asarray(days).astype(int)
+   spec_wav,spec_f,gids = get_SEDs(days, version)
 
-      f1 = filters.fset[filter1]
-      f2 = filters.fset[filter2]
-      if not Scorr:
-         k,f = K(spec_wav, sp_f, f1, f2, z)
-      else:
-         k,f = S(spec_wav, sp_f, f1, f2, z)
-      kcorrs.append(k)
-      mask.append(f)
-   return(kcorrs,mask)
+   # Do the reddening, if required
+   if ebv_gal > 0 or ebv_host > 0:
+      spec_f = redden(spec_wav, spec_f, ebv_gal, ebv_host, z, R_gal, R_host)
+
+   f1 = filters.fset[filter1]
+   f2 = filters.fset[filter2]
+   if not Scorr:
+      k,f = K(spec_wav, spec_f, f1, f2, z)
+   else:
+      k,f = S(spec_wav, spec_f, f1, f2, z)
+   # no spectra for days outside the SED, so set Kxy=0
+   kcorrs = num.where(gids, k, 0.0)
+   mask = gids*f
+   return(kcorrs.tolist(),mask.tolist())
 
 def kcorr_mangle2(waves, spectra, filts, mags, m_mask, restfilts, z, 
       colorfilts=None, full_output=0, Scorr=False, **mopts): 
@@ -548,12 +794,12 @@ def kcorr_mangle(days, filts, mags, m_mask, restfilts, z, version='H',
          Rts.append(R_obs_spectrum(filts, spec_wavs[j], man_spec_fs[j], z, 
             0.01, 0.0))
    else:
+      spec_wav,spec_fs,sids = get_SEDs(num.asarray(days).astype(int), version)
       for j in range(len(days)):
          kcorrs.append([])
          mask.append([])
-         day = int(days[j])
-         spec_wav,spec_f = get_SED(day, version)
-         if spec_wav is None:
+         spec_f = spec_fs[j]
+         if not sids[j]:
             # print "Warning:  no spectra for day %d, setting Kxy=0" % day
             kcorrs[-1] = num.zeros((len(filts),), dtype=num.float32)
             mask[-1] = num.zeros((len(filts),), dtype=num.int8)
@@ -659,72 +905,55 @@ def R_obs_abc(filter1, filter2, filter3, z, days, EBVhost, EBVgal,
        redlaw (str): Which reddening law to use. See :mod:`snpy.utils.deredden`
        strict_ccm (bool): If True and using CCM reddening law, do not apply
                           the corrections due to O'Donnel.'''
-   try:
-      N = len(days)
-      outarr = 1
-   except:
-      days = [days]
-      outarr = 0
+   for filter in [filter1,filter2,filter3]:
+      if filter not in filters.fset:
+         raise AttributeError, "filter %s not defined in filters module" % filter
+   outarr = len(num.shape(days)) > 0
 
-   Rs = []
-   for day in days:
-      spec_wav,spec_f = get_SED(int(day), version)
-      if spec_wav is None:
-         Rs.append(99.9)
-      # Redden the spectrum based on Cardelli et al. and assumed EBVgal + EBVhost
-      red_f = redden(spec_wav, spec_f, EBVgal, EBVhost, z, Rv_gal, Rv_host,
-            redlaw=redlaw, strict_ccm=strict_ccm)
-      for filter in [filter1,filter2,filter3]:
-         if filter not in filters.fset:
-            raise AttributeError, "filter %s not defined in filters module" % filter
- 
-      # Now, we get the response across the filters:
-      resp = {}
-      resp_red = {}
-      for filter in [filter1,filter2,filter3]:
-         if filter not in resp:
-            resp[filter] = filters.fset[filter].response(spec_wav, spec_f, z=z)
-            resp_red[filter] = filters.fset[filter].response(spec_wav, red_f, z=z)
- 
-      A1 = -2.5*num.log10(resp_red[filter1]/resp[filter1])
-      A2 = -2.5*num.log10(resp_red[filter2]/resp[filter2])
-      A3 = -2.5*num.log10(resp_red[filter3]/resp[filter3])
-      Rs.append(A1/(A2 - A3))
+   As,gids = _A_block([filter1,filter2,filter3], z, days, EBVhost, EBVgal,
+         Rv_host, Rv_gal, version, redlaw=redlaw, strict_ccm=strict_ccm)
+   Rs = num.where(gids, As[filter1]/(As[filter2] - As[filter3]), 99.9)
    if outarr:
-      return(num.array(Rs))
+      return(Rs)
    else:
       return(Rs[0])
 
+def _A_block(filts, z, days, EBVhost, EBVgal, Rv_host, Rv_gal, version,
+      clip=False, photons=1, **rargs):
+   '''Compute the extinction in each filter in filts for the SED at each
+   epoch in days. The SEDs are sliced and reddened as a single block.
+   Returns a dictionary of A arrays (indexed by filter) and the mask of
+   valid epochs.'''
+   days = num.atleast_1d(days)
+   if clip:
+      days = num.where(days < -19, -18, days)
+      days = num.where(days > 70, 69, days)
+   spec_wav,spec_f,gids = get_SEDs(days.astype(int), version)
+   red_f = redden(spec_wav, spec_f, EBVgal, EBVhost, z, Rv_gal, Rv_host,
+         **rargs)
+   As = {}
+   for filter in filts:
+      if filter in As:  continue
+      f = filters.fset[filter]
+      resp = f.responses(spec_wav, spec_f, z=z, photons=photons)
+      resp_red = f.responses(spec_wav, red_f, z=z, photons=photons)
+      good = gids*num.greater(resp, 0)
+      As[filter] = num.where(good, 
+            -2.5*num.log10(num.where(good, resp_red, 1)/num.where(good,resp,1)),
+            0)
+   return As,gids
+
 def A_obs(filter, z, days, EBVhost, EBVgal, Rv_host=3.1, Rv_gal=3.1, 
       version='H3'):
-   try:
-      N = len(days)
-      outarr = 1
-   except:
-      days = [days]
-      outarr = 0
-
-   As = []
-   for day in days:
-      if day < -19:  day=-18
-      if day > 70:  day = 69
-      spec_wav,spec_f = get_SED(int(day), version)
-      if spec_wav is None:
-         Rs.append(99.9)
-         continue
-      # rEDDEN the spectrum based on Cardelli et al. and assumed EBVgal+EBVhost
-      red_f = redden(spec_wav, spec_f, EBVgal, EBVhost, z, Rv_gal, Rv_host)
+   if filter not in filters.fset:
+      raise AttributeError, "filter %s not defined in filters module" % filter
+   outarr = len(num.shape(days)) > 0
 
-      if filter not in filters.fset:
-         raise AttributeError, "filter %s not defined in filters module" % filter
- 
-      # Now, we get the response across the filters:
-      resp = filters.fset[filter].response(spec_wav, spec_f, z=z, photons=1)
-      resp_red = filters.fset[filter].response(spec_wav, red_f, z=z, photons=1)
- 
-      As.append(-2.5*num.log10(resp_red/resp))
+   As,gids = _A_block([filter], z, days, EBVhost, EBVgal, Rv_host, Rv_gal,
+         version, clip=True)
+   As = num.where(gids, As[filter], 99.9)
    if outarr:
-      return(num.array(As))
+      return(As)
    else:
       return(As[0])
 
@@ -735,36 +964,15 @@ def R_obs(filter, z, days, EBVhost, EBVgal, Rv_host=3.1, Rv_gal=3.1,
 
       A(filter) = R(filter)*E(B-V).
    '''
-   try:
-      N = len(days)
-      outarr = 1
-   except:
-      days = [days]
-      outarr = 0
-
-   Rs = []
-   for day in days:
-      if day < -19:  day=-18
-      if day > 70:  day = 69
-      spec_wav,spec_f = get_SED(int(day), version)
-      if spec_wav is None:
-         Rs.append(99.9)
-         continue
-      # rEDDEN the spectrum based on Cardelli et al. and assumed EBVgal + EBVhost
-      red_f = redden(spec_wav, spec_f, EBVgal, EBVhost, z, Rv_gal, Rv_host,
-            redlaw=redlaw, strict_ccm=strict_ccm)
+   if filter not in filters.fset:
+      raise AttributeError, "filter %s not defined in filters module" % filter
+   outarr = len(num.shape(days)) > 0
 
-      if filter not in filters.fset:
-         raise AttributeError, "filter %s not defined in filters module" % filter
- 
-      # Now, we get the response across the filters:
-      resp = filters.fset[filter].response(spec_wav, spec_f, z=z, photons=1)
-      resp_red = filters.fset[filter].response(spec_wav, red_f, z=z, photons=1)
- 
-      A_obs = -2.5*num.log10(resp_red/resp)
-      Rs.append(A_obs/(EBVhost + EBVgal))
+   As,gids = _A_block([filter], z, days, EBVhost, EBVgal, Rv_host, Rv_gal,
+         version, clip=True, redlaw=redlaw, strict_ccm=strict_ccm)
+   Rs = num.where(gids, As[filter]/(EBVhost + EBVgal), 99.9)
    if outarr:
-      return(num.array(Rs))
+      return(Rs)
    else:
       return(Rs[0])
 
@@ -2,8 +2,9 @@ from numpy import *
 from filters import fset
 import numpy.random as RA
 from utils import fit1dcurve
-from utils import InteractiveFit
-import plotmod
+from utils.lazy import lazy_import
+InteractiveFit = lazy_import('snpy.utils.InteractiveFit')
+plotmod = lazy_import('snpy.plotmod')
 from scipy.optimize import brentq
 
 if 'gp' in fit1dcurve.functions:
@@ -188,7 +189,7 @@ class lc:
       # the mean accordingly.
       self.__dict__.update(state)
       if getattr(self, 'interp',None) is not None:
-         if isinstance(self.interp, fit1dcurve.GaussianProcess):
+         if isinstance(self.interp, fit1dcurve.gp_classes):
             if getattr(self.interp, 'mean', None) is None:
                self.interp.mean = self.mean
                self.interp.setup = False
@@ -449,7 +450,7 @@ class lc:
       xx,yy,ee = fit1dcurve.regularize(x, y, ey)
       if len(xx) < 2:
          raise ValueError, "Cannot interpolate data with less than two distinct data points"
-      if method == 'gp':
+      if method in ['gp','npgp']:
          args['mean'] = self.mean
       self.interp = fit1dcurve.Interpolator(method, x, y, ey, self.mask, **args)
       if interactive:
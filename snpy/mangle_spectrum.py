@@ -18,6 +18,10 @@ except:
    tspline = None
 from snpy.utils import deredden
 from snpy.utils import mpfit
+try:
+   from scipy.optimize import least_squares
+except ImportError:
+   least_squares = None
 from snpy.utils.bspline import bspline_basis
 import copy
 #from matplotlib import pyplot as plt
@@ -25,6 +29,10 @@ import copy
 filts = fset
 debug=False
 default_method = 'bspline'
+# Non-linear solver used by mangler.solve():  'lsq' (scipy's least_squares
+# with the derivatives supplied by the mangling function), 'mpfit' or 'auto'
+# (lsq if the function has a deriv() method, otherwise mpfit).
+default_solver = 'auto'
 
 class function:
    '''A function object that represents a way of making a smooth multiplication
@@ -54,6 +62,11 @@ class function:
    def __eval__(self, x):
       pass
 
+   # Sub-classes that can compute the derivatives of the function with
+   # respect to its parameters should define a method deriv(x) that returns
+   # them as an array indexed by [parameter,spectrum,wavelength]. The
+   # mangler then uses the faster least-squares solver (see mangler.solve).
+
 class f_tspline(function):
    '''Tension spline mangler. Tension splines are controlled by a tension
    parameter. The higher the tension, the less curvature the spline can
@@ -124,13 +137,13 @@ class f_tspline(function):
          xyds = tspline.tspsi(self.parent.ave_waves, self.pars, 
                tension=self.tension, slopes=self.slopes)
 
-      res = num.array([tspline.tsval1(x[i], xyds) for i in range(x.shape[0])])
+      # evaluate all the spectra's wavelengths in one go
+      res = tspline.tsval(x, xyds)
 
-      y0 = tspline.tsval1(self.parent.ave_waves[0], xyds)[0]
-      y1 = tspline.tsval1(self.parent.ave_waves[-1], xyds)[0]
+      ends = self.parent.ave_waves[[0,-1]]
+      y0,y1 = tspline.tsval(ends, xyds)
       if self.gradient:
-         dy0 = tspline.tsval1(self.parent.ave_waves[0], xyds, 1)[0]
-         dy1 = tspline.tsval1(self.parent.ave_waves[-1], xyds, 1)[0]
+         dy0,dy1 = tspline.tsval(ends, xyds, 1)
          res = num.where(x < self.parent.ave_waves[0], 
                y0 + (x-self.parent.ave_waves[0])*dy0, res)
          res = num.where(x > self.parent.ave_waves[-1], 
@@ -140,6 +153,26 @@ class f_tspline(function):
          res = num.where(x > self.parent.ave_waves[-1], y1, res)
       return(res)
 
+   def deriv(self, x):
+      '''Derivatives of the function at x with respect to the knot values,
+      indexed by [parameter,spectrum,wavelength]. These are forward
+      differences of the spline itself, which is cheap compared to the
+      synthetic photometry the mangler then does with them.'''
+      if self.parent.ave_waves is None or self.pars is None:
+         return num.zeros((0,)+x.shape)
+      p = num.array(self.pars, dtype=num.float64)
+      f0 = self(x)
+      res = num.zeros((p.shape[0],)+x.shape)
+      try:
+         for k in range(p.shape[0]):
+            h = 1e-6*max(1.0, abs(p[k]))
+            self.pars = p.copy()
+            self.pars[k] += h
+            res[k] = (self(x) - f0)/h
+      finally:
+         self.pars = p
+      return res
+
 class f_spline(function):
    '''Spline mangler. Splines are controlled by a smoothing
    parameter. The higher the smoothing, the less curvature the spline can
@@ -265,8 +298,9 @@ class f_Bspline(function):
       self.basis = {}              # basis vectors, indexed by:
                                    #  [filter,spectrum,basis]
 
-   def init_pars(self, nid=0):
-      # one parameter for each knot points, unless slopes are constrained
+   def setup_basis(self):
+      '''Compute the knots and the basis splines at the parent's
+      wavelengths for the parent's current set of bands.'''
       bs = self.parent.bands
       nf = len(bs)            
       args = {}
@@ -308,6 +342,11 @@ class f_Bspline(function):
             for i in range(self.parent.wave.shape[0])]
       self.bsp = bsp
 
+   def init_pars(self, nid=0):
+      # one parameter for each knot points, unless slopes are constrained
+      self.setup_basis()
+      bsp = self.bsp
+
       # setup the parameters
       if self.log:
          limited = [0,0]
@@ -318,11 +357,16 @@ class f_Bspline(function):
 
       # For each filter, compute the reponse for every flux vector multiplied
       # by each basis spline.
+      # Since the response is linear in the flux, this is just a dot
+      # product with the filter's integration weights.
       for f in self.parent.bands:
          self.basis[f] = []
          for i in range(self.parent.wave.shape[0]):
-            self.basis[f].append(num.array([fset[f].response(self.parent.wave[i],
-               self.parent.flux[i]*bsp[i][:,j]) for j in range(bsp[i].shape[1])]))
+            w = fset[f].response_weights(self.parent.wave[i])
+            if w is None:
+               self.basis[f].append(num.zeros((bsp[i].shape[1],)) - 1.0)
+            else:
+               self.basis[f].append(num.dot(w*self.parent.flux[i], bsp[i]))
       
       scale = -num.inf
       # now re-scale to reasonable values
@@ -349,22 +393,45 @@ class f_Bspline(function):
       if self.pars is None:
          return x*0+1.0
       res = num.array([num.dot(b,self.pars) for b in self.bsp])
+      return self._extrapolate(x, res, self.pars)
+
+   def eval_pars(self, pars):
+      '''Evaluate the function at the parent's (first) wavelength vector
+      for many sets of parameters at once.
+
+      Args:
+         pars (2d float array): parameters, indexed by [set,basis]
+
+      Returns:
+         2d float array: function indexed by [set,wavelength]
+      '''
+      pars = num.asarray(pars)
+      res = num.dot(pars, self.bsp[0].T)
+      return self._extrapolate(self.parent.wave[0:1], res, pars)
+
+   def _extrapolate(self, x, res, pars):
       knots = self.knots
       # clamped spline, so it must pass through end-points, but if we used the
       # gradient trick, we need to transform back to original coeficients.
+      # pars[...,i:i+1] lets this work on a single set or on a 2D array of
+      # parameter sets.
+      p0 = pars[...,0:1]
+      p1 = pars[...,1:2]
+      pm1 = pars[...,-1:]
+      pm2 = pars[...,-2:-1]
       if self.gradient and len(knots) > 3:
          dl1 = (knots[1]-knots[0])
          dl2 = (knots[2]-knots[0])
          dlm1 = (knots[-1]-knots[-2])
          dlm2 = (knots[-1]-knots[-3])
-         y0 = self.pars[0] - dl1/dl2*(self.pars[1]-self.pars[0])
-         y1 = self.pars[-1] + dlm1/dlm2*(self.pars[-1]-self.pars[-2])
+         y0 = p0 - dl1/dl2*(p1-p0)
+         y1 = pm1 + dlm1/dlm2*(pm1-pm2)
          # gradient at end-points is also clamped, so use recursion relation
-         yp0 = self.k/dl2*(self.pars[1]-self.pars[0])
-         yp1 = self.k/dlm2*(self.pars[-1] - self.pars[-2])
+         yp0 = self.k/dl2*(p1-p0)
+         yp1 = self.k/dlm2*(pm1 - pm2)
       else:
-         y0 = self.pars[0]
-         y1 = self.pars[-1]
+         y0 = p0
+         y1 = pm1
          yp0 = yp1 = 0
       res = num.where(num.less(x,knots[0]), y0 + yp0*(x-knots[0]), res)
       res = num.where(num.greater(x,knots[-1]), y1 + yp1*(x-knots[-1]), res)
@@ -403,12 +470,40 @@ class f_ccm(function):
       #m *= self.pars[0]
       return m
 
+   def deriv(self, x):
+      '''Analytic derivatives of the function at x with respect to E(B-V)
+      and R_V, indexed by [parameter,spectrum,wavelength].'''
+      ebv,rv = self.pars
+      res = num.zeros((2,)+x.shape)
+      for i in range(x.shape[0]):
+         m,a,b = deredden.unred(x[i], x[i]*0+1, -ebv, R_V=rv)
+         # m = 10**(-0.4*ebv*(a*rv + b))
+         res[0,i] = -0.4*num.log(10)*(a*rv + b)*m
+         res[1,i] = -0.4*num.log(10)*ebv*a*m
+      return res
+
 mangle_functions = {'spline':f_spline,
                     'bspline':f_Bspline,
                     'ccm':f_ccm}
 if tspline is not None:
    mangle_functions['tspline'] = f_tspline
 
+# least_squares status --> equivalent mpfit status (see messages below)
+_lsq_status = {-1:0, 0:5, 1:4, 2:1, 3:2, 4:3}
+
+class lsq_result:
+   '''The result of mangler.solve() when scipy's least_squares is used. It
+   has the attributes of an mpfit instance that are used elsewhere (params,
+   status, niter, fnorm, errmsg), with status translated to mpfit's codes.'''
+
+   def __init__(self, res, params):
+      self.params = params
+      self.status = _lsq_status.get(res.status, 0)
+      self.niter = res.nfev
+      self.fnorm = num.sum(res.fun**2)
+      self.errmsg = '' if res.status > 0 else res.message
+      self.lsq = res
+
 class mangler:
    '''Given a spectrum and spectrum object, find the best set of a function's 
    paramters, such that the function multiplied by the spectrum produces
@@ -597,7 +692,7 @@ class mangler:
 
    def solve(self, bands, colors, fixed_filters=None, 
          anchorwidth=100, xtol=1e-10, ftol=1e-4, gtol=1e-10,
-         init=None):
+         init=None, solver=None):
       '''Solve for the mangling function that will produce the observed colors
       in the filters defined by bands.
       
@@ -613,7 +708,16 @@ class mangler:
          anchorwidth (float): If making fake filters, they will be spaced
                               this many Angstroms from the bluest and reddest
                               filters (default 100).
-         xtol, ftol, gtol (float): see scipy.optimize.leastsq.'''
+         xtol, ftol, gtol (float): see scipy.optimize.leastsq.
+         init (list/array): initial values for the mangle parameters.
+         solver (str): 'lsq' to use scipy's least_squares with derivatives
+                       supplied by the mangling function, 'mpfit' to use
+                       mpfit with numerical derivatives, or 'auto' to use
+                       lsq if the function has derivatives. Default is
+                       the module's default_solver.
+      
+      Returns:
+         mpfit instance or lsq_result: the result of the fit.'''
 
       # going to try to do multiple-epoch colors simultaneously with one
       #  mangle function.  colors[i,j] = color for epoch i, color j
@@ -685,13 +789,31 @@ class mangler:
             for j in range(len(init)):
                pi[j]['value'] = init[j]
 
-      if self.verbose:
-         quiet = 0
+      if solver is None:  solver = default_solver
+      if solver not in ['auto','lsq','mpfit']:
+         raise ValueError, "solver must be 'auto', 'lsq' or 'mpfit'"
+      has_deriv = getattr(self.function, 'deriv', None) is not None
+      if solver == 'lsq' and (not has_deriv or least_squares is None):
+         raise ValueError, "solver 'lsq' needs scipy's least_squares and a "\
+               "mangling function with derivatives"
+      if solver == 'auto':
+         if has_deriv and least_squares is not None:
+            solver = 'lsq'
+         else:
+            solver = 'mpfit'
+
+      if solver == 'lsq':
+         result = self.solve_lsq(pi, bands, maxiter=200, ftol=ftol, 
+               gtol=gtol, xtol=xtol)
       else:
-         quiet = 1
-      #quiet = 1
-      result = mpfit.mpfit(self.leastsq, parinfo=pi, quiet=quiet, maxiter=200,
-            ftol=ftol, gtol=gtol, xtol=xtol, functkw={'bands':bands,'nid':id})
+         if self.verbose:
+            quiet = 0
+         else:
+            quiet = 1
+         #quiet = 1
+         result = mpfit.mpfit(self.leastsq, parinfo=pi, quiet=quiet, 
+               maxiter=200, ftol=ftol, gtol=gtol, xtol=xtol, 
+               functkw={'bands':bands,'nid':id})
       if (result.status == 5) : print \
         'Maximum number of iterations exceeded in mangle_spectrum'
       self.function.set_pars(result.params)
@@ -703,6 +825,110 @@ class mangler:
 
       return(result)
 
+   def _parmap(self, pi):
+      '''Given mpfit-style parameter info [pi], return (p0, A, free) such
+      that the full parameter vector is p0 + dot(A, q), where q are the free
+      parameters (initially p0[free]). Fixed parameters keep their values
+      and tied parameters are evaluated as mpfit does, which means their
+      expressions must be linear (as they are for the functions here).'''
+      npar = len(pi)
+      p0 = num.array([par.get('value', 0.0) for par in pi], dtype=num.float64)
+      tied = [par.get('tied','').strip() for par in pi]
+      free = [i for i in range(npar) if not pi[i].get('fixed',0) \
+            and tied[i] == '']
+
+      def full(q):
+         p = p0.copy()
+         p[free] = q
+         for i in range(npar):
+            if tied[i] != '':
+               p[i] = eval(tied[i], {}, {'p':p})
+         return p
+
+      c = full(p0[free])
+      A = num.zeros((npar, len(free)))
+      for k in range(len(free)):
+         q = p0[free].copy()
+         q[k] += 1.0
+         A[:,k] = full(q) - c
+      return c - num.dot(A, p0[free]), A, free
+
+   def _response_weights(self, bands):
+      '''The filter integration weights multiplied by the input flux, indexed
+      by [spectrum][band,wavelength], so that the responses of the mangled
+      spectrum are dot products. Also returns an array of offsets, which are
+      -1 where a spectrum does not cover the filter (as in filter.response).'''
+      wflux = []
+      off = num.zeros((self.wave.shape[0], len(bands)))
+      for i in range(self.wave.shape[0]):
+         ws = num.zeros((len(bands), self.wave.shape[1]))
+         for j,b in enumerate(bands):
+            w = fset[b].response_weights(self.wave[i], z=self.z)
+            if w is None:
+               off[i,j] = -1.0
+            else:
+               ws[j] = w*self.flux[i]
+         wflux.append(ws)
+      return wflux, off
+
+   def solve_lsq(self, pi, bands, maxiter=200, ftol=1e-4, gtol=1e-10, 
+         xtol=1e-10):
+      '''Solve for the parameters of a mangling function that has a deriv()
+      method using scipy's least_squares. The synthetic responses and their
+      derivatives are dot products of the (cached) filter weights with the
+      function and its derivatives, so the filters are only integrated once.
+      Fixed, tied and bounded parameters behave as they do with mpfit.
+
+      Args:
+         pi (list of dict): mpfit-style parameter info
+         bands (list of str): The list of filters to construct colors from
+         maxiter (int): maximum number of function evaluations
+         xtol,ftol,gtol (float): see scipy.optimize.least_squares
+
+      Returns:
+         lsq_result instance
+      '''
+      p0,A,free = self._parmap(pi)
+      wflux,off = self._response_weights(bands)
+      lower = []
+      upper = []
+      for i in free:
+         limited = pi[i].get('limited', [0,0])
+         limits = pi[i].get('limits', [0.0,0.0])
+         lower.append(limits[0] if limited[0] else -num.inf)
+         upper.append(limits[1] if limited[1] else num.inf)
+      q0 = num.array([pi[i]['value'] for i in free], dtype=num.float64)
+      q0 = num.clip(q0, lower, upper)
+
+      def resps(q, jac):
+         p = p0 + num.dot(A, q)
+         self.function.set_pars(p)
+         f = self.function(self.wave)
+         R = num.array([num.dot(wflux[i], f[i]) for i in range(len(wflux))])
+         R = R + off
+         if not jac:  return R,None
+         # derivatives w.r.t. the free parameters: [spectrum,band,free]
+         D = self.function.deriv(self.wave)
+         dR = num.array([num.dot(wflux[i], D[:,i,:].T) \
+               for i in range(len(wflux))])
+         return R,num.dot(dR, A)
+
+      def fun(q):
+         R,dR = resps(q, False)
+         mresp = R[:,:-1]/R[:,1:]
+         return self.resp_rats[self.gids] - mresp[self.gids]
+
+      def jac(q):
+         R,dR = resps(q, True)
+         dm = (dR[:,:-1,:]*R[:,1:,num.newaxis] - \
+               R[:,:-1,num.newaxis]*dR[:,1:,:])/R[:,1:,num.newaxis]**2
+         return -dm[self.gids]
+
+      res = least_squares(fun, q0, jac=jac, bounds=(lower,upper), 
+            ftol=ftol, xtol=xtol, gtol=gtol, max_nfev=maxiter, 
+            verbose=2 if self.verbose else 0)
+      return lsq_result(res, p0 + num.dot(A, res.x))
+
    def leastsq(self, p, fjac, bands, nid):
       self.function.set_pars(p)
       mresp = self.resp_rats*0
@@ -745,7 +971,7 @@ messages = ['Bad input parameters','chi-square less than ftol',
 def mangle_spectrum2(wave,flux,bands, mags, fixed_filters=None, 
       normfilter=None, z=0, verbose=0, anchorwidth=100,
       method=None, lstsq=True, xtol=1e-6, ftol=1e-6, gtol=1e-6, 
-      init=None, **margs):
+      init=None, solver=None, **margs):
    '''Given an input spectrum, multiply by a smooth function (aka mangle)
    such that the synthetic colors match observed colors.
 
@@ -777,6 +1003,8 @@ def mangle_spectrum2(wave,flux,bands, mags, fixed_filters=None,
                     goodness of fit. See ``scipy.optimize.leastsq`` for
                     meaning of these parameters.
       init (list/array): initial values for the mangle parameters.
+      solver (str): the non-linear solver: 'lsq', 'mpfit' or 'auto'. See
+                    :meth:`mangler.solve`.
       margs (dict): All additional arguments to function are sent to 
                     the :class:`mangle_spectrum.Mangler` class.
    
@@ -806,13 +1034,13 @@ def mangle_spectrum2(wave,flux,bands, mags, fixed_filters=None,
          colors = num.where(gids, mags[:-1,:]-mags[1:,:], 99.9)
       res = m.solve(bands, colors, fixed_filters=fixed_filters,
             anchorwidth=anchorwidth, xtol=xtol, ftol=ftol, gtol=gtol,
-            init=init)
+            init=init, solver=solver)
       if res.status > 4:
          print "Warning:  %s" % messages[res.status]
       elif res.status < 0:
          print "Warning:  some unknown error occurred"
       elif verbose:
-         print "mpfit finised with:  %s" % messages[res.status]
+         print "solver finised with:  %s" % messages[res.status]
 
    # finally, normalize the flux
    mflux = m.get_mflux()
@@ -827,6 +1055,84 @@ def mangle_spectrum2(wave,flux,bands, mags, fixed_filters=None,
 
    return (mflux, m._getstate(), m.function.pars)
 
+def mangle_spectra_linear(wave, fluxes, bands, mags, normfilter=None, 
+      **margs):
+   '''Mangle a block of spectra that share the same wavelengths and the
+   same set of observed filters using the linear basis-spline method. This
+   is equivalent to calling :func:`.mangle_spectrum2` with method='bspline'
+   and lstsq=True on each spectrum, but the basis splines and the filter
+   integrations are shared, so the cost is a few matrix products for the
+   whole block plus a tiny linear least-squares problem per spectrum.
+
+   Args:
+      wave (float array):  Input wavelengths in Angstroms (1D)
+      fluxes (2d float array):  Input fluxes indexed by [spectrum,wavelength]
+      bands (list of str): list of observed filters
+      mags (2d float array): Observed magnitudes indexed by [spectrum,band].
+                             Values > 90 are ignored in the fit.
+      normfilter (str): The mangled spectra are normalized such that the
+                        synthetic magnitude through normfilter matches the
+                        observed one. Default is the last filter in bands.
+      margs (dict): All additional arguments are sent to the
+                    :class:`mangle_spectrum.f_Bspline` class.
+
+   Returns:
+      3-tuple:  (mfluxes, state, pars)
+                
+                * mfluxes:  the mangled fluxes [spectrum,wavelength]
+                * state:  dictionary of the state of the manler.
+                * pars:   parameters of the mangle function [spectrum,basis]
+   '''
+   wave = num.asarray(wave)
+   fluxes = num.asarray(fluxes)
+   if len(fluxes.shape) == 1:
+      fluxes = fluxes.reshape((1,fluxes.shape[0]))
+   mags = num.asarray(mags)
+   if len(mags.shape) == 1:
+      mags = mags.reshape((1,mags.shape[0]))
+   if mags.shape != (fluxes.shape[0], len(bands)):
+      raise ValueError, "mags must have shape (number of spectra, len(bands))"
+
+   m = mangler(wave, fluxes[0], 'bspline', normfilter=normfilter, **margs)
+   m.bands = bands
+   if normfilter is None:
+      m.normfilter = bands[-1]
+   elif normfilter not in bands:
+      raise ValueError, "normfilter must be one of the filters to be fit"
+   nid = bands.index(m.normfilter)
+   m.function.setup_basis()
+   bsp = m.function.bsp[0]
+
+   # responses of each spectrum multiplied by each basis: [spectrum,band,basis]
+   bases = []
+   for b in bands:
+      w = fset[b].response_weights(wave)
+      if w is None:
+         bases.append(num.zeros((fluxes.shape[0], bsp.shape[1])) - 1.0)
+      else:
+         bases.append(num.dot(fluxes, w[:,num.newaxis]*bsp))
+   bases = num.transpose(num.array(bases), (1,0,2))
+   bases = bases/bases.max(axis=2).max(axis=1)[:,num.newaxis,num.newaxis]
+
+   # needed responses in units of the normfilter flux
+   zps = num.array([fset[b].zp for b in bands])
+   gids = num.less(mags, 90)
+   resps = num.power(10, -0.4*(mags - zps[num.newaxis,:]))
+   resps = resps/resps[:,nid:nid+1]
+   pars = num.array([lstsq(bases[i][gids[i]], resps[i][gids[i]])[0] \
+         for i in range(fluxes.shape[0])])
+   m.function.set_pars(pars[-1])
+
+   mfluxes = fluxes*m.function.eval_pars(pars)
+
+   # finally, normalize the flux
+   nf = fset[m.normfilter]
+   resp = nf.responses(wave, mfluxes)
+   mmag = num.where(num.greater(resp, 0), 
+         -2.5*num.log10(num.absolute(resp)) + nf.zp, num.nan)
+   mfluxes = mfluxes*num.power(10, -0.4*(mags[:,nid] - mmag))[:,num.newaxis]
+   return (mfluxes, m._getstate(), pars)
+
 def apply_mangle(wave,flux, state, pars, lstsq=False, init=True, **margs):
 
    if 'method' not in margs:
@@ -6,12 +6,13 @@ classing Model and overriding the member functions.
 
 New:  Add an optional [decline_param] to choose between a dm15 model and stretch
 	  (st)	model'''
-import os,string
+import os,string,time
 from snpy import ubertemp
 from snpy import kcorr
 from snpy.utils import redlaw
+from snpy.utils import profiler
+from snpy.utils import pmap
 from numpy.linalg import cholesky
-from scipy import stats
 from scipy.optimize import leastsq
 from scipy.optimize import brent
 import scipy.interpolate
@@ -20,7 +21,6 @@ from numpy import *
 from numpy.linalg import inv
 import pickle
 
-Ia_w,Ia_f = kcorr.get_SED(0, 'H3')
 gconst = -0.5*log(2*pi)
 
 debug = 0
@@ -35,6 +35,108 @@ def _quniform_prior(p,pmin,pmax,sigma):
    if p <= pmin:  return norm*exp(-0.5*(p-pmin)**2/sigma**2)
    if p >= pmax:  return norm*exp(-0.5*(p-pmax)**2/sigma**2)
 
+def _mc_chunk(job):
+   '''Monte-Carlo draws of the distance modulus for model.mc_systematics.
+   [job] is (setup, seed, n): the same seed always gives the same draws, so
+   results do not depend on how the chunks are shared among processes.'''
+   setup,seed,n = job
+   rs = random.RandomState(seed)
+   nb = len(setup['sig'])
+   if setup['correlated']:
+      # the same deviates of a, b, c and the scatter in every filter
+      u = tile(rs.normal(size=(n,3)), (1,nb))
+   else:
+      u = rs.normal(size=(n,3*nb))
+   theta = setup['theta'] + u*setup['etheta']
+   M = dot(theta, transpose(setup['D']))
+   Rv = setup['Rv'] + setup['eRv']*rs.normal(size=n)
+   R = transpose(array([interp(Rv, setup['Rvs'], Rt) for Rt in setup['Rtab']]))
+   if setup['correlated']:
+      eps = rs.normal(size=(n,1))*setup['sig']
+   else:
+      eps = rs.normal(size=M.shape)*setup['sig']
+   dDM = (setup['M0'] - M) + setup['EBVhost']*(setup['R0'] - R) - eps
+   DM = setup['DM'] + dot(dDM, setup['w'])
+   if setup['Ho_err'] > 0:
+      DM = DM + 2.17*setup['Ho_err']*rs.normal(size=n)
+   return DM,Rv
+
+def _leastsq_start(pars):
+   '''Run leastsq from the starting parameters [pars] (a multi-start worker,
+   with state (model, bands, error)). Returns the output of leastsq, or the
+   error if the model failed.'''
+   m,bands,error = pmap.get_state()
+   try:
+      return leastsq(m._wrap_model, pars, (bands,error), full_output=1)
+   except RuntimeError, e:
+      return e
+
+def _grid_chunk(nodes):
+   '''Evaluate the grid nodes [nodes] (a list of index tuples) for
+   model.evaluate_grid (a grid worker, with state (model, bands, error,
+   job)).'''
+   m,bands,error,job = pmap.get_state()
+   return m._grid_chunk(nodes, bands, error, job)
+
+def _serpentine(shape):
+   '''The indices of a grid of shape [shape] in boustrophedon order, so
+   that consecutive nodes are always neighbours.'''
+   nodes = []
+   for idx in ndindex(*shape):
+      node = list(idx)
+      for k in range(1, len(shape)):
+         if sum(node[:k]) % 2:
+            node[k] = shape[k] - 1 - idx[k]
+      nodes.append(tuple(node))
+   return nodes
+
+class kcorr_evaluator:
+   '''Evaluates the k-corrections of one filter during a fit. The end values
+   of the spline and the map from epoch to nearest observation (whose mask
+   tells whether the k-correction is valid) are computed once, so that each
+   call costs O(N) rather than the O(N^2) of a brute-force nearest-neighbour
+   search.
+
+   Args:
+      tck (tuple): spline representation of the k-corrections (sn.ks_tck)
+      mask (bool array): valid k-corrections of the observations (sn.ks_mask)
+      MJD (float array): epochs of the observations
+   '''
+
+   def __init__(self, tck, mask, MJD):
+      self.tck = tck
+      self.mask = mask
+      self.MJD = MJD
+      knots,coefs,k = tck
+      self.tmin,self.tmax = knots[0],knots[-1]
+      if k == 1:
+         # A linear spline is just linear interpolation between its knots
+         # (and interp() clamps at the ends, as we want)
+         self.x = asarray(knots[1:-1])
+         self.y = asarray(coefs[:len(self.x)])
+      else:
+         self.x = None
+         self.k0,self.k1 = scipy.interpolate.splev([self.tmin,self.tmax], tck)
+      # Epochs are mapped to the nearest (first, if repeated) observation
+      # by bisecting the mid-points between distinct epochs.
+      uMJD,self.ids = unique(MJD, return_index=True)
+      self.bounds = 0.5*(uMJD[1:] + uMJD[:-1])
+
+   def uses(self, tck, mask, MJD):
+      '''Was this evaluator built from these (same objects) inputs?'''
+      return tck is self.tck and mask is self.mask and MJD is self.MJD
+
+   def __call__(self, t):
+      '''Return the k-corrections at epochs [t] (same frame as MJD) and
+      the mask of the nearest observation.'''
+      t = asarray(t)
+      if self.x is not None:
+         K = interp(t, self.x, self.y)
+      else:
+         K = scipy.interpolate.splev(t, self.tck)
+         K = where(less(t, self.tmin), self.k0, K)
+         K = where(greater(t, self.tmax), self.k1, K)
+      return K,self.mask[self.ids[searchsorted(self.bounds, t)]]
 
 class model:
    '''The base class for SNooPy light-curve models. It contains the parameters
@@ -62,6 +164,13 @@ class model:
 	  self.args = {}
 	  self.MWRobs = {}
 
+   def __getstate__(self):
+	  # The caches are not saved: they are keyed by object ids.
+	  d = self.__dict__.copy()
+	  for key in ['_kevals','_max_cache','_peak_cache','_scan_cache']:
+		 d.pop(key, None)
+	  return d
+
    def guess(self, param):
 	  '''A function that is run and picks initial guesses for
 	  the parameter.
@@ -105,23 +214,29 @@ class model:
 
 	  # If k-corrections are there, use them
 	  if band in self.parent.ks_tck:   
-		 tck = self.parent.ks_tck[band]
-		 K = scipy.interpolate.splev(t+self.Tmax, tck)
-		 k0 = scipy.interpolate.splev(tck[0][0], tck)
-		 k1 = scipy.interpolate.splev(tck[0][-1], tck)
-		 K = where(less(t+self.Tmax, tck[0][0]), k0, K)
-		 K = where(greater(t+self.Tmax, tck[0][-1]), k1, K)
-		 mids = argmin(absolute(t[:,newaxis]-self.parent.data[band].MJD[newaxis,:]+\
-			   self.Tmax), axis=1)
+		 K,mask = self.kcorr_evaluator(band)(t+self.Tmax)
 		 # mask based on original mask and limits of Hsiao spectrum
 		 ks_st = getattr(self.parent, 'ks_s', 1.0)
-		 mask2 = self.parent.ks_mask[band][mids]*\
-			   greater_equal(t/ks_st, -19)*less_equal(t/ks_st, 70)
+		 mask2 = mask*greater_equal(t/ks_st, -19)*less_equal(t/ks_st, 70)
 	  else:
 		 K = 0*t
 		 mask2 = ones(t.shape, dtype=bool)
 	  return K,mask2
 
+   def kcorr_evaluator(self, band):
+	  '''Return the kcorr_evaluator of the parent's k-corrections in [band].
+	  It is built once and only re-built when the k-corrections, their mask
+	  or the photometry of the filter are replaced.'''
+	  tck = self.parent.ks_tck[band]
+	  mask = self.parent.ks_mask[band]
+	  MJD = self.parent.data[band].MJD
+	  kevals = self.__dict__.setdefault('_kevals', {})
+	  kev = kevals.get(band, None)
+	  if kev is None or not kev.uses(tck, mask, MJD):
+		 kev = kcorr_evaluator(tck, mask, MJD)
+		 kevals[band] = kev
+	  return kev
+
    def MWR(self, band, t):
 	  '''Determine the best :math:`R_\lambda` for the foreground MW extinction.
 	  
@@ -151,7 +266,7 @@ class model:
    def _extra_error(self, parameters):
 	  return 0
 
-   def fit(self, bands, epsfcn=0, **args):
+   def fit(self, bands, epsfcn=0, multistart=0, processes=1, **args):
 	  '''Fit the model with currently fixed and free parameters againts the
 	  set of bands [bands].	 All other arguments are passed directly to
 	  the model() member function as optional arguments.  After running,
@@ -161,6 +276,11 @@ class model:
 	  Args:
 		 bands (list of str): The filters to fit
 		 epsfcn (float): see scipy.optmize.leastsq.
+		 multistart (int): If > 0, also start the fit from the [multistart]
+						   best points of a chi-square scan over Tmax and
+						   the shape parameter (see grid_starts()) and keep
+						   the best solution.
+		 processes (int): number of processes for the multi-start fits.
 		 
 	  Returns:
 		 None
@@ -208,9 +328,18 @@ class model:
 	  for band in bands:
 		 error[band] = self.parent.data[band].get_covar(flux=1)
 
-	  pars,C,self.info,self.mesg,self.ier = \
-			leastsq(self._wrap_model, pars, (bands,error), full_output=1)
+	  t0 = time.time()
+	  if multistart > 0:
+		 pars,C,self.info,self.mesg,self.ier = self._multistart(pars, bands,
+			   error, multistart, processes)
+	  else:
+		 pars,C,self.info,self.mesg,self.ier = \
+			   leastsq(self._wrap_model, pars, (bands,error), full_output=1)
 	  if self.ier > 4:	print self.mesg
+	  prof = profiler.active()
+	  if prof is not None:
+		 prof.add_fit(bands, self.info['nfev'], time.time() - t0,
+			   ier=self.ier, model=self.__class__.__name__)
 	  
 	  self.chisquare = sum(power(self.info['fvec'], 2))
 	  self.dof = len(self.info['fvec']) - len(self._free)
@@ -239,6 +368,251 @@ class model:
 		 for j in range(len(self._free)):
 			self.C[self._free[i]][self._free[j]] = C[i,j]
 
+   def _multistart(self, pars, bands, error, nstart, processes=1):
+	  '''Run leastsq from [pars] and from the starts found by grid_starts()
+	  and return the output of the fit with the lowest chi-square, preferring
+	  fits that converged.'''
+	  starts = [pars] + self.grid_starts(bands, pars, nstart)
+	  fits = pmap.pmap(_leastsq_start, starts, processes, (self, bands, error))
+	  good = [f for f in fits if not isinstance(f, Exception)]
+	  if not good:
+		 raise fits[0]
+	  good.sort(key=lambda f: (f[4] not in [1,2,3,4],
+								sum(power(f[2]['fvec'],2))))
+	  best = good[0]
+	  # leave the model in the state of the best fit
+	  self._wrap_model(best[0], bands, error)
+	  return best
+
+   def grid_starts(self, bands, pars, nstart=4, Trange=15., dT=1.0,
+		 shapes=None):
+	  '''Starting points for the fit from a coarse chi-square scan over Tmax
+	  and the shape parameter (st or dm15). For each point of the grid, the
+	  template is evaluated for all the observations in [bands] at once and
+	  a free magnitude offset is solved for in each filter (absorbing DM,
+	  extinction, etc.), so only the shape of the light-curves matters.
+	  Observations where the template is not defined count as 3-sigma
+	  outliers. Template evaluations are cached by shape parameter.
+
+	  Args:
+		 bands (list of str): the filters being fit
+		 pars (list of float): the current values of the free parameters
+		 nstart (int): maximum number of starting points
+		 Trange,dT (float): Tmax is scanned in steps of dT (days) from
+							Trange before to Trange after both the current
+							value and guess('Tmax')
+		 shapes (float array): shape parameters to scan
+
+	  Returns:
+		 list: up to [nstart] lists of starting parameters, the best first.
+			   Empty if Tmax or the shape parameter is not free or the
+			   model has no template.
+	  '''
+	  stype = getattr(self, 'stype', None)
+	  if stype is None or 'template' not in self.__dict__ or \
+			'Tmax' not in self._free or stype not in self._free:
+		 return []
+	  iT = self._free.index('Tmax')
+	  iS = self._free.index(stype)
+	  if shapes is None:
+		 if stype == 'st':
+			shapes = arange(0.5, 1.41, 0.1)
+		 else:
+			shapes = arange(0.7, 2.01, 0.1)
+	  T0s = [pars[iT], self.guess('Tmax')]
+	  Tmaxs = arange(min(T0s) - Trange, max(T0s) + Trange + dT/2, dT)
+	  p = self.parent
+	  gen = self.gen
+	  tkey = (self.template.__class__.__module__,
+			self.template.__class__.__name__, gen, p.z)
+	  cache = self.__dict__.setdefault('_scan_cache', {})
+	  if len(cache) > 1000:  cache.clear()
+	  chi2 = zeros((len(shapes),len(Tmaxs)))
+	  for band in bands:
+		 d = p.data[band]
+		 rband = p.restbands[band]
+		 m = d.mask
+		 MJD,mag,emag = d.MJD[m],d.mag[m],d.e_mag[m]
+		 if band in p.ks_tck:
+			mag = mag - self.kcorr_evaluator(band)(MJD)[0]
+		 t = ravel(MJD[newaxis,:] - Tmaxs[:,newaxis])
+		 # the templates need sorted epochs
+		 ids = argsort(t)
+		 for i,shape in enumerate(shapes):
+			key = tkey + (float(shape), rband, MJD.tostring(),
+				  Tmaxs.tostring())
+			if key not in cache:
+			   self.template.mktemplate(shape)
+			   res = self.template.eval(rband, t[ids], p.z, gen=gen)
+			   cache[key] = []
+			   for x in res:
+				  y = empty(x.shape, dtype=x.dtype)
+				  y[ids] = x
+				  cache[key].append(reshape(y, (len(Tmaxs),-1)))
+			temp,etemp,tmask = cache[key]
+			w = where(tmask, 1.0/(emag**2 + etemp**2), 0)
+			r = where(tmask, mag - temp, 0)
+			off = sum(w*r, axis=1)/maximum(sum(w, axis=1), 1e-30)
+			chi2[i] += sum(w*(r - off[:,newaxis])**2, axis=1) + \
+				  9*sum(logical_not(tmask), axis=1)
+	  # best points, at least 2 grid steps apart
+	  starts = []
+	  chosen = []
+	  for k in argsort(ravel(chi2)):
+		 i,j = divmod(k, len(Tmaxs))
+		 if [1 for (i0,j0) in chosen if abs(i-i0) < 2 and abs(j-j0) < 2]:
+			continue
+		 chosen.append((i,j))
+		 start = list(pars)
+		 start[iT] = Tmaxs[j]
+		 start[iS] = shapes[i]
+		 starts.append(start)
+		 if len(starts) >= nstart:  break
+	  return starts
+
+   def evaluate_grid(self, params, values, bands=None, profile=True,
+		 processes=1):
+	  '''Evaluate the chi-square of the fit on a grid of parameter values.
+	  At each node of the grid, [params] are held at the node's values and,
+	  if [profile] is True, the other free parameters of the last fit are
+	  optimized (a profile likelihood), starting from the solution at the
+	  previous node. The nodes are visited in boustrophedon order so that
+	  consecutive nodes are neighbours. The model must have been fit first
+	  and its parameters are left unchanged. The results are also stored
+	  in the parent's grids dictionary, keyed by tuple(params).
+
+	  Args:
+		 params (list of str): the parameters spanning the grid
+		 values (list of arrays): the values of each parameter in [params]
+		 bands (list of str): the filters to use (default: those of the
+							  last fit)
+		 profile (bool): If True, optimize the other free parameters at
+						 each node. Otherwise, they are held at their
+						 current values.
+		 processes (int): number of worker processes. The grid is split
+						  into this many chunks, each started from the
+						  current parameters.
+
+	  Returns:
+		 dict: 'params' and 'values' (the grid axes), 'chisq' and 'dchisq'
+			   (chi-square and chi-square minus the lowest of the fit, over
+			   [bands], and the grid) arrays with one axis per parameter,
+			   'free' (the optimized parameters), 'pars' (their values at
+			   each node, keyed by parameter) and 'ier' (the leastsq
+			   status at each node, -1 if the model could not be
+			   evaluated).
+	  '''
+	  if isinstance(params, str):  params = [params]
+	  params = list(params)
+	  values = [atleast_1d(asarray(v, dtype=float)) for v in values]
+	  if len(params) != len(values):
+		 raise ValueError, "params and values must have the same length"
+	  for p in params:
+		 if p not in self.parameters:
+			raise ValueError, "%s is not a parameter of this model" % p
+	  if not self._fbands:
+		 raise RuntimeError, "You need to fit the model first"
+	  if bands is None:  bands = self._fbands
+	  for b in bands:
+		 if b not in self._fbands:
+			raise ValueError, "band %s was not in the last fit" % b
+	  error = {}
+	  for band in bands:
+		 error[band] = self.parent.data[band].get_covar(flux=1)
+	  free = [p for p in self._free if p not in params]
+	  start = []
+	  for p in free:
+		 if self.parameters[p] is None:
+			start.append(self.guess(p))
+		 else:
+			start.append(self.parameters[p])
+	  job = {'params':params, 'values':values, 'free':free, 'start':start,
+			 'profile':profile}
+	  shape = tuple([len(v) for v in values])
+	  nodes = _serpentine(shape)
+	  nchunk = max(1, min(processes, len(nodes)))
+	  chunks = [[nodes[i] for i in ids] for ids in \
+			array_split(arange(len(nodes)), nchunk)]
+
+	  saved = self.parameters.copy()
+	  saved_free = self._free
+	  try:
+		 res = pmap.pmap(_grid_chunk, chunks, nchunk,
+			   (self, bands, error, job))
+	  finally:
+		 self.parameters.update(saved)
+		 self._free = saved_free
+
+	  chisq = zeros(shape)
+	  ier = zeros(shape, dtype=int)
+	  pars = dict([(p, zeros(shape)) for p in free])
+	  for chunk,(c,x,e) in zip(chunks, res):
+		 for k,node in enumerate(chunk):
+			chisq[node] = c[k]
+			ier[node] = e[k]
+			for j,p in enumerate(free):
+			   pars[p][node] = x[k][j]
+	  cmin = chisq[isfinite(chisq)].min() if sometrue(isfinite(chisq)) \
+			else inf
+	  if 'chisquare' in self.__dict__:
+		 if set(bands) == set(self._fbands):
+			cmin = min(cmin, self.chisquare)
+		 else:
+			# the chi-square of the fit over these bands only
+			try:
+			   fvec = self._wrap_model([saved[p] for p in saved_free], 
+					 bands, error)
+			   cmin = min(cmin, sum(power(fvec, 2)))
+			except RuntimeError:
+			   pass
+			self.parameters.update(saved)
+	  result = {'params':params, 'values':values, 'chisq':chisq,
+				'dchisq':chisq - cmin, 'free':free, 'pars':pars, 'ier':ier,
+				'bands':list(bands), 'profile':profile}
+	  self.parent.__dict__.setdefault('grids', {})[tuple(params)] = result
+	  return result
+
+   def _grid_chunk(self, nodes, bands, error, job):
+	  '''Evaluate the grid [nodes] in order, each profile fit starting from
+	  the last one that converged. Returns lists of chi-square, parameters
+	  and leastsq status.'''
+	  params,values,free = job['params'],job['values'],job['free']
+	  self._free = free
+	  start = list(job['start'])
+	  chisq,pars,ier = [],[],[]
+	  for node in nodes:
+		 for j,p in enumerate(params):
+			self.parameters[p] = values[j][node[j]]
+		 try:
+			if free and job['profile']:
+			   x,C,info,mesg,status = leastsq(self._wrap_model, start,
+					 (bands,error), full_output=1)
+			   x = atleast_1d(x)
+			   fvec = info['fvec']
+			else:
+			   x,status = array(start),1
+			   fvec = self._wrap_model(start, bands, error)
+		 except RuntimeError:
+			chisq.append(inf)
+			pars.append([nan]*len(free))
+			ier.append(-1)
+			continue
+		 chisq.append(sum(power(fvec, 2)))
+		 pars.append(list(x))
+		 ier.append(status)
+		 if status in [1,2,3,4]:  start = list(x)
+	  return chisq,pars,ier
+
+   def profile(self, param, values, **args):
+	  '''The profile likelihood of parameter [param]: the chi-square at each
+	  value in [values] with the other free parameters optimized. Other
+	  arguments are passed to evaluate_grid().
+
+	  Returns:
+		 dict: see evaluate_grid().
+	  '''
+	  return self.evaluate_grid([param], [values], **args)
+
    def covar(self, band, t):
 	  return zeros((t.shape[0],t.shape[0]))
 
@@ -256,6 +630,102 @@ class model:
 				for it.'''
 	  raise NotImplementedError('Derived class must overide')
 
+   def mc_systematics(self, N=10000, seed=None, processes=1, chunk=2000,
+		 calibration=None, include_Ho=False, Ho_err=0.1, nRv=11,
+		 correlated=True):
+	  '''Compute the systematic error in the distance modulus by Monte-Carlo
+	  propagation of the calibration errors: the coefficients of the
+	  peak-magnitude relations, Rv of the host and, optionally, Ho are drawn
+	  from their errors along with the intrinsic scatter of each filter and
+	  MMax, R_obs and DM are recomputed for each draw. The draws are
+	  vectorized and done in chunks, each with its own seeded random
+	  stream, optionally spread over several processes.
+
+	  By default, the errors in the coefficients and the scatter are drawn
+	  coherently across the filters, so that averaging the filters does not
+	  beat them down. This follows systematics(), which takes the weighted
+	  mean of the per-filter variances, and agrees with it when the errors
+	  are the same in every filter.
+
+	  Args:
+		 N (int): number of draws
+		 seed (int): seed of the random streams (None for a random seed).
+					 The results do not depend on [processes].
+		 processes (int): number of processes to use
+		 chunk (int): number of draws per chunk (one random stream each)
+		 calibration (int): the calibration to use (default: the one
+							used in the fit)
+		 include_Ho (bool): If True, include the error in Ho
+		 Ho_err (float): fractional error in Ho
+		 nRv (int): number of values of Rv at which R_obs is computed
+					(and interpolated for each draw)
+		 correlated (bool): If True, the deviates of the coefficients and
+							the scatter are the same in every filter. If
+							False, they are independent from filter to
+							filter, which gives a smaller error.
+
+	  Returns:
+		 dict: systematic errors keyed by parameter, as systematics(), but
+			   with DM from the draws. The draws are kept in
+			   self.mc_samples.
+	  '''
+	  setup = self._mc_setup(calibration, include_Ho and Ho_err or 0, nRv)
+	  setup['correlated'] = correlated
+	  nchunk = int(ceil(float(N)/chunk))
+	  seeds = random.RandomState(seed).randint(0, 2**31-1, size=nchunk)
+	  jobs = [(setup, seeds[i], min(chunk, N - i*chunk)) for i in range(nchunk)]
+	  res = pmap.pmap(_mc_chunk, jobs, processes)
+	  self.mc_samples = {'DM':concatenate([r[0] for r in res]),
+						 'Rv':concatenate([r[1] for r in res])}
+	  systs = self.systematics(calibration=setup['calibration'],
+			include_Ho=include_Ho)
+	  systs['DM'] = std(self.mc_samples['DM'])
+	  return systs
+
+   def _mc_setup(self, calibration, Ho_err, nRv):
+	  '''Everything _mc_chunk needs for models calibrated with read_table():
+	  MMax = a + b*delta + c*delta**2 in each filter.'''
+	  for att in ['a','ea','b','eb','c','ec','Rv_host','eRv_host','sigSN']:
+		 if att not in self.__dict__:
+			raise NotImplementedError, \
+				  "Monte-Carlo systematics are not available for this model"
+	  if calibration is None:
+		 calibration = getattr(self, 'calibration', 0)
+	  if getattr(self, 'stype', 'dm15') == 'st':
+		 delta = self.st - 1.0
+	  else:
+		 delta = self.dm15 - 1.1
+	  p = self.parent
+	  Rv,eRv = self.Rv_host[calibration],self.eRv_host[calibration]
+	  Rvs = Rv + eRv*linspace(-5, 5, nRv)
+	  rbs = [p.restbands[band] for band in self._fbands]
+	  nb = len(rbs)
+	  theta = []; etheta = []
+	  D = zeros((nb, 3*nb))
+	  weights = []; Rtab = []; sig = []
+	  for i,band in enumerate(self._fbands):
+		 rb = rbs[i]
+		 theta += [self.a[calibration][rb], self.b[calibration][rb],
+				   self.c[calibration][rb]]
+		 etheta += [self.ea[calibration][rb], self.eb[calibration][rb],
+					self.ec[calibration][rb]]
+		 D[i,3*i:3*i+3] = [1, delta, delta**2]
+		 sig.append(self.sigSN[calibration][rb])
+		 # weight each filter as systematics() does
+		 mod,err,mask = self.__call__(band, p.data[band].MJD)
+		 weights.append(sum(where(mask, power(err,-2), 0)))
+		 Rtab.append([kcorr.R_obs(band, p.z, 0, self.EBVhost, p.EBVgal, R,
+			   p.Rv_gal, p.k_version, redlaw=p.redlaw) for R in Rvs])
+	  theta = array(theta)
+	  weights = array(weights)
+	  Rtab = array(Rtab)
+	  return {'calibration':calibration, 'theta':theta,
+			  'etheta':array(etheta), 'D':D, 'M0':dot(D, theta),
+			  'Rv':Rv, 'eRv':eRv, 'Rvs':Rvs, 'Rtab':Rtab,
+			  'R0':array([interp(Rv, Rvs, Rt) for Rt in Rtab]),
+			  'EBVhost':self.EBVhost, 'sig':array(sig),
+			  'w':weights/sum(weights), 'DM':self.DM, 'Ho_err':Ho_err}
+
    def get_max(self, bands, restframe=0, deredden=0):
 	  '''Get the maxima of the light-curves, given the current state of
 	  the model.
@@ -277,9 +747,107 @@ class model:
 		 * eMmax (list of floats): errors in maximum magnitudes
 		 * restbands (list of str): The rest-bands used to fit each observed
 									filter
+
+	  The results are cached, keyed by the parameters (and errors) of the
+	  model and the state of the parent that they depend on, so repeated
+	  calls with an unchanged model are free. Derived classes should
+	  implement _get_max().
    '''
+	  key,refs = self._max_key(bands, restframe, deredden)
+	  cache = self.__dict__.setdefault('_max_cache', {})
+	  if key not in cache:
+		 if len(cache) > 100:  cache.clear()
+		 # refs keeps the objects whose ids are in the key alive
+		 cache[key] = (refs, self._get_max(bands, restframe, deredden))
+	  return tuple([list(res) for res in cache[key][1]])
+
+   def _get_max(self, bands, restframe=0, deredden=0):
+	  '''Compute what get_max() returns.'''
 	  raise NotImplementedError('Derived class must overide')
 
+   def _max_key(self, bands, restframe, deredden):
+	  '''The state that get_max() depends on, as (key, refs). The spline
+	  representations of k-corrections and reddening coefficients are
+	  identified by their ids, so the objects are returned in refs.'''
+	  p = self.parent
+	  if type(bands) is str:  bands = [bands]
+	  refs = []
+	  for band in bands:
+		 refs.append(p.ks_tck.get(band, None))
+		 refs.append(p.Robs.get(band, None))
+	  Rv_host = getattr(self, 'Rv_host', None)
+	  if type(Rv_host) is dict:  Rv_host = sorted(Rv_host.items())
+	  key = repr((list(bands), restframe, deredden,
+			sorted(self.parameters.items()), sorted(self.errors.items()),
+			[p.restbands[band] for band in bands], p.z, p.EBVgal,
+			p.Rv_gal, p.k_version, getattr(p, 'redlaw', None),
+			getattr(self, 'gen', None), getattr(self, 'calibration', None),
+			getattr(self, 'do_Robs', None), Rv_host, [id(r) for r in refs]))
+	  return key,refs
+
+   def template_peaks(self, rbands, shape, tmin=-15., tmax=15., dt=0.5,
+		 tol=1e-6):
+	  '''Find where the template with shape parameter [shape] (dm15 or st)
+	  peaks in each of [rbands]. All the bands are evaluated on one coarse
+	  grid of epochs and the minima (in magnitudes) are then refined together
+	  on successively finer grids and with a final parabolic step. The peaks
+	  are cached by template, shape and band.
+
+	  Args:
+		 rbands (list of str): rest-frame filters
+		 shape (float): the shape parameter of the template
+		 tmin,tmax,dt (float): the coarse grid of epochs (days from Tmax)
+		 tol (float): the precision of the peaks in days
+
+	  Returns:
+		 float array: the epoch of the peak in each of [rbands]
+	  '''
+	  gen = self.gen
+	  tkey = (self.template.__class__.__module__,
+			self.template.__class__.__name__, float(shape), gen)
+	  cache = self.__dict__.setdefault('_peak_cache', {})
+	  todo = [b for b in set(rbands) if tkey+(b,) not in cache]
+	  if todo:
+		 if len(cache) > 1000:  cache.clear()
+		 self.template.mktemplate(shape)
+		 def mags(x):
+			# template magnitudes of the todo bands at epochs x[i,:]
+			res = []
+			for i,b in enumerate(todo):
+			   m,em,mask = self.template.eval(b, x[i], gen=gen)
+			   res.append(where(mask, m, inf))
+			return array(res)
+		 t = arange(tmin, tmax+dt/2, dt)
+		 M = mags(array([t]*len(todo)))
+		 ids = argmin(M, axis=1)
+		 inside = (ids > 0) & (ids < len(t)-1)
+		 ids = clip(ids, 1, len(t)-2)
+		 x0 = t[ids]
+		 # zoom in: a finer grid spanning the bracket around each minimum
+		 # (the templates can have kinks, so no pure parabolic search)
+		 rows = arange(len(todo))
+		 h = dt
+		 while h > tol:
+			h = h/4
+			x = x0[:,newaxis] + h*arange(-4,5)
+			M = mags(x)
+			ids = clip(argmin(M, axis=1), 1, 7)
+			x0 = x[rows,ids]
+		 # a final parabolic step, kept only where it improves the minimum
+		 fm,f0,fp = M[rows,ids-1],M[rows,ids],M[rows,ids+1]
+		 denom = fm - 2*f0 + fp
+		 ok = isfinite(denom) & greater(denom, 0)
+		 x1 = x0 + where(ok, clip(0.5*h*(fm - fp)/where(ok, denom, 1), -h, h), 0)
+		 f1 = mags(x1[:,newaxis])[:,0]
+		 x0 = where(less(f1, f0), x1, x0)
+		 for i,b in enumerate(todo):
+			if not inside[i]:
+			   # minimum at the edge of the grid, fall back on brent
+			   x0[i] = brent(lambda x: self.template.eval(b, x, gen=gen)[0],
+					 brack=(0.,5.))
+			cache[tkey+(b,)] = x0[i]
+	  return array([cache[tkey+(b,)] for b in rbands])
+
    def _wrap_model(self, pars, bands, error):
 	  resids_list = []
 	  sum_w = 0
@@ -467,16 +1035,17 @@ class EBV_model(model):
 
 	  return temp,etemp,mask*mask2
 
-   def get_max(self, bands, restframe=0, deredden=0):
+   def _get_max(self, bands, restframe=0, deredden=0):
 	  Tmaxs = []
 	  Mmaxs = []
 	  eMmaxs = []
 	  rbands = []
-	  self.template.mktemplate(self.dm15)
-	  for band in bands:
+	  # find where the template truly peaks:
+	  x0s = self.template_peaks([self.parent.restbands[band] for band in bands],
+			self.dm15)
+	  for i,band in enumerate(bands):
 		 rband = self.parent.restbands[band]
-		 # find where the template truly peaks:
-		 x0 = brent(lambda x: self.template.eval(rband, x, gen=self.gen)[0], brack=(0.,5.))
+		 x0 = x0s[i]
 		 Tmaxs.append(x0 + self.Tmax)
 		 mmax = self.DM + self.MMax(rband, self.calibration)
 		 if not restframe and band in self.parent.ks_tck:
@@ -702,16 +1271,17 @@ class EBV_model2(model):
 	  temp = temp + self.DM + self.MMax(rband, self.calibration)
 	  return temp,etemp,mask*mask2
 
-   def get_max(self, bands, restframe=0, deredden=0):
+   def _get_max(self, bands, restframe=0, deredden=0):
 	  Tmaxs = []
 	  Mmaxs = []
 	  eMmaxs = []
 	  rbands = []
-	  self.template.mktemplate(self.parameters[self.stype])
-	  for band in bands:
+	  # find where the template truly peaks:
+	  x0s = self.template_peaks([self.parent.restbands[band] for band in bands],
+			self.parameters[self.stype])
+	  for i,band in enumerate(bands):
 		 rband = self.parent.restbands[band]
-		 # find where the template truly peaks:
-		 x0 = brent(lambda x: self.template.eval(rband, x, gen=self.gen)[0], brack=(0.,5.))
+		 x0 = x0s[i]
 		 Tmaxs.append(x0 + self.Tmax)
 		 mmax = self.DM + self.MMax(rband, self.calibration)
 		 if not restframe and band in self.parent.ks_tck:
@@ -918,16 +1488,17 @@ class max_model(model):
 	  temp = temp + R*self.parent.EBVgal
 	  return temp,etemp,mask*mask2
 
-   def get_max(self, bands, restframe=0, deredden=0):
+   def _get_max(self, bands, restframe=0, deredden=0):
 	  Tmaxs = []
 	  Mmaxs = []
 	  eMmaxs = []
 	  rbands = []
-	  self.template.mktemplate(self.parameters[self.stype])
-	  for band in bands:
+	  # find where the template truly peaks:
+	  x0s = self.template_peaks([self.parent.restbands[band] for band in bands],
+			self.parameters[self.stype])
+	  for i,band in enumerate(bands):
 		 rband = self.parent.restbands[band]
-		 # find where the template truly peaks:
-		 x0 = brent(lambda x: self.template.eval(rband, x, gen=self.gen)[0], brack=(0.,5.))
+		 x0 = x0s[i]
 		 Tmaxs.append(x0 + self.Tmax)
 		 if rband+"max" not in self.parameters:
 			raise ValueError, "Trying to find max of %s, but haven't solved for %s" %\
@@ -1109,16 +1680,17 @@ class max_model2(model):
 	  temp = temp + R*self.parent.EBVgal
 	  return temp,etemp,mask*mask2
 
-   def get_max(self, bands, restframe=0, deredden=0):
+   def _get_max(self, bands, restframe=0, deredden=0):
 	  Tmaxs = []
 	  Mmaxs = []
 	  eMmaxs = []
 	  rbands = []
-	  self.template.mktemplate(self.parameters[self.stype])
-	  for band in bands:
+	  # find where the template truly peaks:
+	  x0s = self.template_peaks([self.parent.restbands[band] for band in bands],
+			self.parameters[self.stype])
+	  for i,band in enumerate(bands):
 		 rband = self.parent.restbands[band]
-		 # find where the template truly peaks:
-		 x0 = brent(lambda x: self.template.eval(rband, x, gen=self.gen)[0], brack=(0.,5.))
+		 x0 = x0s[i]
 		 if rband+"max" not in self.parameters:
 			raise ValueError, "Trying to find max of %s, but haven't solved for %s" %\
 				  (band, rband+"max")
@@ -1300,16 +1872,17 @@ class Rv_model(model):
 			self.MMax('B', self.calibration)
 	  return temp,etemp,mask*mask2
 
-   def get_max(self, bands, restframe=0, deredden=0):
+   def _get_max(self, bands, restframe=0, deredden=0):
 	  Tmaxs = []
 	  Mmaxs = []
 	  eMmaxs = []
 	  rbands = []
-	  self.template.mktemplate(self.dm15)
-	  for band in bands:
+	  # find where the template truly peaks:
+	  x0s = self.template_peaks([self.parent.restbands[band] for band in bands],
+			self.dm15)
+	  for i,band in enumerate(bands):
 		 rband = self.parent.restbands[band]
-		 # find where the template truly peaks:
-		 x0 = brent(lambda x: self.template.eval(rband, x, gen=self.gen)[0], brack=(0.,5.))
+		 x0 = x0s[i]
 		 Tmaxs.append(x0 + self.Tmax)
 		 mmax = self.Bmax + self.MMax(rband, self.calibration) - \
 			   self.MMax('B', self.calibation)
@@ -1537,16 +2110,17 @@ class color_model(model):
 	  
 	  return temp,etemp,mask*mask2
 
-   def get_max(self, bands, restframe=0, deredden=0):
+   def _get_max(self, bands, restframe=0, deredden=0):
 	  Tmaxs = []
 	  Mmaxs = []
 	  eMmaxs = []
 	  rbands = []
-	  self.template.mktemplate(self.dm15)
-	  for band in bands:
+	  # find where the template truly peaks:
+	  x0s = self.template_peaks([self.parent.restbands[band] for band in bands],
+			self.dm15)
+	  for i,band in enumerate(bands):
 		 rband = self.parent.restbands[band]
-		 # find where the template truly peaks:
-		 x0 = brent(lambda x: self.template.eval(rband, x, gen=self.gen)[0], brack=(0.,5.))
+		 x0 = x0s[i]
 		 Tmaxs.append(x0 + self.Tmax)
 		 mmax = self.Bmax + self.MMax(rband, self.calibration) - \
 			   self.MMax('B', self.calibation)
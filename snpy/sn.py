@@ -7,28 +7,33 @@ if 'SQLSERVER' in os.environ:
    sqlmod.setSQL(os.environ['SQLSERVER'])
 have_sql = sqlmod.have_sql
 
-try:
-   import snemcee
-except ImportError:
+from utils.lazy import lazy_import, available
+# The MCMC and plotting modules are slow to import, so they are only
+# loaded when first used.
+if available('emcee'):
+   snemcee = lazy_import('snpy.snemcee')
+else:
    snemcee = None
 
-try:
-   import corner as triangle
-except ImportError:
+if available('corner'):
+   triangle = lazy_import('corner')
+else:
    triangle=None
 
 import types
 import time
-import plot_sne_mpl as plotmod
+plotmod = lazy_import('snpy.plot_sne_mpl')
 from lc import lc           # the light-curve class
 from numpy import *       # Vectors
 # HACK D. Jones
 import NIR_ubertemp as ubertemp            # a template class that contains these two
 import kcorr                # Code for generating k-corrections
 import bolometric
+import fitstore            # SQLite store of fit results
 import utils.IRSA_dust_getval as dust_getval
 
 from utils import fit_poly  # polynomial fitter
+from utils import profiler  # opt-in timing of the fitting stages
 import scipy                # Scientific python routines
 linalg = scipy.linalg       # Several linear algebra routines
 from scipy.interpolate import interp1d
@@ -45,7 +50,10 @@ from version import __version__
 # Some useful functions in other modules which the interactive user may want:
 getSED = kcorr.get_SED
 Robs = kcorr.R_obs
-Ia_w,Ia_f = getSED(0, 'H3')
+def Ia_SED():
+   '''The Hsiao (H3) SED at maximum light, as (wave, flux). Used for
+   effective wavelengths and reddening coefficients.'''
+   return getSED(0, 'H3')
 Vega = standards.Vega.VegaB
 BD17 = standards.Smith.bd17
 
@@ -55,6 +63,95 @@ def myupdate(d1, d2):
       if key in d2:
          d1[key] = d2[key]
 
+# The rest-frame filters chosen by sn.closest_band(), keyed by (observed
+# filter, template filters, redshift). The cache is shared by all the SN
+# objects of a process (and inherited by forked workers). By default, the
+# key is the exact redshift, so the cache never changes which filter is
+# chosen. See set_restband_dz() to bin the redshifts instead.
+restband_dz = 0
+_restband_cache = {}
+
+def set_restband_dz(dz):
+   '''Bin the redshifts of the rest-band cache with width [dz] (0 for exact
+   redshifts, the default). With dz > 0, the filter is the one found for
+   the center of the bin, which can differ from the exact choice for SNe
+   whose filters straddle a boundary, but lets precompute_restbands() fill
+   the cache for a whole survey. The cache is emptied.'''
+   global restband_dz
+   if dz < 0:
+      raise ValueError, "dz must be >= 0"
+   restband_dz = dz
+   _restband_cache.clear()
+
+def _restband_key(band, tempbands, z):
+   if restband_dz > 0:
+      return (band, tuple(tempbands), int(round(z/restband_dz)))
+   return (band, tuple(tempbands), float(z))
+
+def find_closest_band(band, tempbands, z):
+   '''The filter in [tempbands] whose response, redshifted to [z], overlaps
+   most with observed filter [band] (both normalized to unit area). If none
+   of them overlap, the one with closest mean wavelength.'''
+   resps = []
+   # normalize responses to the area under the filter response curve
+   norm = fset[band].response(fset[band].wave, fset[band].wave*0.0+1.0, z=0,
+         zeropad=1, photons=0)
+   for temp in tempbands:
+      norm2 = fset[temp].response(fset[temp].wave, fset[temp].wave*0.0+1.0,
+            z=0, zeropad=1, photons=0)
+      resps.append(fset[band].response(fset[temp].wave, fset[temp].resp,
+         z=z, zeropad=1, photons=0)*norm/norm2)
+
+   resps = array(resps)
+   if max(resps) <= 0:
+      # all failed to overlap...
+      dists = absolute(array([fset[temp].ave_wave - fset[band].ave_wave \
+            for temp in tempbands]))
+      return tempbands[argmin(dists)]
+   else:
+      return(tempbands[argmax(resps)])
+
+def closest_band(band, tempbands, z):
+   '''Cached version of find_closest_band() (see set_restband_dz()).'''
+   key = _restband_key(band, tempbands, z)
+   if key not in _restband_cache:
+      if restband_dz > 0:
+         z = key[2]*restband_dz
+      _restband_cache[key] = find_closest_band(band, tempbands, z)
+   return _restband_cache[key]
+
+def precompute_restbands(bands, zs, tempbands=None):
+   '''Fill the rest-band cache for observed filters [bands] at redshifts
+   [zs], so that assigning rest-frame filters to SN objects is a table
+   look-up. With redshift bins (see set_restband_dz()), a grid of [zs]
+   spanning a survey covers all its SNe. Do this before forking worker
+   processes to share the table, or see save_restbands().'''
+   if tempbands is None:
+      tempbands = ubertemp.template_bands
+   for z in zs:
+      for band in bands:
+         closest_band(band, tempbands, z)
+
+def save_restbands(file):
+   '''Save the rest-band cache to [file].'''
+   f = open(file, 'w')
+   pickle.dump((restband_dz, _restband_cache), f)
+   f.close()
+
+def load_restbands(file):
+   '''Add the entries of a rest-band cache saved with save_restbands().'''
+   f = open(file, 'r')
+   dz,cache = pickle.load(f)
+   f.close()
+   if dz != restband_dz:
+      raise ValueError, "Rest-band cache in %s was made with restband_dz=%g" %\
+            (file, dz)
+   _restband_cache.update(cache)
+
+def clear_restbands():
+   '''Empty the rest-band cache (e.g., after changing filter definitions).'''
+   _restband_cache.clear()
+
 class dict_def:
    '''A class that acts like a dictionary, but if you ask for a key
    that is not in the dict, it returns the key instead of raising
@@ -138,6 +235,7 @@ class sn(object):
       self.ks_mask = {}     # mask for k-corrections
       self.ks_tck = {}      # spline rep of k-corrections
       self.Robs = {}          # The observed R based on Rv and Ia spectrum
+      self.grids = {}         # chi-square grids (see model.evaluate_grid)
 
       self.p = None
       self.replot = 1          # Do we replot every time the fit finishes?
@@ -496,6 +594,7 @@ class sn(object):
                   else:
                      R = self.parent.Robs[band]
                else:
+                  Ia_w,Ia_f = Ia_SED()
                   R = fset[band].R(wave=Ia_w, flux=Ia_f)
             else:
                R = 0
@@ -571,7 +670,7 @@ class sn(object):
 
 
    def kcorr(self, bands=None, mbands=None, mangle=1, interp=1, use_model=0,
-         min_filter_sep=400, use_stretch=1, **mopts):
+         min_filter_sep=400, use_stretch=1, reuse_tol=None, **mopts):
       '''Compute the k-corrections for the named filters.
       In order to get the best k-corrections possible,
       we warp the SNIa SED (defined by self.k_version) to match the observed
@@ -593,6 +692,11 @@ class sn(object):
                                  than this are rejected. (Default: 400 A)
          use_stretch (bool): If True, stretch the SED in time to match the
                              stretch/dm15 of the object. (Default: True)
+         reuse_tol (float or None): If not None, re-use the mangled
+                             k-corrections from the previous call for any
+                             epoch whose rest-frame phase has moved by less
+                             than this many days. Only new or affected epochs
+                             are mangled. (Default: None)
          mopts (dict): Any additional arguments are sent to the function
                        mangle_spectrum.mangle_spectrum2()
 
@@ -609,6 +713,8 @@ class sn(object):
                          (useful for interpolating the k-corrections).
          * self.mopts:  If mangling was used, contains the parameters of the
                         mangling function.
+         * self.ks_cache: If mangling was used, the per-epoch k-corrections
+                        and mangling parameters (used by reuse_tol).
       '''
       if use_stretch and self.k_version != '91bg':
          dm15 = getattr(self, 'dm15', None)
@@ -657,6 +763,7 @@ class sn(object):
          return
 
       # Now see if we need to eliminate filters
+      Ia_w,Ia_f = Ia_SED()
       eff_waves = array([fset[band].eff_wave(Ia_w,Ia_f) for band in mbands])
       sids = argsort(eff_waves)
       eff_waves = eff_waves[sids]
@@ -702,12 +809,53 @@ class sn(object):
       if not sometrue(greater_equal(t, -19)*less(t, 70)):
          raise RuntimeError, \
             "Error:  your epochs are all outside -20 < t < 70.  Check self.Tmax"
-      kcorrs,mask,Rts,m_opts = kcorr.kcorr_mangle(t/(1+self.z)/s, bands,
-            mags, masks, restbands, self.z,
-            colorfilts=mbands, version=self.k_version, full_output=1, **mopts)
+      phase = t/(1+self.z)/s
+      # Figure out which epochs need to be mangled
+      redo = ones(phase.shape, dtype=bool)
+      cache = getattr(self, 'ks_cache', None)
+      if reuse_tol is not None and cache is not None and \
+            cache['bands'] == bands and cache['mbands'] == mbands and \
+            cache['version'] == self.k_version and cache['mopts'] == mopts:
+         ids = argmin(absolute(res['MJD'][:,newaxis] - 
+                              cache['MJD'][newaxis,:]), axis=1)
+         redo = greater(absolute(res['MJD'] - cache['MJD'][ids]), 1e-6) + \
+                greater_equal(absolute(phase - cache['phase'][ids]), reuse_tol)
+         if not self.quiet:
+            print "Re-using k-corrections for %d of %d epochs" % \
+                  (len(redo) - sum(redo), len(redo))
+
+      if alltrue(redo):
+         kcorrs,mask,Rts,m_opts = kcorr.kcorr_mangle(phase, bands,
+               mags, masks, restbands, self.z,
+               colorfilts=mbands, version=self.k_version, full_output=1, 
+               **mopts)
+         kcorrs = array(kcorrs)
+         Rts = array(Rts)
+      else:
+         kcorrs = cache['kcorrs'][ids]
+         mask = cache['mask'][ids]
+         Rts = cache['Rts'][ids]
+         m_opts = [cache['m_opts'][i] for i in ids]
+         rids = nonzero(redo)[0]
+         if len(rids) > 0:
+            ks1,mask1,Rts1,m_opts1 = kcorr.kcorr_mangle(phase[rids], bands,
+                  mags[rids], masks[rids], restbands, self.z,
+                  colorfilts=mbands, version=self.k_version, full_output=1,
+                  **mopts)
+            kcorrs[rids] = ks1
+            mask[rids] = mask1
+            Rts[rids] = Rts1
+            for j,i in enumerate(rids):
+               m_opts[i] = m_opts1[j]
+            # epochs without an SED get the average R of the good ones
+            bids = array([m is None for m in m_opts])
+            if sometrue(bids) and not alltrue(bids):
+               Rts[bids] = average(Rts[~bids], axis=0)
+      self.ks_cache = {'bands':list(bands), 'mbands':list(mbands),
+            'version':self.k_version, 'mopts':dict(mopts), 
+            'MJD':res['MJD'].copy(), 'phase':phase, 'kcorrs':kcorrs.copy(),
+            'mask':array(mask).copy(), 'Rts':Rts.copy(), 'm_opts':m_opts}
       mask = greater(mask, 0)
-      kcorrs = array(kcorrs)
-      Rts = array(Rts)
 
       # At this point, we have k-corrections for all dates in res['MDJ']:
       #   kcorrs[i,j]  is kcorr for bands[j] on date res['MJD'][i]
@@ -995,8 +1143,9 @@ Either set dokcorr=0 or run self.kcorr() first" % band
          self.EBVgal is set to Milky-Way color excess.
       '''
       if self.ra is not None and self.decl is not None:
-         self.EBVgal,mask = dust_getval.get_dust_RADEC(self.ra, self.decl,
-               calibration=calibration)
+         with profiler.stage('IRSA'):
+            self.EBVgal,mask = dust_getval.get_dust_RADEC(self.ra, self.decl,
+                  calibration=calibration)
          self.EBVgal = self.EBVgal[0]
       else:
          print "Error:  need ra and dec to be defined, E(B-V)_gal not computed"
@@ -1005,8 +1154,9 @@ Either set dokcorr=0 or run self.kcorr() first" % band
       '''Gets the value of the uncertainty in E(B-V) due to Milky Way galactic
       extinction.  The ra and decl member varialbles must be set beforehand.'''
       if self.ra is not None and self.decl is not None:
-         self.e_EBVgal = dust_getval.get_dust_sigma_RADEC(self.ra, self.decl,
-               calibration=calibration)
+         with profiler.stage('IRSA'):
+            self.e_EBVgal = dust_getval.get_dust_sigma_RADEC(self.ra,
+                  self.decl, calibration=calibration)
       else:
          print "Error:  need ra and dec to be defined, e_E(B-V)_gal not computed"
    def get_zcmb(self):
@@ -1259,7 +1409,7 @@ Either set dokcorr=0 or run self.kcorr() first" % band
                print >> f, "%.1f  %.3f" % (ts[i]-toff, m[i])
             f.close()
 
-   def update_sql(self, attributes=None, dokcorr=1):
+   def update_sql(self, attributes=None, dokcorr=1, writer=None):
       '''Updates the current information in the SQL database, creating a new SN
       if needed.
 
@@ -1267,6 +1417,10 @@ Either set dokcorr=0 or run self.kcorr() first" % band
          attributes (list or None): attributes of the SN to update. If None,
                                     then all attributes are updated.
          dokcorr (bool):  If True, also update the k-corrections in the DB.
+         writer (sqlmod.BatchWriter): If not None, the updates are queued on
+                                      this writer and only written when its
+                                      flush() is called. Use this to update
+                                      many SNe efficiently.
 
       Returns:
          None
@@ -1274,29 +1428,12 @@ Either set dokcorr=0 or run self.kcorr() first" % band
       Effects:
          SQL database is updated.
       '''
-      if have_sql:
-         N = self.sql.connect(self.name)
-         if N == 0:
-            self.sql.create_SN(self.ra, self.decl, self.z)
-            data = {}
-            for f in self.data:
-               if dokcorr and data[f].K is not None:
-                  data[f] = [self.data[f].MJD, self.data[f].magnitude, self.data[f].e_mag,
-                          self.data[f].K]
-               else:
-                  data[f] = [self.data[f].MJD, self.data[f].magnitude, self.data[f].e_mag,
-                          None]
-            self.sql.create_SN_photometry(data)
-         elif dokcorr:
-            for f in self.data:
-               self.sql.update_photometry(f, self.data[f].MJD, "K", self.data[f].K)
-         attr_list = ['z','ra','decl'] + self.parameters.keys()
-         for attr in attr_list:
-            try:
-               self.sql.set_SN_parameter(attr, self.__getattr__[attr])
-            except:
-               pass
-         self.sql.close()
+      if writer is not None:
+         writer.add(self, attributes=attributes, dokcorr=dokcorr)
+      elif self.sql.have_driver():
+         writer = sqlmod.BatchWriter(self.sql)
+         writer.add(self, attributes=attributes, dokcorr=dokcorr)
+         writer.flush()
 
    def read_sql(self, name):
       '''Get the data from the SQL server for supernova.
@@ -1311,7 +1448,7 @@ Either set dokcorr=0 or run self.kcorr() first" % band
          If successful, the SN objects is updated with data from the
          SQL database.
       '''
-      if have_sql:
+      if self.sql.have_driver():
          N = self.sql.connect(name)
          if N == 0:
             print "%s not found in database, starting from scratch..." % (name)
@@ -1421,7 +1558,8 @@ Either set dokcorr=0 or run self.kcorr() first" % band
       f.close()
 
    def fit(self, bands=None, mangle=1, dokcorr=1, reset_kcorrs=1,
-         k_stretch=True, margs={}, kcorr=None, **args):
+         k_stretch=True, margs={}, kcorr=None, store=None, 
+         store_systematics=True, multistart=0, processes=1, **args):
       '''Fit the N light curves with the currently set model (see
       self.choose_model()).  The parameters that can be varried or held
       fixed depend on the model being used (try help(self.model)
@@ -1442,6 +1580,15 @@ Either set dokcorr=0 or run self.kcorr() first" % band
                             dm15/st of the object.
          margs (dict): A set of extra arguments to send to
                        kcorr.mangle_spectrum.mangle_spectrum2()
+         store (str or FitStore): If not None, record the results in this
+                       results store (see :mod:`snpy.fitstore`).
+         store_systematics (bool): If True, the systematic errors (see
+                       self.systematics()) are recorded in the store too.
+         multistart (int): If > 0, the initial fit is also started from
+                       the [multistart] best points of a chi-square scan
+                       (see model.fit()). The later fits start from its
+                       solution, so they do not repeat the scan.
+         processes (int): number of processes for the multi-start fits.
          args (dict): Any extra arguments are sent to the model instance
                       If an argument matches a parameter of the model,
                       that parameter will be held fixed at the specified
@@ -1475,6 +1622,7 @@ Either set dokcorr=0 or run self.kcorr() first" % band
                if self.restbands[b] in self.model.rbs]
 
       # Setup initial Robs (in case it is used by the model)
+      Ia_w,Ia_f = Ia_SED()
       for band in bands:
          if band not in self.Robs:
             self.Robs[band] = fset[band].R(self.Rv_gal, Ia_w, Ia_f, z=self.z)
@@ -1496,31 +1644,124 @@ Either set dokcorr=0 or run self.kcorr() first" % band
       if not self.quiet:
          print "Doing Initial Fit to get Tmax..."
 
-      self.model.fit(bands, **args)
+      with profiler.stage('initial_fit'):
+         self.model.fit(bands, multistart=multistart, processes=processes,
+               **args)
 
       if dokcorr:
          kbands = [band for band in bands if band not in self.ks]
          if len(kbands) > 0:
             if not self.quiet:
                print "Setting up initial k-corrections"
-            self.kcorr(kbands, mangle=0, use_stretch=k_stretch)
+            with profiler.stage('kcorr_unmangled'):
+               self.kcorr(kbands, mangle=0, use_stretch=k_stretch)
 
          if not self.quiet:
             if mangle:
                print "Doing first fit..."
             else:
                print "Doing fit..."
-         self.model.fit(bands, **args)
+         with profiler.stage('refit'):
+            self.model.fit(bands, **args)
 
          if mangle:
             if not self.quiet:
                print "Doing mangled k-corrections"
-            self.kcorr(bands, interp=0, use_model=1, use_stretch=k_stretch, **margs)
+            with profiler.stage('kcorr_mangled'):
+               self.kcorr(bands, interp=0, use_model=1, use_stretch=k_stretch,
+                     **margs)
             if not self.quiet:
                print "Doing final fit..."
-            self.model.fit(bands, **args)
+            with profiler.stage('refit'):
+               self.model.fit(bands, **args)
+      if store is not None:
+         opened = type(store) is types.StringType
+         if opened:
+            store = fitstore.FitStore(store)
+         try:
+            store.add(self, systematics=store_systematics, options={
+               'bands':bands, 'mangle':mangle, 'dokcorr':dokcorr, 
+               'k_stretch':k_stretch, 'margs':margs})
+         finally:
+            if opened:  store.close()
       if self.replot:
-         self.plot()
+         with profiler.stage('plotting'):
+            self.plot()
+
+   def refit(self, bands=None, mangle=1, k_stretch=True, margs={}, tol=0.5,
+         multistart=0, processes=1, **args):
+      '''Incrementally update a previous fit (e.g., after new photometry
+      has been added). The fit starts from the current model parameters
+      and the mangled k-corrections of the previous fit are re-used for
+      any epoch whose rest-frame phase has moved by less than [tol] days,
+      so only new or affected epochs are mangled. If there is no previous
+      fit to start from, this is the same as self.fit().
+
+      Args:
+         bands (list or None):  List of observed filters to fit. If None
+                                (default), fit all filters with valid
+                                rest-bands.
+         mangle (bool):  If True, mangle the Ia SED to fit observed colors
+                         before computing k-corrections.
+         k_stretch (bool):  If True, stretch the Ia SED in time to match
+                            dm15/st of the object.
+         margs (dict): A set of extra arguments to send to
+                       kcorr.mangle_spectrum.mangle_spectrum2()
+         tol (float): Tolerance in rest-frame phase (days) within which
+                      previous k-corrections are re-used.
+         multistart (int): If > 0, the warm-start fit is also started from
+                       the [multistart] best points of a chi-square scan
+                       (see model.fit()).
+         processes (int): number of processes for the multi-start fits.
+         args (dict): Any extra arguments are sent to the model instance
+                      (see self.fit()).
+
+      Returns:
+         None
+
+      Effects:
+         Same as self.fit()
+      '''
+      if bands is None:
+         bands = [b for b in self.data.keys() \
+               if self.restbands[b] in self.model.rbs]
+      cache = getattr(self, 'ks_cache', None)
+      if cache is None or not mangle or cache['bands'] != bands or \
+            None in self.model.parameters.values() or \
+            len([b for b in bands if b not in self.ks]) > 0:
+         return self.fit(bands, mangle=mangle, k_stretch=k_stretch,
+               margs=margs, multistart=multistart, processes=processes, 
+               **args)
+
+      # Extend the current k-corrections to any new photometry, until they
+      # are updated below.
+      for i,b in enumerate(bands):
+         MJD = self.data[b].MJD
+         if len(self.ks_mask[b]) == len(MJD):  continue
+         ids = argmin(absolute(MJD[:,newaxis] - cache['MJD'][newaxis,:]), 
+               axis=1)
+         new = greater(absolute(MJD - cache['MJD'][ids]), 1e-6)
+         self.ks[b] = scipy.interpolate.splev(MJD, self.ks_tck[b])
+         self.ks_mask[b] = where(new, True, 
+               greater(cache['mask'][ids,i], 0))
+
+      if not self.quiet:
+         print "Doing warm-start fit..."
+      with profiler.stage('refit'):
+         self.model.fit(bands, multistart=multistart, processes=processes,
+               **args)
+      if not self.quiet:
+         print "Updating mangled k-corrections"
+      with profiler.stage('kcorr_mangled'):
+         self.kcorr(bands, interp=0, use_model=1, use_stretch=k_stretch,
+               reuse_tol=tol, **margs)
+      if not self.quiet:
+         print "Doing final fit..."
+      with profiler.stage('refit'):
+         self.model.fit(bands, **args)
+      if self.replot:
+         with profiler.stage('plotting'):
+            self.plot()
 
    def fitMCMC(self, bands=None, Nwalkers=None, threads=1, Niter=500,
          burn=200, tracefile=None, verbose=False, plot_triangle=False,
@@ -1652,17 +1893,105 @@ Either set dokcorr=0 or run self.kcorr() first" % band
       meds = median(sampler.flatchain, axis=0)
       covar = cov(sampler.flatchain.T)
 
+      self._set_posterior(vinfo, meds, covar)
+      if self.replot:
+         self.plot()
+
+      if plot_triangle:
+         if triangle is None:
+            print "Sorry, but if you want a triangle plot, you have to install"
+            print "the triangle module (http://github.com/dfm/triangle.py)"
+         else:
+            triangle.corner(samples, labels=pars, truths=meds)
+
+   def _set_posterior(self, vinfo, values, covar):
+      '''Set the model parameters, errors and covariance matrix from the
+      [values] and [covar] of the variables in [vinfo] (see
+      snemcee.setup_varinfo()).'''
       self.model.C = {}
       for par in self.model.parameters:
          if not vinfo[par]['fixed']:
             ind = vinfo[par]['index']
-            self.model.parameters[par] = meds[ind]
+            self.model.parameters[par] = values[ind]
             self.model.errors[par] = sqrt(covar[ind,ind])
             self.model.C[par] = {}
             for par2 in self.model.parameters:
                if not vinfo[par2]['fixed']:
                   ind2 = vinfo[par2]['index']
                   self.model.C[par][par2] = covar[ind,ind2]
+
+   def fitLaplace(self, bands=None, threads=1, step=0.1, Nsamples=5000,
+         tracefile=None, verbose=False, plot_triangle=False, **args):
+      '''Fit the N light curves of filters specified in [bands] with the
+      currently set model using a Laplace (Gaussian) approximation of the
+      posterior: the maximum of the posterior (snemcee.lnprob, including
+      any priors) is found, starting from the least-squares solution, and
+      the covariance matrix is the inverse of the Hessian there, computed
+      by finite differences. This is much faster than fitMCMC() and is a
+      good approximation as long as the posterior is close to Gaussian. As
+      with fitMCMC(), you need to do an initial fit first and parameters can
+      be held fixed or given priors as arguments (e.g., Tmax='G,1000,10').
+      The model parameters, errors and covariance matrix are updated as
+      with fitMCMC().
+
+      Args:
+         bands (list or None):  a list of observed filters to fit. If None,
+                               all filters with valid rest-frame filters are
+                               fit.
+         threads (int):  Number of processes used to evaluate the Hessian.
+         step (float): finite-difference step, in units of the errors of the
+                       initial fit.
+         Nsamples (int): Number of samples drawn from the Gaussian for the
+                         tracefile and triangle plot.
+         tracefile (str):  Optional name of a file to which samples of the
+                           posterior will be stored (same format as
+                           fitMCMC()).
+         verbose (bool): be verbose?
+         plot_triangle (bool): If True, plot a covariance plot. This requires
+                               the triangle_plot module (get it from pypi).
+         args (dict):  priors and fixed parameters (see fitMCMC()).
+      '''
+      if snemcee is None:
+         print "Sorry, in order to fit with the Laplace approximation, you"
+         print "need to install the emcee module. Try 'pip install emcee'  or"
+         print "get the source from http://dan.iel.fm/emcee/current/"
+         return None
+
+      if len(self.model._fbands) == 0:
+         raise AttributeError, "In order to fit with the Laplace "\
+               "approximation, you need to do an initial fit first."
+
+      if bands is None:
+         bands = [b for b in self.data.keys() \
+               if self.restbands[b] in self.model.rbs]
+      if verbose:
+         print "Fitting "," ".join(bands)
+
+      self.model.args = args.copy()
+      pmap,covar,vinfo = snemcee.laplace(self, bands, threads, step, **args)
+
+      pars = []
+      ids = []
+      for par in vinfo:
+         if type(vinfo[par]) is type({}) and 'index' in vinfo[par] \
+               and vinfo[par]['prior_type'] != 'nuissance':
+            pars.append(par)
+            ids.append(vinfo[par]['index'])
+      if verbose:
+         for par,ind in zip(pars,ids):
+            print "%s = %f +/- %f" % (par, pmap[ind], sqrt(covar[ind,ind]))
+
+      if tracefile is not None or plot_triangle:
+         samples = random.multivariate_normal(pmap[ids],
+               covar[ids,:][:,ids], size=Nsamples)
+      if tracefile is not None:
+         f = open(tracefile, 'w')
+         for i in range(len(pars)):
+            f.write('# Col(%d) = %s\n' % (i+1,pars[i]))
+         savetxt(f, samples, fmt="%15.10g")
+         f.close()
+
+      self._set_posterior(vinfo, pmap, covar)
       if self.replot:
          self.plot()
 
@@ -1671,15 +2000,17 @@ Either set dokcorr=0 or run self.kcorr() first" % band
             print "Sorry, but if you want a triangle plot, you have to install"
             print "the triangle module (http://github.com/dfm/triangle.py)"
          else:
-            triangle.corner(samples, labels=pars, truths=meds)
+            triangle.corner(samples, labels=pars, truths=pmap[ids])
 
-   def systematics(self, **args):
+   def systematics(self, mc=False, **args):
       '''Report any systematic errors that may be present in the
       fit parameters.
 
       Args:
+         mc (bool):  If True, propagate the calibration errors to DM by
+                     Monte-Carlo (see model.mc_systematics()).
          args (dict):  All arguments are sent to the model.systmatics()
-                       function.
+                       (or model.mc_systematics()) function.
 
       Returns:
          dict:  a dictionary of systematic errors keyed by parameter
@@ -1687,7 +2018,10 @@ Either set dokcorr=0 or run self.kcorr() first" % band
                 see the specific model for any extra arguments.  If None
                 is returned as a value, no systematic has been estimated
                 for it.'''
-      return self.model.systematics(**args)
+      with profiler.stage('systematics'):
+         if mc:
+            return self.model.mc_systematics(**args)
+         return self.model.systematics(**args)
 
    def plot_filters(self, bands=None, day=0, outfile=None, **args):
       '''Plot the filter functions over a typical SN Ia SED.
@@ -1763,6 +2097,7 @@ Either set dokcorr=0 or run self.kcorr() first" % band
       '''
       # First, let's get the proper value of R:
       if R is None:
+         Ia_w,Ia_f = Ia_SED()
          R1 = fset[band1].R(Rv, Ia_w, Ia_f)
          R2 = fset[band2].R(Rv, Ia_w, Ia_f)
          R3 = fset[band3].R(Rv, Ia_w, Ia_f)
@@ -2085,29 +2420,12 @@ Either set dokcorr=0 or run self.kcorr() first" % band
       observed filter [band].  If tempbands is None, defaults to
       self.template_bands.  In the case where the redshift of the
       SN is below [lowz], if [band] is in [tempbands], use [band]
-      regardless of whether another band is closer.'''
+      regardless of whether another band is closer. The choice is cached
+      for the exact redshift (or a redshift bin, see set_restband_dz()).'''
       if tempbands is None:
          tempbands = self.template_bands
       if self.z < lowz and band in tempbands:  return band
-
-      resps = []
-      # normalize responses to the area under the filter response curve
-      norm = fset[band].response(fset[band].wave, fset[band].wave*0.0+1.0, z=0,
-            zeropad=1, photons=0)
-      for temp in tempbands:
-         norm2 = fset[temp].response(fset[temp].wave, fset[temp].wave*0.0+1.0, z=0,
-                           zeropad=1, photons=0)
-         resps.append(fset[band].response(fset[temp].wave, fset[temp].resp,
-            z=self.z, zeropad=1, photons=0)*norm/norm2)
-
-      resps = array(resps)
-      if max(resps) <= 0:
-         # all failed to overlap...
-         dists = absolute(array([fset[temp].ave_wave - fset[band].ave_wave \
-               for temp in tempbands]))
-         return tempbands[argmin(dists)]
-      else:
-         return(tempbands[argmax(resps)])
+      return closest_band(band, tempbands, self.z)
 
 def save(instance, file):
    '''Save a super instance to a file to be loaded back later with load().'''
@@ -2255,6 +2573,39 @@ def get_sn(str, sql=None, **kw):
       s = sn(str, source=sql, **kw)
    return s
 
+def get_sn_list(names, sql=None):
+   '''Get many SNe from the designated sql connection object (or default_sql
+   if sql=None), fetching the coordinates, redshifts and photometry of all
+   of them in a few bulk queries.
+
+   Args:
+      names (list of str): SN names
+      sql (sqlbase): An instance of sqlmod.sqlbase class
+
+   Returns:
+      list: sn instances in the same order as names (None for a SN that is
+            not in the database)
+   '''
+   if sql is None:  sql = sqlmod.default_sql
+   info = sql.fetch_SNe(names)
+   sne = []
+   for name in names:
+      if name not in info:
+         print "%s not found in database" % (name)
+         sne.append(None)
+         continue
+      d = info[name]
+      s = sn(name, ra=d['ra'] or 0.0, dec=d['decl'] or 0.0, z=d['z'] or 0.0)
+      s.sql = sql
+      s._sql_read_time = time.gmtime()
+      for filter in d['data']:
+         dd = d['data'][filter]
+         s.data[filter] = lc(s, filter, dd['t'], dd['m'], dd['em'],
+               K=dd.get('K', None), SNR=dd.get('SNR', None))
+      s.get_restbands()
+      sne.append(s)
+   return sne
+
 def check_version():
    global __version__
    import urllib2
@@ -6,6 +6,7 @@ import emcee
 import numpy as np
 from scipy.optimize import minimize
 import types,os
+from snpy.utils import pmap
 
 gconst = -0.5*np.log(2*np.pi)
 
@@ -247,3 +248,103 @@ def generateSampler(snobj, bands, nwalkers, threads=1, tracefile=None, **args):
    sampler = emcee.EnsembleSampler(nwalkers, ndim, lnprob, args=(vinfo, snobj, bands),
          threads=threads)
    return sampler,vinfo,p0
+
+def _batch_lnprob(p):
+   varinfo,snobj,bands = pmap.get_state()
+   return lnprob(p, varinfo, snobj, bands)
+
+def lnprob_batch(ps, varinfo, snobj, bands, threads=1):
+   '''Evaluate lnprob at each of the points [ps] (a 2D array, one point per
+   row), using [threads] processes if > 1.'''
+   lps = pmap.pmap(_batch_lnprob, list(ps), threads, (varinfo, snobj, bands))
+   return np.array(lps)
+
+def scales(varinfo, snobj):
+   '''Typical scales of the free variables: the errors of the initial fit
+   or, for nuissance parameters, their standard deviations.'''
+   sc = np.zeros((varinfo['Nvar'],))
+   for var in varinfo['free']:
+      id = varinfo[var]['index']
+      if varinfo[var]['prior_type'] == 'nuissance':
+         sc[id] = varinfo[var]['std']
+      else:
+         err = snobj.model.errors.get(var, 0)
+         val = snobj.model.parameters[var]
+         if not err > 0:
+            err = max(1e-3*abs(val), 1e-3)
+         sc[id] = err
+   return sc
+
+def hessian(p, varinfo, snobj, bands, h, threads=1):
+   '''The Hessian of lnprob at [p] by central finite differences with steps
+   [h] (one per variable). All the 2N(N-1)+2N+1 points are evaluated in
+   one batch (see lnprob_batch()). Returns (H, lnprob(p)).'''
+   n = p.shape[0]
+   E = np.diag(h)
+   pts = [p]
+   for i in range(n):
+      pts += [p + E[i], p - E[i]]
+   pairs = [(i,j) for i in range(n) for j in range(i+1,n)]
+   for i,j in pairs:
+      pts += [p + E[i] + E[j], p + E[i] - E[j], p - E[i] + E[j],
+              p - E[i] - E[j]]
+   f = lnprob_batch(np.array(pts), varinfo, snobj, bands, threads)
+   if not np.all(np.isfinite(f)):
+      raise RuntimeError, "lnprob is not finite around the MAP point. "\
+            "Try a smaller step or check your priors"
+   f0 = f[0]
+   H = np.zeros((n,n))
+   for i in range(n):
+      H[i,i] = (f[1+2*i] - 2*f0 + f[2+2*i])/h[i]**2
+   for k,(i,j) in enumerate(pairs):
+      fpp,fpm,fmp,fmm = f[1+2*n+4*k:5+2*n+4*k]
+      H[i,j] = H[j,i] = (fpp - fpm - fmp + fmm)/(4*h[i]*h[j])
+   return H,f0
+
+def laplace(snobj, bands, threads=1, step=0.1, **args):
+   '''The Laplace approximation of the posterior of the model of [snobj]:
+   the maximum a-posteriori (MAP) point of lnprob (including priors set
+   as arguments, as in generateSampler()) and the covariance matrix
+   from the Hessian there.
+
+   Args:
+      snobj (sn instance): a SN object that has been fit.
+      bands (list of str): the filters to fit
+      threads (int): number of processes used to evaluate the Hessian
+      step (float): finite-difference steps in units of the errors of the
+                    initial fit.
+      args (dict): priors and fixed values (see generateSampler())
+
+   Returns:
+      (p,C,varinfo): the MAP point, covariance matrix and the variable
+                     info (see setup_varinfo()).
+   '''
+   if not snobj.model._fbands:
+      raise ValueError, "You need to do an initial fit to the SN first"
+   vinfo = setup_varinfo(snobj, args)
+   p,ep = guess(vinfo, snobj)
+   sc = scales(vinfo, snobj)
+   if not np.isfinite(lnprior(p, vinfo, snobj)):
+      raise RuntimeError, "The initial fit solution is outside the priors"
+
+   # Find the MAP in units of the scales
+   nlp = lambda u: -lnprob(p + u*sc, vinfo, snobj, bands)
+   n = p.shape[0]
+   simplex = np.vstack([np.zeros((1,n)), np.eye(n)])
+   res = minimize(nlp, np.zeros((n,)), method='Nelder-Mead',
+         options={'initial_simplex':simplex, 'xatol':1e-4, 'fatol':1e-6,
+                  'maxiter':200*n})
+   pmap = p + res.x*sc
+
+   H,lp = hessian(pmap, vinfo, snobj, bands, step*sc, threads)
+   try:
+      C = np.linalg.inv(-H)
+   except np.linalg.LinAlgError:
+      raise RuntimeError, "The Hessian is singular.  Two or more parameters "\
+            "are degenerate"
+   if not np.all(np.diag(C) > 0):
+      raise RuntimeError, "The Hessian is not negative definite at the MAP "\
+            "point.  The posterior is not well approximated by a Gaussian"
+   # leave the model at the MAP point
+   lnprob(pmap, vinfo, snobj, bands)
+   return pmap,C,vinfo
@@ -1,13 +1,82 @@
 import os,sys
+import math
+import time
 import numpy
 import getpass
+import threading
+import sqlite3
 
-try:
-   import pymysql as sql
+from snpy.utils.lazy import lazy_import, available, loaded
+
+# pymysql is imported when the first connection is made
+if available('pymysql'):
+   sql = lazy_import('pymysql')
    have_sql = 1
-except:
+else:
    have_sql = 0
 
+class ConnectionPool:
+   '''A pool of open database connections, keyed by (host, user, port, db),
+   so that loading many SNe does not pay for a new connection (and login)
+   each time. Connections are handed out with get() and given back with
+   release(); at most [maxidle] idle connections are kept per key.'''
+
+   def __init__(self, maxidle=4):
+      self.maxidle = maxidle
+      self.idle = {}
+      self.lock = threading.Lock()
+
+   def get(self, key, factory):
+      '''Return an idle connection for [key], or a new one made by calling
+      factory().'''
+      while True:
+         self.lock.acquire()
+         try:
+            cons = self.idle.get(key, [])
+            con = cons and cons.pop() or None
+         finally:
+            self.lock.release()
+         if con is None:
+            return factory()
+         if hasattr(con, 'ping'):
+            # MySQL connections may have timed out while idle
+            try:
+               con.ping(True)
+            except:
+               continue
+         return con
+
+   def release(self, key, con):
+      '''Give [con] back to the pool. Any open transaction is committed.'''
+      try:
+         con.commit()
+      except:
+         con.close()
+         return
+      self.lock.acquire()
+      try:
+         cons = self.idle.setdefault(key, [])
+         if len(cons) < self.maxidle:
+            cons.append(con)
+            con = None
+      finally:
+         self.lock.release()
+      if con is not None:
+         con.close()
+
+   def clear(self):
+      '''Close all idle connections.'''
+      self.lock.acquire()
+      try:
+         for cons in self.idle.values():
+            for con in cons:
+               con.close()
+         self.idle = {}
+      finally:
+         self.lock.release()
+
+pool = ConnectionPool()
+
 class sqlbase:
    '''A base class for an sql connection object.  Custom SQL query objects
    should inherit from this base class and override the member variables and
@@ -53,7 +122,9 @@ class sqlbase:
    PHOTO_K = "K"           # SQL field in PHOTO_TABLE that gives K-corrections
    PHOTO_FILT = "filter"   # SQL field in PHOTO_TABLE that gives filter name
    PHOTO_COND = ""         # Any extra WHERE conditions
-   
+   POOL = 1                # Re-use connections from the connection pool?
+   BULK_CHUNK = 500        # Max number of SNe per query in fetch_SNe()
+
    def __init__(self):
       self.connected=0
 
@@ -74,41 +145,68 @@ class sqlbase:
       return dict
 
 
-   def connect(self, name):
-      '''Connect to the database.'''
+   def have_driver(self):
+      '''Is the database driver for this class available?'''
+      return have_sql
+
+   def _open(self, db):
+      '''Open a new connection to database [db].'''
       if self.passwd is None:
          passwd = getpass.getpass(prompt='SQL passwd for %s@%s:\n' % (self.user,
             self.host))
       else:
          passwd = self.passwd
-      if not self.connected:
-         try:
-            self.con = sql.connect(host=self.host,user=self.user, passwd=passwd,
-                  db=self.PHOTO_DB, port=self.port)
-            if self.SPEC_DB is not None:
-               if self.SPEC_DB != self.PHOTO_DB:
-                  self.con2 = sql.connect(host=self.host, user=self.user, 
-                        passwd=passwd, db=self.SPEC_DB)
-               else:
-                  self.con2 = self.con
-            else:
-               self.con2 = None
-         except:
-            raise
-         else:
-            # Cache the passwd for future use if it worked
-            if self.passwd is None:  self.passwd = passwd
-            
-         self.c = self.con.cursor()
-         if self.con2 is not None:
-            self.c2 = self.con2.cursor()
+      con = sql.connect(host=self.host,user=self.user, passwd=passwd,
+            db=db, port=self.port)
+      # Cache the passwd for future use if it worked
+      if self.passwd is None:  self.passwd = passwd
+      return con
+
+   def _pool_key(self, db):
+      return (self.host, self.user, self.port, db)
+
+   def _get_con(self, db):
+      if not self.POOL:
+         return self._open(db)
+      return pool.get(self._pool_key(db), lambda: self._open(db))
+
+   def _release_con(self, db, con):
+      if not self.POOL:
+         con.close()
+      else:
+         pool.release(self._pool_key(db), con)
+
+   def attach(self):
+      '''Connect to the database without selecting a SN (see connect()).'''
+      if self.connected:  return
+      self.con = self._get_con(self.PHOTO_DB)
+      if self.SPEC_DB is not None:
+         if self.SPEC_DB != self.PHOTO_DB:
+            try:
+               self.con2 = self._get_con(self.SPEC_DB)
+            except:
+               self._release_con(self.PHOTO_DB, self.con)
+               raise
          else:
-            self.c2 = self.c
-         self.connected = 1
+            self.con2 = self.con
+      else:
+         self.con2 = None
+
+      self.c = self.con.cursor()
+      if self.con2 is not None:
+         self.c2 = self.con2.cursor()
+      else:
+         self.c2 = self.c
+      self.connected = 1
+      # Collect info about the SN_TABLE and PHOTO_TABLE:
+      self.SN_table_info = self.get_table_info(self.SN_TABLE)
+      self.PHOTO_table_info = self.get_table_info(self.PHOTO_TABLE)
+
+   def connect(self, name):
+      '''Connect to the database.'''
+      if not self.connected:
+         self.attach()
          self.name = name
-         # Collect info about the SN_TABLE and PHOTO_TABLE:
-         self.SN_table_info = self.get_table_info(self.SN_TABLE)
-         self.PHOTO_table_info = self.get_table_info(self.PHOTO_TABLE)
 
          # See if the SN object exists
          if self.SN_ID2 is not None:
@@ -164,9 +262,9 @@ class sqlbase:
    def close(self):
       '''Close connection to the database.'''
       if not self.connected: return
-      self.con.close()
-      if self.con2 is not None and self.con2 != self.con:
-         self.con2.close()
+      if self.con2 is not None and self.con2 is not self.con:
+         self._release_con(self.SPEC_DB, self.con2)
+      self._release_con(self.PHOTO_DB, self.con)
       self.connected = 0
 
    def sql_field(self, attr):
@@ -252,70 +350,140 @@ class sqlbase:
             (self.SN_TABLE, field, self.SN_ID)
       self.c.execute(updt, (value, self.name))
 
-   def get_SN_photometry(self, verbose=0):
-      '''Get the photometry form the SQL database.  Returns a dictionary
-      indexed by filter name.  Each element is a 5-tuple of arrays:
-      (MJD, mag, e_mag, K).'''
-      if not self.connected:
-         raise RuntimeError, "Not connected to SQL database."
-      if self.name2 is not None:
-         name_where = '(%s="%s" or %s="%s")' % (self.PHOTO_ID,self.name,
-                                                self.PHOTO_ID,self.name2)
-      else:
-         name_where = '%s="%s"' % (self.PHOTO_ID,self.name)
-
+   def _photo_select(self):
+      '''The SELECT ... FROM part of a photometry query. The first column is
+      PHOTO_ID, followed by filter, JD, mag, error and optionally K and SNR.'''
       if type(self.PHOTO_TABLE) is type([]):
          phot_table = ','.join(self.PHOTO_TABLE)
       else:
          phot_table = self.PHOTO_TABLE
 
-      slct = '''SELECT %s,%s,%s,%s''' % \
-            (self.PHOTO_FILT, self.PHOTO_JD, self.PHOTO_MAG, self.PHOTO_EMAG)
-
+      slct = '''SELECT %s,%s,%s,%s,%s''' % \
+            (self.PHOTO_ID, self.PHOTO_FILT, self.PHOTO_JD, self.PHOTO_MAG,
+             self.PHOTO_EMAG)
       if self.PHOTO_K is not None:
          slct += ",%s" % (self.PHOTO_K)
       if self.PHOTO_SNR is not None:
          slct += ",%s" % (self.PHOTO_SNR)
+      return slct + " from %s" % (phot_table)
 
-      slct += " from %s where %s %s ORDER by %s" % \
-            (phot_table, name_where, self.PHOTO_COND, self.PHOTO_JD)
-      if verbose:  print "executing... ",slct
-      N = self.c.execute(slct)
-      if N == 0:
-         raise ValueError, "No photometry for %s found" % \
-                  (self.name)
-      list = self.c.fetchall()
-
+   def _photometry_dict(self, rows):
+      '''Convert rows from _photo_select() into the dictionary returned by
+      get_SN_photometry().'''
       data = {}
-      for l in list:
-         filter = l[0]
-         if l[0] not in self.FILTER_KEYS:  
-            filter = l[0]
-         else:
-            filter = self.FILTER_KEYS[l[0]]
-         if filter in data:
-            data[filter]['t'].append(l[1] + self.JD_OFFSET)
-            data[filter]['m'].append(l[2])
-            data[filter]['em'].append(l[3])
-            ii = 0
-            if self.PHOTO_K is not None:
-               data[filter]['K'].append(l[4])
-               ii += 1
-            if self.PHOTO_SNR is not None:
-               data[filter]['SNR'].append(l[4+ii])
+      for l in rows:
+         if l[1] not in self.FILTER_KEYS:  
+            filter = l[1]
          else:
-            data[filter] = {'t':[l[1] + self.JD_OFFSET],
-                            'm':[l[2]], 'em':[l[3]]}
-            ii = 0
-            if self.PHOTO_K is not None:
-               data[filter]['K'] = [l[4]]
-            if self.PHOTO_SNR is not None:
-               data[filter]['SNR'] = [l[4+ii]]
+            filter = self.FILTER_KEYS[l[1]]
+         if filter not in data:
+            data[filter] = {'t':[], 'm':[], 'em':[]}
+            if self.PHOTO_K is not None:  data[filter]['K'] = []
+            if self.PHOTO_SNR is not None:  data[filter]['SNR'] = []
+         d = data[filter]
+         d['t'].append(l[2] + self.JD_OFFSET)
+         d['m'].append(l[3])
+         d['em'].append(l[4])
+         ii = 5
+         if self.PHOTO_K is not None:
+            d['K'].append(l[ii])
+            ii += 1
+         if self.PHOTO_SNR is not None:
+            d['SNR'].append(l[ii])
       for key in data:
          for key2 in data[key]:
             data[key][key2] = numpy.array(data[key][key2])
       return(data)
 
+   def get_SN_photometry(self, verbose=0):
+      '''Get the photometry form the SQL database.  Returns a dictionary
+      indexed by filter name.  Each element is a dictionary of arrays:
+      't' (MJD), 'm', 'em' and, if available, 'K' and 'SNR'.'''
+      if not self.connected:
+         raise RuntimeError, "Not connected to SQL database."
+      if self.name2 is not None:
+         name_where = '(%s=%%s or %s=%%s)' % (self.PHOTO_ID,self.PHOTO_ID)
+         args = (self.name,self.name2)
+      else:
+         name_where = '%s=%%s' % (self.PHOTO_ID)
+         args = (self.name,)
+
+      slct = self._photo_select()
+      slct += " where %s %s ORDER by %s" % \
+            (name_where, self.PHOTO_COND, self.PHOTO_JD)
+      if verbose:  print "executing... ",slct % args
+      N = self.c.execute(slct, args)
+      if N == 0:
+         raise ValueError, "No photometry for %s found" % \
+                  (self.name)
+      return self._photometry_dict(self.c.fetchall())
+
+   def fetch_SNe(self, names, verbose=0):
+      '''Get the coordinates, redshift and photometry of many SNe with a
+      few set-based queries (in chunks of BULK_CHUNK names), rather than
+      several queries per SN.
+
+      Args:
+         names (list of str): the SN names (SN_ID)
+         verbose (bool): print the queries
+
+      Returns:
+         dict: indexed by SN name, each a dictionary with keys 'ra', 'decl',
+               'z', 'name2' and 'data' (as returned by get_SN_photometry).
+               SNe not found in SN_TABLE are omitted.
+      '''
+      was_connected = self.connected
+      self.attach()
+      try:
+         fields = [self.SN_ID] + [self.sql_field(a) for a in ['ra','decl','z']]
+         if self.SN_ID2 is not None:
+            fields.append(self.SN_ID2)
+         res = {}
+         alias = {}
+         names = list(names)
+         # SQL string comparisons may be case-insensitive
+         requested = dict([(name.lower(), name) for name in names])
+         for i in range(0, len(names), self.BULK_CHUNK):
+            chunk = names[i:i+self.BULK_CHUNK]
+            slct = '''SELECT %s from %s where %s in (%s) %s''' % \
+                  (','.join(fields), self.SN_TABLE, self.SN_ID,
+                   ','.join(['%s']*len(chunk)), self.SN_COND)
+            if verbose:  print "executing... ",slct
+            self.c.execute(slct, tuple(chunk))
+            for l in self.c.fetchall():
+               name = requested.get(l[0].lower(), l[0])
+               if name in res:
+                  print "Warning!  %s is not unique in the database, "\
+                        "taking first" % (name)
+                  continue
+               name2 = self.SN_ID2 is not None and l[4] or None
+               res[name] = {'ra':l[1], 'decl':l[2], 'z':l[3], 'name2':name2,
+                     'data':{}}
+               alias[l[0].lower()] = name
+               if name2 is not None:  alias[name2.lower()] = name
+
+         ids = [r['name2'] for r in res.values() if r['name2'] is not None]
+         ids = res.keys() + ids
+         rows = {}
+         for i in range(0, len(ids), self.BULK_CHUNK):
+            chunk = ids[i:i+self.BULK_CHUNK]
+            slct = self._photo_select()
+            slct += " where %s in (%s) %s ORDER by %s" % (self.PHOTO_ID,
+                  ','.join(['%s']*len(chunk)), self.PHOTO_COND, self.PHOTO_JD)
+            if verbose:  print "executing... ",slct
+            self.c.execute(slct, tuple(chunk))
+            for l in self.c.fetchall():
+               rows.setdefault(alias[l[0].lower()], []).append(l)
+         for name in rows:
+            if res[name]['name2'] is not None:
+               # a SN and its alias may have been in different chunks
+               rows[name].sort(key=lambda l: l[2])
+            res[name]['data'] = self._photometry_dict(rows[name])
+      finally:
+         if not was_connected:
+            self.close()
+      return res
+
    def get_SN_spectra(self):
       '''Get the spectra form the SQL database.  Returns a tuple:
       (JDs, waves, fluxes)
@@ -534,12 +702,321 @@ class sql_SBS_csp2_pub(sql_csp2):
    PHOTO_DB = "PubPhot"
 
 
+class _sqlite_cursor:
+   '''Wraps an sqlite3 cursor so that it behaves like a pymysql cursor:
+   %s placeholders are used and execute() returns the number of rows.'''
+
+   def __init__(self, cursor):
+      self.cursor = cursor
+      self.rows = None
+
+   def _args(self, args):
+      if args is None:  return ()
+      if type(args) not in [type(()), type([])]:  return (args,)
+      return tuple(args)
+
+   def execute(self, query, args=None):
+      self.cursor.execute(query.replace('%s','?'), self._args(args))
+      if self.cursor.description is not None:
+         self.rows = self.cursor.fetchall()
+         return len(self.rows)
+      self.rows = None
+      return self.cursor.rowcount
+
+   def executemany(self, query, args):
+      self.cursor.executemany(query.replace('%s','?'),
+            [self._args(a) for a in args])
+      self.rows = None
+      return self.cursor.rowcount
+
+   def fetchall(self):
+      rows,self.rows = self.rows or [],None
+      return rows
+
+   def close(self):
+      self.cursor.close()
+
+class _sqlite_connection:
+   '''Wraps an sqlite3 connection so that cursors act like pymysql's.'''
+
+   def __init__(self, con):
+      self.con = con
+
+   def cursor(self):
+      return _sqlite_cursor(self.con.cursor())
+
+   def commit(self):
+      self.con.commit()
+
+   def rollback(self):
+      self.con.rollback()
+
+   def close(self):
+      self.con.close()
+
+class sql_sqlite(sqlbase):
+   '''A local SQLite stand-in for the SQL server, with the default schema of
+   sqlbase (see create_tables()). Useful for testing and for working offline.
+   The database file is given by [dbfile] or the SQL_SQLITE environment
+   variable. Use ':memory:' for a temporary database (kept alive by the
+   connection pool).'''
+   host = "localhost"
+   user = None
+   passwd = ""
+   port = None
+   PHOTO_DB = "snpy.sqlite"
+
+   def __init__(self, dbfile=None):
+      sqlbase.__init__(self)
+      if dbfile is None:
+         dbfile = os.environ.get('SQL_SQLITE', self.PHOTO_DB)
+      self.PHOTO_DB = dbfile
+
+   def have_driver(self):
+      return 1
+
+   def _open(self, db):
+      con = sqlite3.connect(db, timeout=30.0, check_same_thread=False)
+      con.text_factory = str
+      con.create_function('sqrt', 1,
+            lambda x: None if x is None else math.sqrt(x))
+      return _sqlite_connection(con)
+
+   def get_table_info(self, table):
+      '''Same as sqlbase.get_table_info(), using PRAGMA table_info.'''
+      if not self.connected:
+         raise RuntimeError, "Not connected to SQL database."
+      if type(table) is not type([]):
+         tables = [table]
+      else:
+         tables = table
+
+      data = {}
+      for table in tables: 
+         data[table] = {}
+         self.c.execute('''PRAGMA table_info(%s)''' % table)
+         for cid,name,typ,notnull,default,pk in self.c.fetchall():
+            data[table][name] = {'type':typ,
+                             'null':notnull and 'NO' or 'YES',
+                             'key':pk and 'PRI' or '',
+                             'default':default,
+                             'extra':''}
+      if len(tables) == 1:
+         data = data[tables[0]]
+      return(data)
+
+   def create_tables(self, params=[]):
+      '''Create SN_TABLE and PHOTO_TABLE (if they don't exist). [params] is
+      a list of extra (REAL) columns to add to SN_TABLE, e.g., fitted
+      parameters and their errors.'''
+      con = self._get_con(self.PHOTO_DB)
+      c = con.cursor()
+      cols = ['%s TEXT PRIMARY KEY' % self.SN_ID]
+      if self.SN_ID2 is not None:
+         cols.append('%s TEXT' % self.SN_ID2)
+      cols += ['%s REAL' % p for p in ['ra','decl','z'] + list(params)]
+      c.execute('''CREATE TABLE IF NOT EXISTS %s (%s)''' % \
+            (self.SN_TABLE, ','.join(cols)))
+      c.execute('''CREATE TABLE IF NOT EXISTS %s (id INTEGER PRIMARY KEY,
+            %s TEXT, %s TEXT, %s REAL, %s REAL, %s REAL, %s REAL)''' % \
+            (self.PHOTO_TABLE, self.PHOTO_ID, self.PHOTO_FILT, self.PHOTO_JD,
+             self.PHOTO_MAG, self.PHOTO_EMAG, self.PHOTO_K))
+      c.execute('''CREATE INDEX IF NOT EXISTS %s_id ON %s (%s)''' % \
+            (self.PHOTO_TABLE, self.PHOTO_TABLE, self.PHOTO_ID))
+      self._release_con(self.PHOTO_DB, con)
+
+
+def _conflict(e):
+   '''Is exception [e] a lock conflict (deadlock, lock wait timeout or a
+   locked SQLite file) that is worth retrying?'''
+   if isinstance(e, sqlite3.OperationalError):
+      msg = str(e)
+      return 'locked' in msg or 'busy' in msg
+   if have_sql and loaded(sql) and isinstance(e, sql.err.OperationalError):
+      return len(e.args) > 0 and e.args[0] in [1205, 1213]
+   return False
+
+def _pyvalue(value):
+   '''Convert numpy scalars to python types for the DB driver.'''
+   if hasattr(value, 'item'):
+      return value.item()
+   return value
+
+class BatchWriter:
+   '''Accumulates updates from many sn objects and writes them to the
+   database in a few chunked executemany() calls, all in one transaction, so
+   that a failed flush leaves the database untouched. A flush that fails
+   because of a lock conflict is rolled back and retried as a whole (up to
+   [retries] times, waiting [wait]*2**n seconds).
+
+   Args:
+      sql (sqlbase): the database to write to (default_sql if None)
+      chunk (int): maximum number of rows per executemany()
+      retries (int): number of times a conflicting flush is retried
+      wait (float): seconds to wait before the first retry
+      tol (float): tolerance (days) for matching photometry epochs
+
+   Attributes written for each SN (if the SN_TABLE has a column for them,
+   see sqlbase.sql_field()) are z, ra, decl, the model parameters, their
+   errors (as 'e_'+param) and the light-curve parameters of each band (as
+   param+'_'+band, e.g., Tmax_B and e_Tmax_B). K-corrections are written
+   to the PHOTO_TABLE. SNe not yet in the database are created.
+   '''
+   lc_params = ['Tmax','Mmax','dm15']
+
+   def __init__(self, sql=None, chunk=500, retries=5, wait=0.5, tol=1e-6):
+      if sql is None:  sql = default_sql
+      self.sql = sql
+      self.chunk = chunk
+      self.retries = retries
+      self.wait = wait
+      self.tol = tol
+      self.clear()
+
+   def clear(self):
+      '''Forget any pending updates.'''
+      self.sne = {}        # name -> (ra, decl, z, photometry)
+      self.attrs = {}      # name -> {attr:value}
+      self.Ks = []         # (K, name, filter, JD)
+
+   def __len__(self):
+      return len(self.sne)
+
+   def add(self, s, attributes=None, dokcorr=1):
+      '''Queue the updates for sn object [s].
+
+      Args:
+         s (sn instance): the SN
+         attributes (list or None): attributes to update. If None, all
+                                    of them (see above).
+         dokcorr (bool):  If True, also update the k-corrections.
+      '''
+      vals = {'z':s.z, 'ra':s.ra, 'decl':s.decl}
+      for p in s.model.parameters:
+         vals[p] = s.model.parameters[p]
+         vals['e_'+p] = s.model.errors.get(p, None)
+      for f in s.data:
+         for p in self.lc_params:
+            for pp in [p, 'e_'+p]:
+               vals[pp+'_'+f] = getattr(s.data[f], pp, None)
+      if attributes is not None:
+         vals = dict([(a,vals[a]) for a in attributes if a in vals])
+      self.attrs[s.name] = dict([(a,_pyvalue(vals[a])) for a in vals \
+            if vals[a] is not None])
+
+      phot = {}
+      for f in s.data:
+         d = s.data[f]
+         K = None
+         if dokcorr and d.K is not None:  K = d.K
+         phot[f] = (d.MJD, d.magnitude, d.e_mag, K)
+         if K is not None:
+            self.Ks += [(float(K[i]), s.name, f, float(d.MJD[i]) - \
+                  self.sql.JD_OFFSET) for i in range(len(K))]
+      self.sne[s.name] = (s.ra, s.decl, s.z, phot)
+
+   def _execute(self, query, rows):
+      '''executemany() [query] over [rows] in chunks. Nothing is committed
+      here:  see flush().'''
+      for i in range(0, len(rows), self.chunk):
+         self.sql.c.executemany(query, rows[i:i+self.chunk])
+
+   def _write(self):
+      '''Issue all the INSERTs and UPDATEs for the pending updates.'''
+      sql = self.sql
+      # Create the SNe that are not in the database
+      names = self.sne.keys()
+      found = {}
+      for i in range(0, len(names), sql.BULK_CHUNK):
+         chunk = names[i:i+sql.BULK_CHUNK]
+         sql.c.execute('''SELECT %s from %s where %s in (%s)''' % \
+               (sql.SN_ID, sql.SN_TABLE, sql.SN_ID,
+                ','.join(['%s']*len(chunk))), tuple(chunk))
+         for l in sql.c.fetchall():
+            found[l[0].lower()] = 1
+      new = [name for name in names if name.lower() not in found]
+      if new:
+         insrt = '''INSERT INTO %s (%s,%s,%s,%s) VALUES (%%s,%%s,%%s,%%s)'''%\
+               (sql.SN_TABLE, sql.SN_ID, sql.sql_field('ra'),
+                sql.sql_field('decl'), sql.sql_field('z'))
+         self._execute(insrt, [(name,) + self.sne[name][:3] for name in new])
+         insrt = '''INSERT INTO %s (%s,%s,%s,%s,%s,%s) VALUES '''\
+               '''(%%s,%%s,%%s,%%s,%%s,%%s)''' % (sql.PHOTO_TABLE,
+               sql.PHOTO_ID, sql.PHOTO_FILT, sql.PHOTO_JD, sql.PHOTO_MAG,
+               sql.PHOTO_EMAG, sql.PHOTO_K)
+         rows = []
+         for name in new:
+            phot = self.sne[name][3]
+            for f in phot:
+               t,m,em,K = phot[f]
+               # no k-corrections --> NULL
+               if K is None:  K = [None]*len(t)
+               rows += [(name, f, float(t[i]) - sql.JD_OFFSET, float(m[i]),
+                     float(em[i]), _pyvalue(K[i])) for i in range(len(t))]
+         self._execute(insrt, rows)
+         newK = dict([(name,1) for name in new])
+         Ks = [k for k in self.Ks if k[1] not in newK]
+      else:
+         Ks = self.Ks
+
+      # SN attributes, one executemany per column
+      rows = {}
+      for name in self.attrs:
+         for attr,value in self.attrs[name].items():
+            field = sql.sql_field(attr)
+            if field not in sql.SN_table_info:  continue
+            rows.setdefault(field, []).append((value, name))
+      for field in rows:
+         updt = '''UPDATE %s SET %s = %%s where %s = %%s''' % \
+               (sql.SN_TABLE, field, sql.SN_ID)
+         self._execute(updt, rows[field])
+
+      # K-corrections
+      field = sql.PHOTO_ATTR_KEYS.get('K', 'K')
+      if Ks and field in sql.PHOTO_table_info:
+         updt = '''UPDATE %s set %s = %%s where %s = %%s and %s = %%s '''\
+               '''and abs(%s - %%s) < %g''' % (sql.PHOTO_TABLE, field,
+               sql.PHOTO_ID, sql.PHOTO_FILT, sql.PHOTO_JD, self.tol)
+         self._execute(updt, Ks)
+
+   def flush(self):
+      '''Write all the pending updates to the database in a single
+      transaction. Returns the number of SNe written.'''
+      if not self.sne:  return 0
+      sql = self.sql
+      if sql.readonly:
+         raise ValueError, "Database is read-only"
+      if self.Ks and type(sql.PHOTO_TABLE) is type([]):
+         raise TypeError, "K-corrections cannot be written to table joins"
+      was_connected = sql.connected
+      sql.attach()
+      try:
+         n = 0
+         while True:
+            try:
+               self._write()
+               sql.con.commit()
+               break
+            except Exception, e:
+               sql.con.rollback()
+               if not _conflict(e) or n >= self.retries:
+                  raise
+               time.sleep(self.wait*2**n)
+               n += 1
+      finally:
+         if not was_connected:
+            sql.close()
+      N = len(self.sne)
+      self.clear()
+      return N
+
 databases = \
    {'default':(sql_csp2, "Working CSP2 database at LCO"),
     'SBS':(sql_SBS_csp2, "Working CSP2 database at SBS"),
     'LCOpub':(sql_csp2_pub, "Published CP2 database at LCO"),
     'SBSpub':(sql_SBS_csp2_pub, "Published CSP2 database at SBS"),
-    'highz':(sql_highz, "Highz database at SBS")}
+    'highz':(sql_highz, "Highz database at SBS"),
+    'sqlite':(sql_sqlite, "Local SQLite database (file in $SQL_SQLITE)")}
 
 default_sql = databases['default'][0]()
 
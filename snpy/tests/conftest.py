@@ -0,0 +1,19 @@
+import pytest
+
+@pytest.fixture
+def offline_sn():
+   '''SN2006ax, with no plotting and E(B-V)gal set to 0 if IRSA could not be
+   reached.'''
+   import snpy
+   s = snpy.get_sn('SN2006ax.txt')
+   if s.EBVgal is None:  s.EBVgal = 0.0   # offline
+   s.replot = 0
+   return s
+
+@pytest.fixture
+def fitted_sn(offline_sn):
+   '''SN2006ax fit with EBV_NIR_model2 (st) in B, V, r and i, without
+   k-corrections.'''
+   offline_sn.choose_model('EBV_NIR_model2', stype='st')
+   offline_sn.fit(['B','V','r','i'], dokcorr=False)
+   return offline_sn
@@ -0,0 +1,42 @@
+import pytest
+import numpy as num
+
+@pytest.fixture
+def snobj():
+   import snpy
+   s = snpy.get_sn('SN2006ax.txt')
+   if s.EBVgal is None:  s.EBVgal = 0.0   # offline
+   s.replot = 0
+   s.choose_model('EBV_NIR_model2')
+   s.fit(['B','V'], dokcorr=0)
+   return s
+
+def test_fitstore(snobj):
+   from snpy import fitstore
+   db = fitstore.FitStore(':memory:')
+   fid = db.add(snobj, options={'bands':['B','V']})
+   name = snobj.name
+   snobj.name = 'other'
+   db.add(snobj)
+   snobj.name = name
+   db.add(snobj)
+   res = db.query(['Tmax','st'], columns=['id','name'])
+   assert list(res['name']) == ['other', name]
+   assert num.allclose(res['Tmax'], snobj.model.parameters['Tmax'])
+   assert num.allclose(res['e_st'], snobj.model.errors['st'])
+   assert num.alltrue(num.isnan(res['sys_st']))
+   res = db.query(['Tmax'], name=name, latest=False)
+   assert len(res['Tmax']) == 2
+   params,C = db.get_covar(fid)
+   i = params.index('Tmax')
+   assert num.allclose(C[i,i], snobj.model.C['Tmax']['Tmax'])
+   assert db.get_options(fid)['bands'] == ['B','V']
+
+def test_fit_store_systematics(snobj, tmpdir):
+   from snpy import fitstore
+   dbfile = str(tmpdir.join('fits.db'))
+   snobj.fit(['B','V'], dokcorr=0, store=dbfile)
+   db = fitstore.FitStore(dbfile)
+   res = db.query(['DM'])
+   db.close()
+   assert num.allclose(res['sys_DM'], snobj.systematics()['DM'])
@@ -0,0 +1,46 @@
+import os
+import sys
+import json
+import subprocess
+import pytest
+import snpy
+
+# Budget (seconds) for a bare "import snpy". Wall-clock time depends on the
+# machine, so it is only checked if SNPY_IMPORT_BUDGET is set.
+budget = os.environ.get('SNPY_IMPORT_BUDGET', None)
+
+# Modules that should only be loaded when they are first used
+deferred = ['matplotlib', 'astropy', 'emcee', 'corner', 'pymysql',
+            'snpy.plot_sne_mpl', 'snpy.snemcee', 'snpy.get_osc']
+
+code = '''
+import sys, time, json
+t0 = time.time()
+import snpy
+t = time.time() - t0
+print(json.dumps({"time":t, "loaded":[m for m in %r if sys.modules.get(m)],
+   "cubes":list(dict.keys(snpy.kcorr.SED_cubes)),
+   "filter_read":snpy.fset["B"].__dict__["wave_data"] is not None}))
+''' % (deferred,)
+
+def import_snpy():
+   root = os.path.dirname(os.path.dirname(os.path.abspath(snpy.__file__)))
+   env = dict(os.environ)
+   env['PYTHONPATH'] = os.pathsep.join([root] + \
+         [p for p in [env.get('PYTHONPATH')] if p])
+   p = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE,
+         env=env)
+   out = p.communicate()[0]
+   assert p.returncode == 0
+   return json.loads(out.strip().split('\n')[-1])
+
+def test_import_deferred():
+   res = import_snpy()
+   assert res['loaded'] == []
+   assert res['cubes'] == []
+   assert not res['filter_read']
+
+@pytest.mark.skipif(budget is None, reason="SNPY_IMPORT_BUDGET is not set")
+def test_import_time():
+   res = [import_snpy() for i in range(3)]
+   assert min([r['time'] for r in res]) < float(budget)
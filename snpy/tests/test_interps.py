@@ -8,6 +8,7 @@ allresults = {'chebyshev': 828.730,
            'hermiteE': 828.730,
            'hyperspline': 827.426,
            'laguerre': 828.730,
+           'npgp': 827.183,
            'polynomial': 828.730,
            'spline': 827.290,
            'spline2': 827.426}
@@ -28,3 +29,31 @@ for func in funcs:
 def test_interp(snobj, func, Tmax):
    snobj.B.template(method=func)
    assert round(Tmax,3) == round(snobj.B.Tmax,3)
+
+def test_npgp(snobj):
+   import numpy as num
+   snobj.B.template(method='npgp')
+   gp = snobj.B.interp
+   x = num.linspace(gp.x.min(), gp.x.max(), 7)
+   # analytic gradient of the marginal likelihood
+   lnl,grad = gp.lnlike(grad=True)
+   amp = gp.amp
+   gp.amp = amp*num.exp(1e-5);  l1 = gp.lnlike()
+   gp.amp = amp*num.exp(-1e-5); l2 = gp.lnlike()
+   gp.amp = amp
+   assert abs((l1 - l2)/2e-5 - grad[0]) < 1e-4*abs(grad[0])
+   scale = gp.scale
+   gp.scale = scale*num.exp(1e-5);  l1 = gp.lnlike()
+   gp.scale = scale*num.exp(-1e-5); l2 = gp.lnlike()
+   gp.scale = scale
+   assert abs((l1 - l2)/2e-5 - grad[1]) < 1e-4*abs(grad[1])
+   # analytic first derivative of the interpolant
+   h = 1e-4
+   d1 = (gp(x[1:-1] + h)[0] - gp(x[1:-1] - h)[0])/2/h
+   assert num.allclose(gp.deriv(x[1:-1], n=1), d1, rtol=1e-5, atol=1e-6)
+   # masking a point updates the factorization
+   gp.maskid(num.nonzero(gp.mask)[0][3])
+   y1,e1 = gp(x)[0],gp.error(x)
+   gp.setup = False
+   assert num.allclose(y1, gp(x)[0], rtol=0, atol=1e-9)
+   assert num.allclose(e1, gp.error(x), rtol=0, atol=1e-9)
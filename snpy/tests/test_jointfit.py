@@ -0,0 +1,35 @@
+import pytest
+import copy
+import numpy as num
+
+@pytest.fixture
+def sne(fitted_sn):
+   s = fitted_sn
+   sne = [s]
+   for i in range(2):
+      s2 = copy.deepcopy(s)
+      s2.name = s.name + '_%d' % i
+      sne.append(s2)
+   return sne
+
+def test_jointfit(sne):
+   from snpy import jointfit
+   m = sne[0].model
+   cal = m.calibration
+   a = m.a[cal].copy()
+   pars = dict(m.parameters)
+   jf = jointfit.JointFit(sne, DM={sne[0].name:m.DM}, hyper=['a'],
+         priors={'a_B':(a['B'], 0.01)})
+   assert jf.hnames == ['a_B','a_V','a_i','a_r']
+   res = jf.fit()
+   assert res.status > 0
+   # the models are left as they were
+   assert m.a[cal] == a
+   assert m.parameters == pars
+   for h in jf.hnames:
+      assert abs(jf.hyper[h] - a[h[2:]]) < 0.1
+      assert 0 < jf.ehyper[h] < 0.2
+   r = jf.results[sne[1].name]
+   assert abs(r['parameters']['st'] - m.st) < 0.02
+   assert r['parameters']['DM'] != m.DM
+   assert jf.results[sne[0].name]['parameters']['DM'] == m.DM
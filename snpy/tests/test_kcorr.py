@@ -3,6 +3,7 @@
 # This script creates a fake SN spectrum, puts it at several redshifts
 # and compares with kcorr
 
+import os
 import pytest
 from snpy import kcorr,getSED,fset,mangle_spectrum
 from numpy import *
@@ -34,3 +35,97 @@ def test_kcorr():
    # The mangling should be better and precise
    assert alltrue(delta2 < delta1) and alltrue(delta2 < 0.01)
    
+
+def test_redden_cache():
+   # cached extinction curves must give the same answer as computing them
+   from snpy.utils import deredden
+   wave0,flux0 = getSED(0, version="H3")
+   for redlaw in ['ccm','f99','fm07']:
+      deredden.clear_cache()
+      rflux1 = kcorr.redden(wave0, flux0, 0.05, 0.2, 0.1, redlaw=redlaw)
+      rflux2 = kcorr.redden(wave0, flux0, 0.05, 0.2, 0.1, redlaw=redlaw)
+      size = deredden.cache_size
+      deredden.cache_size = 0
+      rflux3 = kcorr.redden(wave0, flux0, 0.05, 0.2, 0.1, redlaw=redlaw)
+      deredden.cache_size = size
+      assert alltrue(rflux1 == rflux2)
+      assert allclose(rflux1, rflux3, rtol=1e-12, atol=0)
+   # a new R_V re-uses the cached CCM coefficients, and a view of the
+   # same wavelengths is recognized without re-hashing
+   waves = array([wave0, wave0])
+   for Rv in [2.0, 2.5]:
+      f1 = deredden.unred(waves[0], flux0, 0.1, R_V=Rv)[0]
+      size = deredden.cache_size
+      deredden.cache_size = 0
+      f2 = deredden.unred(wave0, flux0, 0.1, R_V=Rv)[0]
+      deredden.cache_size = size
+      assert allclose(f1, f2, rtol=1e-12, atol=0)
+   assert deredden._wave_key(waves[0]) == deredden._wave_key(waves[0])
+   wave1 = wave0*1.0
+   key = deredden._wave_key(wave1)
+   wave1[-1] += 1.0
+   assert deredden._wave_key(wave1) != key
+
+def test_kcorr_block():
+   # epoch-vectorized K-corrections must agree with one SED at a time
+   days = arange(-25, 75, 5)
+   ks,mask = kcorr.kcorr(days, 'B', 'V', 0.05, ebv_host=0.1)
+   for i,day in enumerate(days):
+      wave,flux = getSED(day, version='H3')
+      if wave is None:
+         assert mask[i] == 0 and ks[i] == 0
+         continue
+      rflux = kcorr.redden(wave, flux, 0, 0.1, 0.05)
+      k,f = kcorr.K(wave, rflux, fset['B'], fset['V'], 0.05)
+      assert mask[i] == f and absolute(ks[i] - k) < 1e-6
+
+def test_sed_provider():
+   # the provider must serve the same SEDs as slicing the cube directly,
+   # in bulk or one at a time, stretched or not.
+   prov = kcorr.SEDProvider(kcorr.SED_cubes, kcorr.SED_lims, cache_size=4)
+   days = array([-25., -10., 0., 3.5, 20., 80.])
+   wave,fluxes,mask = prov.get_SEDs(days, 'H3', stretch=1.2)
+   assert len(prov._cache) <= 4
+   for i,day in enumerate(days):
+      w,f = kcorr.get_SED(day/1.2, 'H3')
+      if w is None:
+         assert not mask[i] and alltrue(fluxes[i] == 0)
+      else:
+         assert mask[i] and allclose(fluxes[i], f, rtol=1e-6, atol=0)
+         w,f2 = prov.get_SED(day, 'H3', stretch=1.2)
+         assert allclose(f2, f, rtol=1e-6, atol=0)
+   # without interpolation, the nearest epoch after stretching
+   wave,fluxes,mask = prov.get_SEDs(days, 'H3', stretch=1.2, 
+         interpolate=False)
+   for i,day in enumerate(days):
+      if not mask[i]:  continue
+      w,f = prov.get_SED(float64(day), 'H3', stretch=1.2, interpolate=False)
+      assert alltrue(fluxes[i] == f)
+      w,f = kcorr.get_SED(round(day/1.2), 'H3')
+      assert allclose(fluxes[i], f, rtol=1e-6, atol=0)
+
+def test_sed_cache(tmpdir):
+   # cubes are cached as .npy files and memory-mapped after that; float32
+   # cubes must give the same k-corrections as float64 to well below the
+   # photometric errors.
+   cubes = {}
+   for prec in ['float64','float32']:
+      c = kcorr.SEDCubes(kcorr.SED_files, str(tmpdir), prec)
+      c['H3']
+      assert os.path.isfile(c.cache_files('H3')[1])
+      c.clear()
+      wave,cube,off = c['H3']
+      assert cube.dtype == dtype(prec) and not cube.flags.writeable
+      assert allclose(cube, kcorr.SED_cubes['H3'][1], rtol=1e-7, atol=0)
+      cubes[prec] = c
+
+   days = arange(-10, 40, 2.5)
+   filts = ['B','V','r','i','Y','J','H']
+   ks = {}
+   for prec in cubes:
+      prov = kcorr.SEDProvider(cubes[prec], kcorr.SED_lims)
+      wave,fluxes,mask = prov.get_SEDs(days, 'H3', stretch=1.1)
+      fluxes = kcorr.redden(wave, fluxes, 0.02, 0.2, 0.05)
+      ks[prec] = array([kcorr.K(wave, fluxes, fset[f], fset[f], 0.05)[0] \
+            for f in filts])
+   assert absolute(ks['float32'] - ks['float64']).max() < 1e-4
@@ -56,3 +56,63 @@ def test_mangle_lstsq():
       p_diff = sum((mflux[0][gids]-rflux[gids])/rflux[gids])/sum(gids)*100
       assert(p_diff < 0.1)
 
+
+def test_mangle_linear_block():
+   # Mangling a block of spectra at once should agree with mangling them
+   # one at a time
+   filters = ['u','B','V','r','i','Y','J','H']
+
+   waves,fluxes,rfluxes,mags = [],[],[],[]
+   for day in [-5,0,10]:
+      wave0,flux0 = getSED(day, version="H3")
+      rflux = kcorr.redden(wave0,flux0, 0.1, 0.0, 0.0)
+      fluxes.append(flux0)
+      mags.append([fset[f].synth_mag(wave0, rflux) for f in filters])
+   fluxes = array(fluxes)
+   mags = array(mags)
+
+   mfluxes,state,pars = mangle_spectrum.mangle_spectra_linear(wave0, fluxes,
+         filters, mags)
+   for i in range(len(fluxes)):
+      mflux,awaves,pars = mangle_spectrum.mangle_spectrum2(wave0, fluxes[i],
+            filters, mags[i], method='bspline')
+      assert alltrue(absolute(mfluxes[i] - mflux[0]) <= 1e-6*absolute(mflux[0]))
+
+def test_mangle_lsq_solver():
+   # The least-squares solver with analytic derivatives should agree with
+   # mpfit
+   filters = ['u','B','V','r','i','Y','J','H']
+
+   wave0,flux0 = getSED(0, version="H3")
+   rflux = kcorr.redden(wave0,flux0, 0.1, 0.0, 0.0)
+   mags = array([fset[f].synth_mag(wave0, rflux) for f in filters])
+
+   m = mangle_spectrum.mangler(wave0, flux0, 'ccm')
+   m.function.set_pars([0.1, 2.5])
+   D = m.function.deriv(m.wave)
+   f0 = m.function(m.wave)
+   m.function.set_pars([0.1+1e-6, 2.5])
+   assert alltrue(absolute((m.function(m.wave) - f0)/1e-6 - D[0]) < 1e-3)
+
+   res = {}
+   for solver in ['mpfit','lsq']:
+      mflux,awaves,pars = mangle_spectrum.mangle_spectrum2(wave0,flux0, 
+            filters, mags, method='ccm', lstsq=False, solver=solver)
+      res[solver] = pars
+   assert alltrue(absolute(array(res['lsq']) - array(res['mpfit'])) < 1e-4)
+
+@pytest.mark.skipif(mangle_spectrum.tspline is None, 
+      reason="tspack is not available")
+def test_tsval_array():
+   # Evaluating a grid of wavelengths in one call should agree with
+   # evaluating one spectrum at a time
+   tspline = mangle_spectrum.tspline
+   x = array([3000., 4000., 6000., 9000., 12000.])
+   xyds = tspline.tspsi(x, array([1.0, 1.2, 0.9, 1.1, 1.3]), tension=1.0)
+   waves = array([linspace(3000, 12000, 50), linspace(3500, 11000, 50)])
+   for degree in [0,1]:
+      res = tspline.tsval(waves, xyds, degree)
+      assert res.shape == waves.shape
+      for i in range(waves.shape[0]):
+         assert alltrue(absolute(res[i] - tspline.tsval1(waves[i], xyds,
+            degree)) < 1e-10)
@@ -57,3 +57,89 @@ def test_model(snobj, model, result):
    res = [round(snobj.model.parameters[key],3) == round(result[key],3) \
          for key in result]
    assert num.alltrue(res)
+
+def test_kcorr_evaluator():
+   import scipy.interpolate
+   from snpy.model import kcorr_evaluator
+   num.random.seed(1)
+   MJD = num.sort(num.random.uniform(0, 60, 30))
+   K = num.random.normal(0, 0.1, 30)
+   mask = num.random.uniform(size=30) > 0.3
+   t = num.random.uniform(-20, 80, 500)
+   for k in [1,3]:
+      tck = scipy.interpolate.splrep(MJD, K, k=k, s=0)
+      Ks,m = kcorr_evaluator(tck, mask, MJD)(t)
+      # brute force:  clamped splev and nearest observation
+      Kb = scipy.interpolate.splev(num.clip(t, MJD[0], MJD[-1]), tck)
+      mb = mask[num.argmin(num.absolute(t[:,num.newaxis] - MJD), axis=1)]
+      assert num.allclose(Ks, Kb, atol=1e-12)
+      assert num.all(m == mb)
+
+def test_get_max(fitted_sn):
+   from scipy.optimize import brent
+   m = fitted_sn.model
+   bands = ['u','B','V','r','i','Y','J','H']
+   rbands = [fitted_sn.restbands[b] for b in bands]
+   x0s = m.template_peaks(rbands, 1.0)
+   m.template.mktemplate(1.0)
+   for rb,x0 in zip(rbands, x0s):
+      xb = brent(lambda x: m.template.eval(rb, x, gen=m.gen)[0], brack=(0.,5.))
+      assert abs(x0 - xb) < 1e-4
+   # cached results for unchanged parameters, new ones when they change
+   res1 = m.get_max(bands)
+   assert m.get_max(bands) == res1
+   m.parameters['st'] = 1.1
+   res2 = m.get_max(bands)
+   assert res2[0] != res1[0]
+   assert num.allclose(res2[0], m._get_max(bands)[0])
+
+def test_mc_systematics(fitted_sn):
+   s1 = fitted_sn.systematics(mc=True, N=3000, chunk=1000, seed=42)
+   DM1 = fitted_sn.model.mc_samples['DM']
+   s2 = fitted_sn.systematics(mc=True, N=3000, chunk=1000, seed=42,
+         processes=2)
+   assert num.all(fitted_sn.model.mc_samples['DM'] == DM1)
+   assert s1['DM'] == s2['DM']
+   # coherent draws across filters follow the analytic convention
+   DM0 = fitted_sn.systematics()['DM']
+   assert abs(s1['DM']/DM0 - 1) < 0.05
+   s3 = fitted_sn.systematics(mc=True, N=3000, chunk=1000, seed=42, 
+         correlated=False)
+   assert 0 < s3['DM'] < s1['DM']
+   assert abs(num.mean(DM1) - fitted_sn.DM) < 0.01
+
+def test_multistart(offline_sn):
+   offline_sn.choose_model('EBV_NIR_model2', stype='st')
+   # a bad initial Tmax, 3 weeks early
+   offline_sn.model.parameters['Tmax'] = 805.
+   offline_sn.fit(['B','V','r','i'], dokcorr=False, multistart=4)
+   assert abs(offline_sn.Tmax - 827.5) < 0.5
+   assert abs(offline_sn.st - 1.0) < 0.1
+
+def test_profile(fitted_sn):
+   pars = dict(fitted_sn.model.parameters)
+   Ts = fitted_sn.Tmax + num.arange(-2, 2.1, 1.0)
+   res = fitted_sn.model.profile('Tmax', Ts)
+   assert fitted_sn.model.parameters == pars
+   assert fitted_sn.grids[('Tmax',)] is res
+   # the minimum of the profile is the best fit
+   assert num.argmin(res['chisq']) == 2
+   assert abs(res['dchisq'][2]) < 1e-3
+   assert abs(res['pars']['st'][2] - fitted_sn.st) < 1e-3
+   # over a subset of the bands, dchisq is relative to those bands only
+   res = fitted_sn.model.profile('Tmax', Ts, bands=['B','V'])
+   assert fitted_sn.model.parameters == pars
+   assert res['dchisq'].min() >= -1e-6
+
+def test_fitLaplace(fitted_sn):
+   pytest.importorskip('emcee')
+   st = fitted_sn.st
+   fitted_sn.fitLaplace(['B','V','r','i'])
+   assert abs(fitted_sn.st - st) < 0.01
+   assert 0 < fitted_sn.model.errors['st'] < 0.01
+   assert abs(fitted_sn.model.C['st']['st'] - 
+         fitted_sn.model.errors['st']**2) < 1e-12
+   # a tight prior pulls the solution and shrinks the error
+   fitted_sn.fitLaplace(['B','V','r','i'], st='G,1.1,0.001')
+   assert abs(fitted_sn.st - 1.1) < 0.01
+   assert fitted_sn.model.errors['st'] < 0.001
@@ -0,0 +1,11 @@
+from snpy.utils import pmap
+
+def _scale(x):
+   return pmap.get_state()*x
+
+def test_pmap():
+   jobs = range(10)
+   assert pmap.pmap(_scale, jobs, 1, 3) == [3*x for x in jobs]
+   assert pmap.pmap(_scale, jobs, 2, 3) == [3*x for x in jobs]
+   # the state is only set while mapping
+   assert pmap.get_state() is None
@@ -112,6 +112,27 @@ def test_mask_SNR(snobj):
 def test_closest_band(snobj):
    assert snobj.closest_band('B', ['Bs','Vs','Rs','Is']) == 'Bs'
 
+def test_restband_cache(snobj):
+   import sys
+   import snpy
+   snmod = sys.modules['snpy.sn']
+   tbands = ['u','B','V','g','r','i']
+   snmod.clear_restbands()
+   snobj.z = 0.3012
+   assert snobj.closest_band('r', tbands) == \
+         snmod.find_closest_band('r', tbands, 0.3012)
+   assert len(snmod._restband_cache) == 1
+   snpy.set_restband_dz(0.001)
+   try:
+      snmod.precompute_restbands(['B','r'], [0.3], tbands)
+      assert len(snmod._restband_cache) == 2
+      snobj.z = 0.3002
+      assert snobj.closest_band('r', tbands) == \
+            snmod.find_closest_band('r', tbands, 0.3)
+      assert len(snmod._restband_cache) == 2
+   finally:
+      snpy.set_restband_dz(0)
+
 def test_save_load(snobj):
    import snpy
    snobj.save('temp.snpy')
@@ -119,3 +140,26 @@ def test_save_load(snobj):
    assert snobj == t
 
 
+
+def test_profile_fit(offline_sn):
+   from snpy.utils import profiler
+   with profiler.profiling(offline_sn.name) as prof:
+      offline_sn.fit(['B','V'], dokcorr=0)
+   rec = prof.as_dict()
+   assert profiler.active() is None
+   assert rec['stages']['initial_fit']['calls'] == 1
+   assert len(rec['fits']) == 1 and rec['fits'][0]['nfev'] > 0
+   assert rec['counters']['model_evals'] == rec['fits'][0]['nfev']
+   assert rec['counters']['filter.response'] > 0
+
+def test_refit(offline_sn):
+   # with no new data, a refit re-uses every mangled k-correction and
+   # stays at the same solution
+   offline_sn.fit(['B','V','r','i'])
+   pars = offline_sn.model.parameters.copy()
+   m_opts = offline_sn.ks_cache['m_opts']
+   offline_sn.refit(['B','V','r','i'])
+   assert all([a is b for a,b in zip(m_opts, offline_sn.ks_cache['m_opts'])])
+   for p in pars:
+      assert abs(pars[p] - offline_sn.model.parameters[p]) < \
+            0.1*offline_sn.model.errors[p]
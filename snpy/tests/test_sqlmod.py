@@ -0,0 +1,110 @@
+import os
+import numpy as num
+import snpy
+from snpy import sqlmod
+
+base = os.path.dirname(__file__)
+
+def make_db(dbfile):
+   '''Fill an SQLite stand-in database with SN2006ax and a renamed copy.'''
+   s = snpy.get_sn(os.path.join(base, 'SN2006ax.txt'))
+   db = sqlmod.sql_sqlite(dbfile)
+   db.create_tables()
+   db.attach()
+   for name in ['SN2006ax', 'SN2006xx']:
+      db.c.execute('INSERT INTO SNe (name,ra,decl,z) VALUES (%s,%s,%s,%s)',
+            (name, s.ra, s.decl, s.z))
+      for f in s.data:
+         d = s.data[f]
+         db.c.executemany('INSERT INTO Photo (name,filter,JD,m,e_m,K) '\
+               'VALUES (%s,%s,%s,%s,%s,%s)',
+               [(name, f, d.MJD[i] + 2400000.5, d.magnitude[i], d.e_mag[i],
+                 0.0) for i in range(len(d.MJD))])
+   db.close()
+   return s,db
+
+def test_fetch_SNe(tmpdir):
+   s,db = make_db(str(tmpdir.join('snpy.sqlite')))
+   res = db.fetch_SNe(['SN2006ax', 'SN2006xx', 'SN2099zz'])
+   assert sorted(res.keys()) == ['SN2006ax', 'SN2006xx']
+   assert num.allclose(res['SN2006xx']['z'], s.z)
+   for f in s.data:
+      assert num.allclose(res['SN2006ax']['data'][f]['t'], s.data[f].MJD)
+      assert num.allclose(res['SN2006ax']['data'][f]['m'],
+            s.data[f].magnitude)
+
+   # The one-at-a-time path gives the same answer
+   assert db.connect('SN2006ax') == 1
+   data = db.get_SN_photometry()
+   db.close()
+   for f in s.data:
+      assert num.allclose(data[f]['em'], res['SN2006ax']['data'][f]['em'])
+
+   sne = snpy.get_sn_list(['SN2006xx', 'SN2099zz'], sql=db)
+   assert sne[1] is None
+   assert sorted(sne[0].data.keys()) == sorted(s.data.keys())
+   assert sne[0].restbands['B'] == s.restbands['B']
+   sqlmod.pool.clear()
+
+def test_batch_writer(tmpdir):
+   s,db = make_db(str(tmpdir.join('snpy.sqlite')))
+   db.attach()
+   for col in ['Tmax','e_Tmax','Tmax_B']:
+      db.c.execute('ALTER TABLE SNe ADD COLUMN %s REAL' % col)
+   db.close()
+   sne = snpy.get_sn_list(['SN2006ax', 'SN2006xx'], sql=db)
+   s.name = 'SN2006yy'                          # not yet in the DB
+   sne.append(s)
+   w = sqlmod.BatchWriter(db, chunk=7)
+   for i,obj in enumerate(sne):
+      obj.model.parameters['Tmax'] = 53827. + i
+      obj.model.errors['Tmax'] = 0.1
+      obj.data['B'].Tmax = 53826. + i
+      for f in obj.data:
+         obj.data[f].K = num.arange(len(obj.data[f].MJD))*0.01 + i
+      obj.update_sql(writer=w)
+   assert len(w) == 3
+   assert w.flush() == 3
+
+   res = db.fetch_SNe(['SN2006ax', 'SN2006xx', 'SN2006yy'])
+   for i,obj in enumerate(sne):
+      for f in obj.data:
+         assert num.allclose(res[obj.name]['data'][f]['K'], obj.data[f].K)
+      db.connect(obj.name)
+      assert db.get_SN_parameter('Tmax') == 53827. + i
+      assert db.get_SN_parameter('e_Tmax') == 0.1
+      assert db.get_SN_parameter('Tmax_B') == 53826. + i
+      db.close()
+   sqlmod.pool.clear()
+
+def test_batch_writer_rollback(tmpdir):
+   # A failed flush must not leave new SNe without their photometry
+   s,db = make_db(str(tmpdir.join('snpy.sqlite')))
+   db.attach()
+   db.c.execute("CREATE TRIGGER nophot BEFORE INSERT ON Photo WHEN "\
+         "NEW.filter = 'B' BEGIN SELECT RAISE(ABORT, 'no B'); END")
+   db.con.commit()
+   db.close()
+   s.name = 'SN2006yy'
+   for f in s.data:
+      s.data[f].K = None
+   w = sqlmod.BatchWriter(db)
+   s.update_sql(writer=w)
+   try:
+      w.flush()
+      assert False, "flush should have failed"
+   except Exception:
+      pass
+   assert db.fetch_SNe(['SN2006yy']) == {}
+
+   db.attach()
+   db.c.execute("DROP TRIGGER nophot")
+   db.con.commit()
+   db.close()
+   assert w.flush() == 1
+   res = db.fetch_SNe(['SN2006yy'])
+   for f in s.data:
+      assert len(res['SN2006yy']['data'][f]['t']) == len(s.data[f].MJD)
+      # no k-corrections are stored as NULL
+      assert all([K is None for K in res['SN2006yy']['data'][f]['K']])
+   sqlmod.pool.clear()
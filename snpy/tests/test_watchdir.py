@@ -0,0 +1,48 @@
+import os
+import json
+import time
+from snpy.utils import watchdir
+
+def copy_fitter(filename, workdir):
+   # stand-in for a fit: one product derived from the input
+   text = open(filename).read()
+   if 'bad' in text:
+      raise ValueError("bad photometry")
+   name = os.path.splitext(os.path.basename(filename))[0]
+   f = open(os.path.join(workdir, name+'.fit'), 'w')
+   f.write(text.upper())
+   f.close()
+   return {'nchar':len(text)}
+
+def write(path, text):
+   f = open(path, 'w')
+   f.write(text)
+   f.close()
+
+def test_watchdir(tmpdir):
+   inbox = str(tmpdir.join('in'))
+   outbox = str(tmpdir.join('out'))
+   w = watchdir.WatchDir(inbox, outbox, copy_fitter, pattern='*.dat',
+         debounce=0, workers=0, max_queue=1)
+   write(os.path.join(inbox, 'a.dat'), 'sn a')
+   write(os.path.join(inbox, 'b.dat'), 'bad')
+   write(os.path.join(inbox, 'c.txt'), 'ignored')
+
+   # back-pressure: only one file is queued per pass
+   assert w.scan() == [os.path.join(inbox, 'a.dat')]
+   w.dispatch()
+   assert [s for f,s in w.collect()] == ['ok']
+   w.run(until_idle=True)
+   assert w.nfit == 1 and w.nfail == 1
+   assert open(os.path.join(outbox, 'a.fit')).read() == 'SN A'
+   rec = json.load(open(os.path.join(outbox, 'b.status.json')))
+   assert rec['status'] == 'failed' and 'bad photometry' in rec['info']['error']
+   assert os.listdir(os.path.join(outbox, '.staging')) == []
+   assert not os.path.exists(os.path.join(outbox, 'c.status.json'))
+
+   # nothing to do until a file is modified
+   assert w.poll() == []
+   write(os.path.join(inbox, 'a.dat'), 'sn a, night 2')
+   os.utime(os.path.join(inbox, 'a.dat'), (time.time()+10, time.time()+10))
+   assert w.poll() == [(os.path.join(inbox, 'a.dat'), 'ok')]
+   assert open(os.path.join(outbox, 'a.fit')).read() == 'SN A, NIGHT 2'
@@ -129,6 +129,18 @@ def tsval1(x, xydt, degree=0, verbose=0):
    elif ier == -2:
       raise ValueError, "x values are not strictly increasing"
 
+def tsval(x, xydt, degree=0, verbose=0):
+   '''Evaluate the tension spline xydt (from tspsi or tspss) at the points x,
+   an array of any shape (e.g., a grid of wavelengths for several spectra),
+   with a single call to TSVAL1. degree is the order of the derivative
+   (0, 1 or 2) or a list of them, in which case a list of arrays is
+   returned, one for each degree.'''
+   if type(degree) in [type([]), type(())]:
+      return [tsval(x, xydt, d, verbose) for d in degree]
+   x = asarray(x, dtype=float64)
+   y = tsval1(ravel(x), xydt, degree, verbose)
+   return reshape(y, x.shape)
+
 
 
 
@@ -5,6 +5,7 @@ and extract E(B-V)'''
 import urllib
 import re
 from xml.dom.minidom import parse
+from snpy.utils import profiler
 
 debug = 0
 
@@ -16,6 +17,7 @@ def get_dust_RADEC(ra, dec, calibration="SF11"):
    You can specify calibration of "SF11" or "SFD98"'''
    if debug:
       print "get_dust_RADEC:  Querying URL:  ",BASE_URL % (ra,dec)
+   profiler.count('IRSA.query')
    try:
       u = urllib.urlopen(BASE_URL % (ra,dec))
    except:
@@ -43,6 +45,7 @@ def get_dust_sigma_RADEC(ra, dec, calibration="SF11"):
    You can specify calibration of "SF11" or "SFD98"'''
    if debug:
       print "get_dust_RADEC:  Querying URL:  ",BASE_URL % (ra,dec)
+   profiler.count('IRSA.query')
    try:
       u = urllib.urlopen(BASE_URL % (ra,dec))
    except:
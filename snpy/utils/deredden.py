@@ -12,6 +12,15 @@ from scipy.interpolate import interp1d
 
 import numpy as num
 from scipy.interpolate import UnivariateSpline
+from collections import OrderedDict
+import weakref
+
+# Maximum number of extinction curves (one per reddening law, R_V, z and
+# wavelength grid) that unred() keeps around. Set to 0 to disable caching.
+cache_size = 64
+_curve_cache = OrderedDict()
+# Hashes of the wavelength grids, keyed by their memory (see _wave_key)
+_wave_keys = {}
 
 def poly(x, c):
    ret = 0
@@ -378,44 +387,121 @@ def unred(wave, flux, ebv, R_V = 3.1, z=0, redlaw='ccm', strict_ccm=0):
       srict_ccm (bool):  If True and redlaw='ccm', ignore changes by
                         O'Donnel (1994)
 
+   The extinction curve for a given reddening law, R_V, z and wavelength
+   grid is cached (see :data:`cache_size`), so repeated calls on the same
+   SED wavelengths only cost a multiplication.
+
    Returns:
       3-tuple:  (uflux, a, b)
                 uflux: un-reddened flux
                 a,b:  The equivalent of the CCM a and b parameters.
    '''
 
+   R_lambda,a,b,factors = _get_curve(wave, R_V, z, redlaw, strict_ccm)
+   fac = factors.get(ebv, None)
+   if fac is None:
+      fac = num.power(10.0, 0.4*ebv*R_lambda)
+      if len(factors) > 8:  factors.clear()
+      factors[ebv] = fac
+   unred_flux = flux * fac
+   return(unred_flux, a , b)
+
+def clear_cache():
+   '''Empty the cache of extinction curves used by :func:`unred`.'''
+   _curve_cache.clear()
+   _wave_keys.clear()
+
+def _wave_key(wave):
+   '''A cache key for the 1D wavelength array [wave]. The whole array is
+   only hashed the first time its memory is seen: later calls with the same
+   array, or a new view of the same memory, are matched by data pointer
+   and layout, as long as the array that owns the memory is still alive and
+   the end-points have not changed.'''
+   key = (wave.shape[0], wave.dtype.str)
+   if wave.shape[0] == 0:
+      return key
+   owner = wave
+   while isinstance(owner.base, num.ndarray):
+      owner = owner.base
+   mem = (wave.__array_interface__['data'][0], wave.shape, wave.strides,
+          wave.dtype.str)
+   entry = _wave_keys.get(mem, None)
+   if entry is not None:
+      ref,w0,w1,key = entry
+      if ref() is owner and w0 == wave[0] and w1 == wave[-1]:
+         return key
+   key = key + (hash(wave.tostring()),)
+   try:
+      ref = weakref.ref(owner)
+   except TypeError:
+      return key
+   if len(_wave_keys) > 4*cache_size:  _wave_keys.clear()
+   _wave_keys[mem] = (ref, wave[0], wave[-1], key)
+   return key
+
+def _get_curve(wave, R_V, z, redlaw, strict_ccm):
+   '''Returns (R_lambda, a, b, factors), where R_lambda = A_lambda/E(B-V)
+   for the reddening law at wavelengths wave*(1+z), a,b are the CCM-like
+   coefficients returned by unred() and factors is a dictionary of
+   10**(0.4*ebv*R_lambda) keyed by ebv. Results are memoized in a
+   least-recently-used cache keyed by the law, R_V, z, strict_ccm and the
+   wavelength grid (see _wave_key()). For the laws that are linear in R_V,
+   a and b are also cached independently of R_V.'''
+   key = None
+   if cache_size > 0 and isinstance(wave, num.ndarray) and len(wave.shape) == 1:
+      key = (redlaw, float(R_V), float(z), bool(strict_ccm)) + \
+            _wave_key(wave)
+      entry = _curve_cache.pop(key, None)
+      if entry is not None:
+         # put it back as most recently used
+         _curve_cache[key] = entry
+         return entry
+
    if z > 0:
       wave = wave*(1+z)
   
-   if redlaw == 'ccm':
-      a,b = ccm(wave, strict_ccm)
-      # note CCM gives A_lambda/A_V = a + b/Rv
-      # therefore, A_lambda = E(B-V)*R_V*(a + b/Rv) = ebv*(a*R_V + b)
-      A_lambda = ebv * (a*R_V + b)
-      unred_flux = flux * num.power(10.0, 0.4*A_lambda)
-   elif redlaw == 'nataf':
-      a,b = nataf(wave, strict_ccm)
+   if redlaw in ['ccm','nataf']:
+      # a and b do not depend on R_V, so they are cached on their own and
+      # a new R_V (e.g., while fitting it) only costs a multiply-add.
+      ab = None
+      if key is not None:
+         abkey = (redlaw, None) + key[2:]
+         ab = _curve_cache.pop(abkey, None)
+      if ab is None:
+         if redlaw == 'ccm':
+            ab = ccm(wave, strict_ccm)
+         else:
+            ab = nataf(wave, strict_ccm)
+      if key is not None:
+         for arr in ab:
+            if isinstance(arr, num.ndarray):  arr.setflags(write=False)
+         _curve_cache[abkey] = ab
+      a,b = ab
       # note CCM gives A_lambda/A_V = a + b/Rv
       # therefore, A_lambda = E(B-V)*R_V*(a + b/Rv) = ebv*(a*R_V + b)
-      A_lambda = ebv * (a*R_V + b)
-      unred_flux = flux * num.power(10.0, 0.4*A_lambda)
+      R_lambda = a*R_V + b
    elif redlaw == 'fm' or redlaw == 'f99':
       R_lambda = fm(wave, R_V, avglmc=False, lmc2=False)
-      A_lambda = ebv*R_lambda
-      unred_flux = flux * num.power(10.0, 0.4*A_lambda)
       # This is a little trick to return an a and b like CCM
       a = R_lambda/R_V
       b = R_lambda*0
    elif redlaw == 'fm07':
       R_lambda = fm07(wave, R_V)
-      A_lambda = ebv*R_lambda
-      unred_flux = flux * num.power(10.0, 0.4*A_lambda)
       # This is a little trick to return an a and b like CCM
       a = R_lambda/R_V
       b = R_lambda*0
    else:
       raise ValueError, "Unkwown reddening law %s" % redlaw
-   return(unred_flux, a , b)
+
+   entry = (R_lambda, a, b, {})
+   if key is not None:
+      # Cached arrays are shared, so make sure nobody modifies them
+      for arr in entry[:3]:
+         if isinstance(arr, num.ndarray):  arr.setflags(write=False)
+      _curve_cache[key] = entry
+      while len(_curve_cache) > cache_size:
+         _curve_cache.popitem(last=False)
+   return entry
 
 
 def R_z(wave, z, R_V = 3.1, strict_ccm=0):
@@ -6,7 +6,8 @@ extrama, etc.'''
 import numpy as num
 from snpy.utils import fit_spline
 from scipy.interpolate import splrep,splev,sproot
-from scipy.optimize import brentq, newton
+from scipy.optimize import brentq, newton, minimize
+from scipy.linalg import cholesky, cho_solve, solve_triangular
 from scipy.misc import derivative as deriv
 try:
    from snpy.spline2 import spline2, evalsp,eval_extrema,eval_x
@@ -25,9 +26,11 @@ try:
 except:
    pymc = None
 
-try:
-   import InteractiveFit
-except:
+from snpy.utils.lazy import lazy_import, available
+if available('matplotlib'):
+   # imported on first use
+   InteractiveFit = lazy_import('snpy.utils.InteractiveFit')
+else:
    InteractiveFit = None
 
 functions = {}
@@ -1132,6 +1135,347 @@ else:
    GaussianProcess = None
 
 
+def _chol_update(L, v):
+   '''In-place rank-one update of the lower Cholesky factor [L] so that
+   L*L^T becomes L*L^T + v*v^T. [v] is overwritten.'''
+   n = len(v)
+   for k in range(n):
+      r = num.hypot(L[k,k], v[k])
+      c = r/L[k,k]
+      s = v[k]/L[k,k]
+      L[k,k] = r
+      if k+1 < n:
+         L[k+1:,k] = (L[k+1:,k] + s*v[k+1:])/c
+         v[k+1:] = c*v[k+1:] - s*L[k+1:,k]
+
+def _chol_delete(L, j):
+   '''The lower Cholesky factor of the matrix factored by [L] with row and
+   column [j] removed (an O(n^2) rank-one update).'''
+   v = L[j+1:,j].copy()
+   L2 = num.delete(num.delete(L, j, axis=0), j, axis=1)
+   _chol_update(L2[j:,j:], v)
+   return L2
+
+class NumpyGP(oneDcurve):
+
+   def __init__(self, x, y, dy, mask=None, **args):
+      '''Fit a GP (Gaussian Process) to the data using only numpy/scipy. The
+      covariance function is Matern with parameters [scale], [amp] and
+      [diff_degree] (the number of times the function is differentiable:
+      0, 1 and 2 give Matern nu=1/2, 3/2 and 5/2, 3 or more a squared
+      exponential). [mean] is an optional mean function.
+
+      The Cholesky factor of the covariance matrix of the data and the
+      weights (alpha) are computed once for the current data, mask and
+      parameters. Masking a single point updates them in O(n^2).'''
+
+      oneDcurve.__init__(self, x, y, dy, mask)
+
+      self.pars = {
+            'diff_degree':None,
+            'scale':None,
+            'amp':None}
+      for key in args:
+         if key not in self.pars and key != "mean":
+            raise TypeError, \
+                  "%s is an invalid keyword argument for this method" % key
+         if key != "mean": self.pars[key] = args[key]
+      self.mean = args.get('mean', None)
+      self._cache = None
+      self._setup()
+      self.realization = None
+
+   def __str__(self):
+      return "Gaussian Process (numpy)"
+
+   def __getstate__(self):
+      # the mean function may not be pickleable and the cache is rebuilt
+      dict = self.__dict__.copy()
+      dict['mean'] = None
+      dict['_cache'] = None
+      dict['setup'] = False
+      return dict
+
+   def help(self):
+      print "scale:       Scale over which the function varies"
+      print "amp:         Amplitude of typical function variations"
+      print "diff_degree: Degree of differentiability (0,1,2, >2 for inf.)"
+
+   def _mean(self, x):
+      if self.mean is None:
+         return x*0 + self._median
+      return self.mean(x)
+
+   def _kernel(self, r, der=0):
+      '''The covariance at separations [r] (der=0), its derivatives with
+      respect to r (der=1,2) or r times its derivative with respect to
+      scale (der='scale').'''
+      u = num.absolute(r)/self.scale
+      A2 = self.amp**2
+      d = self.diff_degree
+      if d < 0:
+         raise ValueError, "diff_degree must be >= 0"
+      if d == 0:
+         e = num.exp(-u)
+         g = [e, -e, e]
+      elif d == 1:
+         e = num.exp(-num.sqrt(3)*u)
+         g = [(1 + num.sqrt(3)*u)*e, -3*u*e, -3*(1 - num.sqrt(3)*u)*e]
+      elif d == 2:
+         e = num.exp(-num.sqrt(5)*u)
+         g = [(1 + num.sqrt(5)*u + 5*u**2/3)*e,
+              -5./3*u*(1 + num.sqrt(5)*u)*e,
+              -5./3*(1 + num.sqrt(5)*u - 5*u**2)*e]
+      else:
+         e = num.exp(-u**2/2)
+         g = [e, -u*e, (u**2 - 1)*e]
+      if der == 'scale':
+         return -A2*g[1]*u
+      return A2*g[der]/self.scale**der
+
+   def _setup(self):
+      '''Given the current set of params, setup the interpolator.'''
+      x,y,var = self.x,self.y,self.var
+      self._median = num.median(y)
+      if self.diff_degree is None:
+         self.diff_degree = 2
+      if self.amp is None:
+         self.amp = num.std(y - self._mean(x))
+         if self.amp == 0:  self.amp = 1.0
+      if self.scale is None:
+         self.scale = 30
+      K = self._kernel(x[:,num.newaxis] - x[num.newaxis,:])
+      K[num.diag_indices_from(K)] += var + 1e-10*self.amp**2
+      L = cholesky(K, lower=True)
+      r = y - self._mean(x)
+      self._cache = {'mask':num.array(self.mask, dtype=bool), 'x':x, 'r':r,
+                     'L':L, 'alpha':cho_solve((L,True), r), 'grid':None}
+      self.setup = True
+      self.realization = None
+
+   def _check(self):
+      '''Make sure the cached factorization matches the data mask. If a
+      single point was masked, the factorization is updated, otherwise it
+      is recomputed.'''
+      c = self._cache
+      if not self.setup or c is None:
+         self._setup()
+         return
+      mask = num.asarray(self.mask, dtype=bool)
+      if num.alltrue(mask == c['mask']):
+         return
+      if num.sum(c['mask'] != mask) == 1 and num.sum(c['mask']) > 2 and \
+            num.alltrue(mask <= c['mask']):
+         # a point was masked: find its position among the unmasked data
+         j = num.nonzero(c['mask'][c['mask']] != mask[c['mask']])[0][0]
+         L = _chol_delete(c['L'], j)
+         r = num.delete(c['r'], j)
+         self._cache = {'mask':mask.copy(), 'x':num.delete(c['x'], j),
+                        'r':r, 'L':L, 'alpha':cho_solve((L,True), r),
+                        'grid':None}
+         self.realization = None
+      else:
+         self._setup()
+
+   def maskpoint(self, x, y):
+      id = num.argmin(num.power(self.xdata-x,2) + num.power(self.ydata-y,2) +\
+            1e30*num.logical_not(self.mask))
+      self.mask[id] = False
+
+   def maskid(self, i):
+      self.mask[i] = False
+
+   def __call__(self, x):
+      '''Interpolate at point [x].  Returns a 3-tuple: (y, mask) where [y]
+      is the interpolated point, and [mask] is a boolean array with the same
+      shape as [x] and is True where interpolated and False where extrapolated'''
+      self._check()
+      scalar = (len(num.shape(x)) < 1)
+      x = num.atleast_1d(x)
+      if self.realization is not None:
+         res = splev(x, self.realization)
+      else:
+         c = self._cache
+         res = self._mean(x) + \
+               num.dot(self._kernel(x[:,num.newaxis] - c['x'][num.newaxis,:]),
+                       c['alpha'])
+      mask = num.greater_equal(x, self.x.min())*num.less_equal(x, self.x.max())
+      if scalar:
+         return res[0],mask[0]
+      return res,mask
+
+   def domain(self):
+      return (self.x.min(),self.x.max())
+
+   def covariance(self, x):
+      '''The covariance matrix of the posterior at points [x].'''
+      self._check()
+      c = self._cache
+      x = num.atleast_1d(x)
+      Ks = self._kernel(c['x'][:,num.newaxis] - x[num.newaxis,:])
+      V = solve_triangular(c['L'], Ks, lower=True)
+      return self._kernel(x[:,num.newaxis] - x[num.newaxis,:]) - \
+             num.dot(V.T, V)
+
+   def error(self, x, N=None):
+      '''Returns the error in the interpolator at points [x].'''
+      self._check()
+      c = self._cache
+      scalar = (len(num.shape(x)) < 1)
+      x = num.atleast_1d(x)
+      Ks = self._kernel(c['x'][:,num.newaxis] - x[num.newaxis,:])
+      V = solve_triangular(c['L'], Ks, lower=True)
+      res = num.sqrt(num.maximum(self.amp**2 - num.sum(V**2, axis=0), 0))
+      if scalar:
+         return res[0]
+      return res
+
+   def sample(self, x, N=1):
+      '''[N] draws from the posterior at points [x], as an (N,len(x)) array.'''
+      x = num.atleast_1d(x)
+      C = self.covariance(x)
+      w,v = num.linalg.eigh(C)
+      S = v*num.sqrt(num.maximum(w, 0))[num.newaxis,:]
+      return self.__call__(x)[0][num.newaxis,:] + \
+             num.dot(num.random.normal(size=(N,len(x))), S.T)
+
+   def draws(self, N):
+      '''Generate [N] random realizations of the GP at once. They are drawn
+      jointly on a grid spanning the data (at least 20 points per scale)
+      and interpolated with cubic splines. The last one becomes the current
+      realization.'''
+      self._check()
+      c = self._cache
+      if c['grid'] is None:
+         xmin,xmax = self.domain()
+         n = min(max(int(20*(xmax - xmin)/self.scale) + 1, 50), 1000)
+         xg = num.linspace(xmin, xmax, n)
+         C = self.covariance(xg)
+         w,v = num.linalg.eigh(C)
+         c['grid'] = (xg, self.__call__(xg)[0],
+                      v*num.sqrt(num.maximum(w, 0))[num.newaxis,:])
+      xg,yg,S = c['grid']
+      ys = yg[num.newaxis,:] + num.dot(num.random.normal(size=(N,len(xg))), S.T)
+      for y in ys:
+         self.realizations.append(splrep(xg, y, k=3, s=0))
+      if len(self.realizations) > self.num_real_keep:
+         self.realizations = self.realizations[-self.num_real_keep:]
+      self.realization = self.realizations[-1]
+
+   def draw(self):
+      '''Generate a random realization of the GP, based on the data.'''
+      self.draws(1)
+
+   def reset_mean(self):
+      self.realization = None
+
+   def rchisquare(self):
+      chisq = self.chisquare()
+      if len(self.x) < 5:
+         return -1
+      return chisq/(len(self.x) - 4)
+
+   def lnlike(self, grad=False):
+      '''The log marginal likelihood of the data. If [grad] is True, return
+      it along with its gradient with respect to log(amp) and log(scale).'''
+      self._check()
+      c = self._cache
+      L,alpha = c['L'],c['alpha']
+      n = len(alpha)
+      lnl = -0.5*num.dot(c['r'], alpha) - num.sum(num.log(num.diag(L))) - \
+            0.5*n*num.log(2*num.pi)
+      if not grad:
+         return lnl
+      dx = c['x'][:,num.newaxis] - c['x'][num.newaxis,:]
+      W = num.outer(alpha, alpha) - cho_solve((L,True), num.eye(n))
+      dKa = 2*self._kernel(dx)
+      dKs = self._kernel(dx, der='scale')
+      return lnl,num.array([0.5*num.sum(W*dKa), 0.5*num.sum(W*dKs)])
+
+   def optimize(self, **args):
+      '''Set amp and scale to the values that maximize the marginal
+      likelihood, using its analytic gradient. Extra arguments are passed
+      to scipy.optimize.minimize. Returns the output of minimize.'''
+      def f(p):
+         self.pars['amp'],self.pars['scale'] = num.exp(p)
+         self.setup = False
+         lnl,g = self.lnlike(grad=True)
+         return -lnl,-g
+      self._check()
+      p0 = num.log([self.amp, self.scale])
+      res = minimize(f, p0, jac=True, method=args.pop('method','L-BFGS-B'),
+            **args)
+      self.pars['amp'],self.pars['scale'] = num.exp(res.x)
+      self.setup = False
+      if self.ifit is not None:
+         self.ifit.redraw()
+      return res
+
+   def deriv(self, x, n=1):
+      '''Returns the nth derivative of the function at x.'''
+      self._check()
+      scalar = (len(num.shape(x)) < 1)
+      xs = num.atleast_1d(x)
+      if self.realization is not None and n <= 3:
+         res = splev(xs, self.realization, der=n)
+      elif n <= 2:
+         c = self._cache
+         dx = xs[:,num.newaxis] - c['x'][num.newaxis,:]
+         if n == 1:
+            dK = self._kernel(dx, der=1)*num.sign(dx)
+         else:
+            dK = self._kernel(dx, der=2)
+         res = num.dot(dK, c['alpha'])
+         if self.mean is not None:
+            res = res + deriv(self._mean, xs, dx=self.scale/100., n=n)
+      else:
+         f = lambda x:  self.__call__(x)[0]
+         res = deriv(f, xs, dx=self.scale/100., n=n, order=2*n+1)
+      if scalar:
+         return res[0]
+      return res
+
+   def find_extrema(self, xmin=None, xmax=None):
+      '''Find the position and values of the maxima/minima.  Returns a tuple:
+         (roots,vals,ypps) where roots are the x-values where the extrema
+         occur, vals are the y-values at these points, and ypps are the
+         2nd derivatives.  Optionally, only search for roots between
+         xmin and xmax'''
+      if xmin is None:  xmin = self.x.min()
+      if xmax is None:  xmax = self.x.max()
+      dx = min(self.scale*1.0/20, (xmax-xmin)/5.0)
+      xs = num.arange(xmin, xmax, dx)
+      pids = num.greater(self.deriv(xs, n=1), 0)
+      inds = num.nonzero(pids[1:] != pids[:-1])[0]
+      ret = []
+      for i in inds:
+         try:
+            ret.append(brentq(self.deriv, xs[i], xs[i+1]))
+         except:
+            continue
+      if len(ret) == 0:
+         return (num.array([]), num.array([]), num.array([]))
+      ret = num.array(ret)
+      vals = self.__call__(ret)[0]
+      curvs = num.sign(self.deriv(ret, n=2))
+      return ret,vals,curvs
+
+   def intercept(self, y):
+      '''Find the value of x for which the interpolator goes through [y]'''
+      xs = num.arange(self.x.min(), self.x.max(), self.scale/10.)
+      f = lambda x:  self.__call__(x)[0] - y
+      pids = num.greater(f(xs), 0)
+      if num.alltrue(pids) or not num.sometrue(pids):
+         return None
+      inds = num.nonzero(pids[1:] != pids[:-1])[0]
+      return num.array([brentq(f, xs[i], xs[i+1]) for i in inds])
+
+functions['npgp'] = (NumpyGP, "Gaussian Process (numpy, Matern covariance)")
+
+# The Gaussian process interpolators that are available
+gp_classes = tuple([c for c in [GaussianProcess, NumpyGP] if c is not None])
+
+
 def Interpolator(type, x, y, dy, mask=None, **args):
    '''Convenience function that returns a 1D interpolator of the given [type]
    if possible.'''
@@ -0,0 +1,67 @@
+'''Deferred imports, so that ``import snpy`` does not pay for modules
+(matplotlib, emcee, pymysql, ...) that a given session may never use::
+
+   >>> from snpy.utils.lazy import lazy_import
+   >>> plotmod = lazy_import('snpy.plot_sne_mpl')
+   >>> plotmod.plot_sn(s)          # matplotlib is imported here
+
+The real module is imported on first attribute access. Use available() to
+find out whether an optional module can be imported without importing it.
+'''
+import sys
+import imp
+import types
+
+class LazyModule(types.ModuleType):
+   '''A stand-in for module [name] that imports it on first use. Attribute
+   access (and assignment) is forwarded to the real module.'''
+
+   def __init__(self, name):
+      types.ModuleType.__init__(self, name)
+      self.__dict__['_lazy_name'] = name
+      self.__dict__['_lazy_module'] = None
+
+   def _load(self):
+      mod = self.__dict__['_lazy_module']
+      if mod is None:
+         name = self.__dict__['_lazy_name']
+         __import__(name)
+         mod = sys.modules[name]
+         self.__dict__['_lazy_module'] = mod
+      return mod
+
+   def __getattr__(self, attr):
+      return getattr(self._load(), attr)
+
+   def __setattr__(self, attr, value):
+      setattr(self._load(), attr, value)
+
+   def __repr__(self):
+      if self.__dict__['_lazy_module'] is None:
+         return "<lazy module '%s' (not loaded)>" % self.__dict__['_lazy_name']
+      return repr(self.__dict__['_lazy_module'])
+
+def lazy_import(name):
+   '''Return module [name] (an absolute name) if it has already been imported,
+   otherwise a LazyModule that imports it on first use.'''
+   if name in sys.modules and sys.modules[name] is not None:
+      return sys.modules[name]
+   return LazyModule(name)
+
+def loaded(mod):
+   '''Has [mod] (a module or LazyModule) actually been imported?'''
+   if isinstance(mod, LazyModule):
+      return mod.__dict__['_lazy_module'] is not None
+   return mod is not None
+
+def available(name):
+   '''Can top-level module [name] be found on the path? The module is not
+   imported (so an import error inside the module is not detected).'''
+   if name in sys.modules:
+      return sys.modules[name] is not None
+   try:
+      f,path,desc = imp.find_module(name)
+   except ImportError:
+      return False
+   if f is not None:  f.close()
+   return True
@@ -0,0 +1,78 @@
+'''A parallel map over a pool of forked worker processes::
+
+   >>> from snpy.utils import pmap
+   >>> def _work(job):
+   ...    m = pmap.get_state()       # the model, SN, ... of the caller
+   ...    return m.something(job)
+   >>> res = pmap.pmap(_work, jobs, processes=4, state=m)
+
+The function that is mapped must be defined at module level so that it can
+be pickled. Whatever else it needs (models, SN objects, ...), which may not
+be picklable, is passed as [state]: it is set before the workers are
+forked, so they inherit it, and read back with get_state(). With one
+process, the jobs are simply mapped in the calling process.
+'''
+
+# The state of the map in progress, inherited by the worker processes
+_state = None
+
+def get_state():
+   '''The state of the map in progress (see pmap()).'''
+   return _state
+
+class WorkerPool:
+   '''A pool of [processes] worker processes that inherit [state], for
+   callers that map many times (e.g., once per iteration of a solver).
+   With processes <= 1, map() is the built-in map. Call close() when done
+   (or use the pool as a context manager), which also restores the
+   previous state.'''
+
+   def __init__(self, processes=1, state=None):
+      global _state
+      self._old = _state
+      _state = state
+      self.processes = processes
+      self.pool = None
+      if processes > 1:
+         import multiprocessing
+         self.pool = multiprocessing.Pool(processes)
+
+   def map(self, func, jobs, chunksize=None):
+      '''map [func] over [jobs], in the workers if there are any.'''
+      if self.pool is None:
+         return map(func, jobs)
+      return self.pool.map(func, jobs, chunksize)
+
+   def close(self):
+      '''Shut down the workers and restore the previous state.'''
+      global _state
+      if self.pool is not None:
+         self.pool.close()
+         self.pool.join()
+         self.pool = None
+      _state = self._old
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, *args):
+      self.close()
+
+def pmap(func, jobs, processes=1, state=None, chunksize=None):
+   '''Map [func] over [jobs] using up to [processes] worker processes that
+   inherit [state] (see get_state()).
+
+   Args:
+      func (function): a module-level function of one argument
+      jobs (list): the arguments
+      processes (int): maximum number of worker processes
+      state (object): state shared with func through get_state()
+      chunksize (int): number of jobs sent to a worker at a time (see
+                       multiprocessing.Pool.map)
+
+   Returns:
+      list: func(job) for each job, in order.
+   '''
+   jobs = list(jobs)
+   with WorkerPool(min(processes, len(jobs)), state) as pool:
+      return pool.map(func, jobs, chunksize)
@@ -0,0 +1,141 @@
+'''A light-weight, opt-in profiler for the SNooPy fitting chain.
+
+Profiling is switched on by activating a :class:`Profiler` as a context::
+
+   >>> from snpy.utils import profiler
+   >>> with profiler.profiling(s.name) as prof:
+   ...    s.fit()
+   >>> prof.write('SN2006ax_profile.json')
+
+While a profiler is active, the code in :mod:`snpy.sn` and :mod:`snpy.model`
+reports the wall time and number of calls of each stage (initial fit,
+k-corrections, refits, systematics, plotting, ...) along with the number of
+model evaluations done by each least-squares fit. The lower-level hot spots
+are counted too: 'filter.response' (synthetic photometry integrals),
+'template.bisplev' (evaluations of the light-curve template surfaces) and
+'IRSA.query' (dust-map look-ups over the network). When no profiler is
+active, the instrumentation costs a dictionary lookup and nothing is
+recorded.
+'''
+import time
+import json
+
+# The currently active profiler (None if profiling is off)
+_active = None
+
+class Profiler:
+   '''Accumulates wall time and call counts for named stages, counters and
+   a record of every least-squares fit.
+
+   Args:
+      name (str): a label for the record (e.g., the SN name)
+   '''
+
+   def __init__(self, name=None):
+      self.name = name
+      self.stages = {}
+      self.counters = {}
+      self.fits = []
+      self.info = {}
+      self._stack = []
+      self._t0 = time.time()
+      self._t1 = None
+
+   def start(self, stage):
+      '''Start timing [stage].'''
+      self._stack.append((stage, time.time()))
+
+   def stop(self):
+      '''Stop timing the last stage that was started.'''
+      stage,t0 = self._stack.pop()
+      rec = self.stages.setdefault(stage, {'time':0.0, 'calls':0})
+      rec['time'] += time.time() - t0
+      rec['calls'] += 1
+
+   def count(self, counter, n=1):
+      '''Increment [counter] by [n].'''
+      self.counters[counter] = self.counters.get(counter, 0) + n
+
+   def add_fit(self, bands, nfev, walltime, **info):
+      '''Record a least-squares fit. [nfev] is the number of model
+      evaluations and any extra keywords are stored with the record.'''
+      rec = {'stage':self._stack[-1][0] if self._stack else None,
+             'bands':list(bands), 'nfev':int(nfev), 'time':walltime}
+      rec.update(info)
+      self.fits.append(rec)
+      self.count('model_evals', int(nfev))
+
+   def as_dict(self):
+      '''Return the profile as a dictionary that can be serialized as
+      JSON. Anything stored in self.info is added to the record.'''
+      t1 = self._t1 if self._t1 is not None else time.time()
+      d = {'name':self.name,
+           'total_time':t1 - self._t0,
+           'stages':self.stages,
+           'counters':self.counters,
+           'fits':self.fits}
+      d.update(self.info)
+      return d
+
+   def write(self, filename):
+      '''Write the profile as a JSON record to [filename].'''
+      f = open(filename, 'w')
+      json.dump(self.as_dict(), f, indent=1, sort_keys=True)
+      f.close()
+
+   def activate(self):
+      '''Make this the active profiler. Returns self.'''
+      global _active
+      self._prev = _active
+      _active = self
+      return self
+
+   def deactivate(self):
+      '''Stop profiling and restore the previously active profiler.'''
+      global _active
+      self._t1 = time.time()
+      while self._stack:
+         # stages left open by an exception
+         self.stop()
+      _active = self._prev
+
+   def __enter__(self):
+      return self.activate()
+
+   def __exit__(self, *exc):
+      self.deactivate()
+      return False
+
+def profiling(name=None):
+   '''Return a new :class:`Profiler` to be used as a context.'''
+   return Profiler(name)
+
+def active():
+   '''Return the active profiler or None if profiling is off.'''
+   return _active
+
+class stage:
+   '''Context that times a stage on the active profiler, if any::
+
+      with profiler.stage('kcorr_mangled'):
+         self.kcorr(...)
+   '''
+
+   def __init__(self, name):
+      self.name = name
+      self.prof = _active
+
+   def __enter__(self):
+      if self.prof is not None:
+         self.prof.start(self.name)
+      return self.prof
+
+   def __exit__(self, *exc):
+      if self.prof is not None:
+         self.prof.stop()
+      return False
+
+def count(counter, n=1):
+   '''Increment [counter] on the active profiler, if any.'''
+   if _active is not None:
+      _active.count(counter, n)
@@ -0,0 +1,236 @@
+'''A module for watching an inbox directory and processing (e.g., fitting) the
+files that appear in it with a pool of warm worker processes.
+
+New or modified files are picked up once they have stopped changing for
+[debounce] seconds, queued and handed to a fitting function. The fitting
+function writes whatever it produces to a private staging directory; when it
+is done, the products are moved into the outbox with atomic renames, along
+with a JSON status record (<name>.status.json), so that nothing ever sees
+a half-written result::
+
+   >>> from snpy.utils import watchdir
+   >>> def fitter(filename, workdir):
+   ...    s = snpy.get_sn(filename)
+   ...    s.fit()
+   ...    s.save(os.path.join(workdir, s.name+'.snpy'))
+   >>> w = watchdir.WatchDir('inbox', 'outbox', fitter, workers=4)
+   >>> w.run()
+
+The number of files being fit at any one time is bounded by [workers] and
+the queue of files waiting to be fit by [max_queue]. When the queue is full,
+new files are simply left in the inbox until there is room (back-pressure).
+With workers=0, files are fit in the calling process, which is handy for
+testing.
+'''
+import os
+import time
+import glob
+import json
+import shutil
+import tempfile
+import traceback
+from collections import deque
+
+def atomic_write(filename, text):
+   '''Write [text] to [filename] such that readers see either the old file
+   or the complete new one.'''
+   tmp = os.path.join(os.path.dirname(filename) or '.',
+         '.%s.tmp%d' % (os.path.basename(filename), os.getpid()))
+   f = open(tmp, 'w')
+   f.write(text)
+   f.flush()
+   os.fsync(f.fileno())
+   f.close()
+   os.rename(tmp, filename)
+
+def _init_worker(modules):
+   '''Pool initializer: import the (expensive) modules once per worker.'''
+   for mod in modules:
+      __import__(mod)
+
+def _run_task(fitter, filename, workdir):
+   '''Run the fitter, returning (status, info, elapsed time). Exceptions are
+   caught so that a bad file does not take down a worker.'''
+   t0 = time.time()
+   try:
+      info = fitter(filename, workdir)
+      return ('ok', info, time.time() - t0)
+   except Exception, e:
+      return ('failed', {'error':str(e), 'traceback':traceback.format_exc()},
+            time.time() - t0)
+
+class WatchDir:
+   '''Watch [inbox] for files matching [pattern] and fit them with [fitter].
+
+   Args:
+      inbox (str): directory to watch
+      outbox (str): directory into which results are moved
+      fitter (function): called as fitter(filename, workdir). Must write its
+                         products into workdir and may return a dictionary
+                         (JSON-serializable) to be added to the status record.
+                         Must be picklable (a module-level function) if
+                         workers > 0.
+      pattern (str): glob pattern of files to process.
+      debounce (float): a file must not change for this many seconds before
+                        it is processed.
+      workers (int): number of worker processes (0 to fit in this process)
+      max_queue (int): maximum number of files waiting to be fit. Default
+                       is 2*workers (at least 1).
+      warm (list of str): modules to import in each worker at start-up.
+      poll_interval (float): seconds between scans of the inbox in run().
+   '''
+
+   def __init__(self, inbox, outbox, fitter, pattern='*', debounce=2.0,
+         workers=1, max_queue=None, warm=['snpy'], poll_interval=1.0):
+      self.inbox = inbox
+      self.outbox = outbox
+      self.fitter = fitter
+      self.pattern = pattern
+      self.debounce = debounce
+      self.workers = workers
+      if max_queue is None:
+         max_queue = max(2*workers, 1)
+      self.max_queue = max_queue
+      self.poll_interval = poll_interval
+      self.staging = os.path.join(outbox, '.staging')
+      for d in [inbox, outbox, self.staging]:
+         if not os.path.isdir(d):
+            os.makedirs(d)
+
+      self.queue = deque()       # files waiting to be fit
+      self.running = {}          # filename -> (signature, workdir, result)
+      self.seen = {}             # filename -> (mtime,size) when last changed
+      self.done = {}             # filename -> signature when last fit
+      self.nfit = 0
+      self.nfail = 0
+      self.pool = None
+      if workers > 0:
+         import multiprocessing
+         self.pool = multiprocessing.Pool(workers, _init_worker, (warm,))
+
+   def _signature(self, filename):
+      st = os.stat(filename)
+      return (st.st_mtime, st.st_size)
+
+   def scan(self):
+      '''Look for new or modified files that have settled and add them
+      to the queue (as long as there is room). Returns the list of files
+      that were queued.'''
+      now = time.time()
+      queued = []
+      files = sorted(glob.glob(os.path.join(self.inbox, self.pattern)))
+      for filename in files:
+         if os.path.basename(filename).startswith('.'):  continue
+         if not os.path.isfile(filename):  continue
+         try:
+            sig = self._signature(filename)
+         except OSError:
+            continue          # removed under our feet
+         if filename not in self.seen or self.seen[filename][0] != sig:
+            self.seen[filename] = (sig, now)
+         if now - self.seen[filename][1] < self.debounce:  continue
+         if self.done.get(filename, None) == sig:  continue
+         if filename in self.queue or filename in self.running:  continue
+         if len(self.queue) >= self.max_queue:
+            break             # back-pressure: leave it in the inbox
+         self.queue.append(filename)
+         queued.append(filename)
+      # forget about files that have been removed
+      for filename in self.seen.keys():
+         if not os.path.exists(filename):
+            del self.seen[filename]
+            self.done.pop(filename, None)
+      return queued
+
+   def dispatch(self):
+      '''Hand queued files to the workers, up to the number of workers.'''
+      nslots = max(self.workers, 1)
+      while self.queue and len(self.running) < nslots:
+         filename = self.queue.popleft()
+         try:
+            sig = self._signature(filename)
+         except OSError:
+            continue
+         workdir = tempfile.mkdtemp(prefix=os.path.basename(filename)+'.',
+               dir=self.staging)
+         if self.pool is None:
+            res = _run_task(self.fitter, filename, workdir)
+         else:
+            res = self.pool.apply_async(_run_task,
+                  (self.fitter, filename, workdir))
+         self.running[filename] = (sig, workdir, res)
+
+   def collect(self):
+      '''Move the products of finished fits into the outbox. Returns a list
+      of (filename, status) for the fits that finished.'''
+      finished = []
+      for filename in self.running.keys():
+         sig,workdir,res = self.running[filename]
+         if self.pool is not None:
+            if not res.ready():  continue
+            res = res.get()
+         status,info,elapsed = res
+         del self.running[filename]
+         self.publish(filename, workdir, status, info, elapsed)
+         self.done[filename] = sig
+         if status == 'ok':
+            self.nfit += 1
+         else:
+            self.nfail += 1
+         finished.append((filename, status))
+      return finished
+
+   def publish(self, filename, workdir, status, info, elapsed):
+      '''Atomically move the products in [workdir] to the outbox and write
+      the status record.'''
+      products = []
+      for name in sorted(os.listdir(workdir)):
+         os.rename(os.path.join(workdir, name),
+                   os.path.join(self.outbox, name))
+         products.append(name)
+      shutil.rmtree(workdir, ignore_errors=True)
+      rec = {'file':filename, 'status':status, 'time':elapsed,
+             'products':products, 'finished':time.time()}
+      if info is not None:
+         rec['info'] = info
+      name = os.path.splitext(os.path.basename(filename))[0]
+      atomic_write(os.path.join(self.outbox, name+'.status.json'),
+            json.dumps(rec, indent=1, sort_keys=True))
+
+   def poll(self):
+      '''Do one scan/dispatch/collect cycle. Returns the list of fits
+      that finished.'''
+      self.scan()
+      self.dispatch()
+      return self.collect()
+
+   def idle(self):
+      '''True if there is nothing queued or running and every file in the
+      inbox has been processed.'''
+      if self.queue or self.running:
+         return False
+      for filename in self.seen:
+         if self.done.get(filename, None) != self.seen[filename][0]:
+            return False
+      return True
+
+   def run(self, max_time=None, until_idle=False):
+      '''Poll the inbox until interrupted, [max_time] seconds have passed
+      or, if [until_idle], there is nothing left to do.'''
+      t0 = time.time()
+      try:
+         while True:
+            self.poll()
+            if until_idle and self.idle():  break
+            if max_time is not None and time.time() - t0 > max_time:  break
+            time.sleep(self.poll_interval)
+      finally:
+         self.close()
+
+   def close(self):
+      '''Shut down the worker pool, waiting for running fits to finish.'''
+      if self.pool is not None:
+         self.pool.close()
+         self.pool.join()
+         self.collect()
+         self.pool = None